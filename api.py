@@ -1,83 +1,438 @@
 """Interact with the Globus API. All endpoint connections happen here."""
+import calendar
+import collections
+import datetime
+import errno
+import httplib
+import itertools
+import json
+import os
+import random
+import socket
+import tempfile
 import threading
 import time
+import urllib
+import urlparse
 
 from globusonline.transfer import api_client
 
+# Priority classes of transfer tasks, most urgent first (see TransferScheduler).
+FOREGROUND = 0  # Files being opened.
+PREFETCH = 1  # Files likely to be opened soon.
+BACKGROUND = 2  # Queued deletes and renames, hydrations.
+
+# Failures worth retrying: the service is throttling us or briefly unavailable.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+
+# Calls that are safe to repeat after any failure: reads have no side effects, and tasks carry a
+# submission id, so Globus accepts each of them at most once. Other calls (mkdir, cancel) may
+# have taken effect before failing, so only throttled ones, which Globus turned away, are retried.
+REPEATABLE_METHODS = frozenset([
+    'delete', 'endpoint_autoactivate', 'endpoint_ls', 'task', 'task_successful_transfers',
+    'transfer', 'transfer_submission_id'])
+
+# Workload classes of transfer tasks, each with its own TransferProfile (see ProfileFor()).
+SMALL = 'small'  # Batches of small files: prefetches, single small files.
+LARGE = 'large'  # Large files, one per task.
+SUBTREE = 'subtree'  # Directory trees: hydrations, queued renames.
+
+# Credentials and endpoint activations are kept here between mounts (never the password).
+SESSION_PATH = os.path.expanduser('~/.globusfs/session.json')
+
+
+def _ParseExpireTime(expire_time):
+    """Convert a Globus 'expire_time' string (e.g. '2016-03-22 20:58:37+00:00') to epoch secs."""
+    try:
+        return calendar.timegm(time.strptime(expire_time[:19], '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
 
 class GlobusAPI(object):
 
-    def __init__(self, local_endpoint, remote_endpoint):
-        """Create a wrapper around the Globus API Client."""
-        # Get credentials.
-        auth_result = api_client.goauth.get_access_token()
-        self.api = api_client.TransferAPIClient(
-            username=auth_result.username, goauth=auth_result.token)
+    def __init__(self, local_endpoint, remote_endpoint, session_path=SESSION_PATH,
+                 journal_path=None):
+        """Create a wrapper around the Globus API Client.
+
+        This returns quickly: credentials are reused from the last mount while they are valid,
+        and the endpoints are activated in the background (see WaitForActivation()).
+        Queued changes are journaled to journal_path, if given (see AsyncTaskQueue).
+        """
+        self.session_path = session_path
+        self.session = self._LoadSession()
+        self.auth_result = self._Authenticate()
+
+        # The client's HTTPS connection can't be shared between threads, so each thread that
+        # talks to Globus gets its own client (see the api property).
+        self.local = threading.local()
+        self.clients = []
+        self.clients_lock = threading.Lock()
+
+        # Transfer deadlines scale with the estimated duration of each task (see TransferTimeout()).
+        self.estimators = {}  # Maps source endpoint to its ThroughputEstimator.
+        self.submitted = {}  # Maps task id to (source endpoint, submission time, bytes).
+        self.timeout_factor = 3  # Waits give up after this many times the estimated duration...
+        self.min_timeout = 30  # ...but never sooner than this many seconds.
+        self.expiry_factor = 10  # Globus itself abandons a task after this many timeouts.
+        self.tasks_lock = threading.Lock()  # Guards estimators and submitted.
+
+        # Every API call goes through the limiter; transient failures are retried with
+        # exponential backoff (see Call()).
+        self.limiter = RateLimiter()
+        self.max_attempts = 6
+        self.base_backoff = 0.5  # Seconds; doubles with every attempt...
+        self.max_backoff = 30  # ...up to this. The actual delay is random, up to that bound.
+
+        # Every task takes a slot from the scheduler, so bulk work can't delay opens.
+        self.scheduler = TransferScheduler(self.TaskStatus)
+
+        # Transfer options by workload class. Files of at least large_file_size bytes (on
+        # average, for a batch) are transferred with the LARGE profile.
+        self.profiles = {
+            SMALL: TransferProfile(parallelism=1, concurrency=4, max_files=64),
+            LARGE: TransferProfile(parallelism=4, verify_checksum=True),
+            SUBTREE: TransferProfile(concurrency=2, parallelism=2, verify_checksum=True),
+        }
+        self.large_file_size = 1024 * 1024 * 1024
 
         # Activate endpoints.
         self.local_endpoint, self.remote_endpoint = local_endpoint, remote_endpoint
-        status, msg, data = self.api.endpoint_autoactivate(local_endpoint)
-        print data['message']
-        assert status == 200
-        status, msg, data = self.api.endpoint_autoactivate(remote_endpoint)
-        print data['message']
-        assert status == 200
+        self.activation_margin = 3600  # Reactivate endpoints expiring sooner than this.
+        self.activation_error = None
+        self.activated = threading.Event()
+        thread = threading.Thread(target=self._ActivateEndpoints)
+        thread.daemon = True
+        thread.start()
 
         # Setup asynchronous task queue.
-        self.task_queue = AsyncTaskQueue(self)
+        self.task_queue = AsyncTaskQueue(self, journal_path)
+
+    def _LoadSession(self):
+        try:
+            with open(self.session_path) as f:
+                session = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return session if isinstance(session, dict) else {}
+
+    def _SaveSession(self):
+        """Atomically write the session file, readable by its owner only.
+
+        Each save goes through its own temporary file, so mounts (or the endpoints of one cache
+        daemon) saving at once don't clobber each other. A failed save is only reported: the
+        next mount authenticates or activates again.
+        """
+        directory = os.path.dirname(self.session_path)
+        tmp_path = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            fd, tmp_path = tempfile.mkstemp(prefix='.session-', dir=directory)  # Mode 0600.
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.session, f)
+            os.rename(tmp_path, self.session_path)
+        except EnvironmentError, e:
+            print 'Saving the session to {0} failed: {1}'.format(self.session_path, e)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _Authenticate(self):
+        """Reuse the token of the last mount if it hasn't expired, otherwise prompt for one."""
+        username, token = self.session.get('username'), self.session.get('token')
+        if isinstance(token, basestring):
+            # Nexus tokens look like 'un=...|tokenid=...|expiry=1458680317|...'.
+            fields = dict(field.split('=', 1) for field in token.split('|') if '=' in field)
+            try:
+                expiry = int(fields.get('expiry', 0))
+            except ValueError:
+                expiry = 0  # Malformed; authenticate again.
+            if expiry > time.time() + 60:
+                return api_client.goauth.GOAuthResult(username, None, token)
+
+        result = api_client.goauth.get_access_token()
+        self.session = {'username': result.username, 'token': result.token, 'activations': {}}
+        self._SaveSession()
+        return result
+
+    def _ActivateEndpoints(self):
+        """Async function: activate both endpoints in parallel, skipping recent activations."""
+        activations = self.session.get('activations')
+        if not isinstance(activations, dict):
+            activations = self.session['activations'] = {}
+        threads = []
+        for endpoint in set([self.local_endpoint, self.remote_endpoint]):
+            if activations.get(endpoint, 0) > time.time() + self.activation_margin:
+                continue
+            thread = threading.Thread(target=self._Activate, args=(endpoint,))
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                thread.join()
+            if threads and not self.activation_error:
+                self._SaveSession()
+        finally:
+            self.activated.set()  # Never leave WaitForActivation() callers waiting.
+
+    def _Activate(self, endpoint):
+        try:
+            status, msg, data = self.Call('endpoint_autoactivate', endpoint)
+        except api_client.APIError, e:
+            status, data = e.status_code, {'message': str(e)}
+        except Exception, e:  # Out of retries on a network error, or a malformed reply.
+            status, data = None, {'message': '{0}: {1}'.format(type(e).__name__, e)}
+        print data['message']
+        if status != 200:
+            self.activation_error = '{0}: {1}'.format(endpoint, data['message'])
+            return
+        # Endpoints without an expiry (e.g. shared ones) are activated again on every mount.
+        self.session['activations'][endpoint] = _ParseExpireTime(data.get('expire_time')) or 0
+
+    def WaitForActivation(self):
+        """Block until both endpoints have been activated.
+
+        Raises:
+            OSError: EACCES if an endpoint couldn't be activated.
+        """
+        self.activated.wait()
+        if self.activation_error:
+            raise OSError(errno.EACCES, 'Activation failed for ' + self.activation_error)
+
+    @property
+    def api(self):
+        """The calling thread's TransferAPIClient."""
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = api_client.TransferAPIClient(
+                username=self.auth_result.username, goauth=self.auth_result.token)
+            with self.clients_lock:
+                self.clients.append(client)
+        return client
 
     def Close(self):
-        """Wait for pending changes and close out the API connection."""
+        """Stop the task queue (see AsyncTaskQueue.Finish()) and close out the API connections."""
         self.task_queue.Finish()
-        self.api.close()
+        with self.clients_lock:
+            for client in self.clients:
+                client.close()
+
+    def Call(self, method, *args, **kwargs):
+        """Call a TransferAPIClient method within the rate limits, retrying transient failures.
+
+        Only REPEATABLE_METHODS are retried after a failure that may have taken effect (a server
+        error or a dropped connection); every method is retried when throttled.
+
+        Returns:
+            The (status, message, data) of the call.
+
+        Raises:
+            api_client.APIError: the call failed for good.
+        """
+        for attempt in itertools.count(1):
+            self.limiter.Acquire()
+            throttled = succeeded = False
+            try:
+                result = getattr(self.api, method)(*args, **kwargs)
+            except api_client.APIError, e:
+                throttled = e.status_code in THROTTLE_STATUSES
+                if not _Transient(e) or attempt == self.max_attempts:
+                    raise
+                if not throttled and method not in REPEATABLE_METHODS:
+                    raise
+                error = e
+            except (socket.error, httplib.HTTPException), e:
+                throttled = isinstance(e, socket.timeout)
+                self._DropClient()  # Its connection may be broken.
+                if method not in REPEATABLE_METHODS or attempt == self.max_attempts:
+                    raise
+                error = e
+            else:
+                succeeded = True
+                return result
+            finally:
+                # Whatever happened (even an exception we don't handle), the call is over.
+                self.limiter.Release(throttled=throttled, succeeded=succeeded)
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+            print 'Globus {0} failed ({1}); retrying in {2:.1f}s'.format(method, error, delay)
+            time.sleep(delay)
+
+    def _DropClient(self):
+        """Close the calling thread's TransferAPIClient; the next call opens a new one."""
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            return
+        self.local.client = None
+        with self.clients_lock:
+            self.clients.remove(client)
+        client.close()
 
     def SubmissionID(self):
         """Get a new submission id."""
-        status, msg, data= self.api.transfer_submission_id()
+        status, msg, data = self.Call('transfer_submission_id')
         return data['value']
 
     ######################
     #  Blocking Requests #
     ######################
 
-    def CopyToLocal(self, remote_path, local_path, timeout_secs=10):
+    def CopyToLocal(self, remote_path, local_path, size=0, timeout_secs=None):
         """Copy a remote file into the local endpoint.
 
         Args:
             remote_path: Remote file path to copy.
             local_path: Destination file path.
-            timeout: Maximum waiting time (in seconds) for file transfer to complete.
+            size: Size of the remote file in bytes, used to pick the default timeout.
+            timeout_secs: Maximum waiting time (in seconds) for file transfer to complete.
+                Defaults to TransferTimeout(size).
 
         Returns:
             True if the transfer was successful, False otherwise.
         """
         # Copy the file over the network; block until successful or timeout.
         print 'Copying {0} to local cache...'.format(remote_path)
-        task = api_client.Transfer(
-            self.SubmissionID(), self.remote_endpoint, self.local_endpoint)
-        task.add_item(remote_path, local_path)
-        status, msg, data = self.api.transfer(task)
-        task_id = data['task_id']
-
-        success = False
-        for _ in xrange(timeout_secs):
-            status, msg, data = self.api.task(task_id)
+        task_id = self.SubmitCopyToLocal([(remote_path, local_path)], size)
+        if timeout_secs is None:
+            timeout_secs = self.TransferTimeout(size)
+        return self.WaitForTask(task_id, timeout_secs)
+
+    def SubmitCopyToLocal(self, items, size=None, recursive=False, ticket=None, profile=None,
+                          sync_level=None):
+        """Submit a single transfer task for a list of (remote_path, local_path) pairs.
+
+        Blocks until the scheduler has a slot for the task. FOREGROUND tasks (opens) wait for
+        at most TransferTimeout(size); the others as long as it takes.
+
+        Args:
+            items: (remote_path, local_path) pairs to transfer.
+            size: Total bytes of the files, if known. The task then expires expiry_factor
+                timeouts after submission rather than after Globus' default deadline.
+            recursive: True if the items are directories to transfer with their contents.
+            ticket: TransferTicket to wait for a slot with (default: a FOREGROUND one).
+            profile: Workload class whose TransferProfile to use (default: ProfileFor()).
+            sync_level: If given, destination files that are already up to date by this
+                measure (1: size, 2: mtime, 3: checksum) are skipped rather than copied.
+
+        Returns:
+            The task id; see WaitForTask() and CancelTask().
+
+        Raises:
+            IOError: ETIMEDOUT if a FOREGROUND task got no slot in time.
+        """
+        self.WaitForActivation()
+        ticket = ticket or TransferTicket(FOREGROUND)
+        profile = profile or self.ProfileFor(items, size, recursive)
+        timeout = self.TransferTimeout(size or 0) if ticket.priority == FOREGROUND else None
+        if not self.scheduler.Acquire(ticket, timeout):
+            raise IOError(errno.ETIMEDOUT, 'No transfer slot for {0} in {1:.0f}s'.format(
+                items[0][0], timeout))
+        try:
+            task_id = self._SubmitCopyToLocal(items, size, recursive, profile, sync_level)
+        except:
+            self.scheduler.Release(ticket)
+            raise
+        self.scheduler.Assign(ticket, task_id)
+        return task_id
+
+    def ProfileFor(self, items, size, recursive):
+        """The workload class of a transfer (see SubmitCopyToLocal() for the arguments)."""
+        if recursive:
+            return SUBTREE
+        if size is not None and size >= self.large_file_size * len(items):
+            return LARGE
+        return SMALL
+
+    def _SubmitCopyToLocal(self, items, size, recursive, profile, sync_level):
+        deadline = None
+        if size is not None:
+            lifetime = self.expiry_factor * self.TransferTimeout(size)
+            deadline = (datetime.datetime.utcnow().replace(microsecond=0) +
+                        datetime.timedelta(seconds=int(lifetime)))
+        task = self.profiles[profile].Transfer(
+            self.SubmissionID(), self.remote_endpoint, self.local_endpoint, sync_level=sync_level,
+            deadline=deadline)
+        for remote_path, local_path in items:
+            task.add_item(remote_path, local_path, recursive=recursive)
+        status, msg, data = self.Call('transfer', task)
+        task_id = _TaskID(data)
+        with self.tasks_lock:
+            self.submitted[task_id] = (self.remote_endpoint, time.time(), size)
+        return task_id
+
+    def WaitForTask(self, task_id, timeout_secs=None):
+        """Block until the task completes or timeout_secs pass (None to wait for completion).
+
+        A task that is still running when the timeout expires keeps going; it can be waited for
+        again.
+
+        Returns:
+            True if the task completed successfully, False otherwise.
+        """
+        deadline = None if timeout_secs is None else time.time() + timeout_secs
+        while True:
+            data = self.TaskStatus(task_id)
             if data['completion_time']:
-                success = True
-                break
+                return data['status'] == 'SUCCEEDED'
+            if deadline is not None and time.time() >= deadline:
+                return False
             time.sleep(1)
 
-        return success
+    def TaskStatus(self, task_id):
+        """Return the task document (status, completion_time, files, bytes_transferred...).
+
+        Once a task has completed, its scheduler slot is given back; if it was successful, it
+        also feeds the throughput estimate of its source endpoint.
+        """
+        status, msg, data = self.Call('task', task_id)
+        if data['completion_time']:
+            self.scheduler.Finished(task_id)
+            with self.tasks_lock:
+                endpoint, submit_time, size = self.submitted.pop(task_id, (None, None, None))
+            if data['status'] == 'SUCCEEDED' and endpoint:
+                if size is None:
+                    size = data.get('bytes_transferred') or 0
+                self.Estimator(endpoint).Observe(size, time.time() - submit_time)
+        return data
+
+    def SuccessfulTransfers(self, task_id, marker=None):
+        """List the files a transfer task has delivered so far, one page at a time.
+
+        Returns:
+            (source paths, marker of the next page or None if this was the last one)
+        """
+        kw = {'marker': marker} if marker else {}
+        status, msg, data = self.Call('task_successful_transfers', task_id, **kw)
+        return [item['source_path'] for item in data['DATA']], data.get('next_marker')
+
+    def Estimator(self, endpoint=None):
+        """The ThroughputEstimator of an endpoint (default: the remote one)."""
+        endpoint = endpoint or self.remote_endpoint
+        with self.tasks_lock:
+            if endpoint not in self.estimators:
+                self.estimators[endpoint] = ThroughputEstimator()
+            return self.estimators[endpoint]
+
+    def TransferTimeout(self, size):
+        """Seconds to wait for size bytes to arrive from the remote endpoint before giving up."""
+        estimate = self.Estimator().Estimate(size)
+        return max(self.min_timeout, self.timeout_factor * estimate)
+
+    def CancelTask(self, task_id):
+        """Cancel an active task."""
+        self.Call('task_cancel', task_id)
 
     def EndpointList(self, path):
         """Return a list of file info dictionaries for the given path."""
         print 'Loading directory %s from Globus...' % path
-        status, msg, data = self.api.endpoint_ls(self.remote_endpoint, path=path)
+        self.WaitForActivation()
+        status, msg, data = self.Call('endpoint_ls', self.remote_endpoint, path=path)
         return data['DATA']
 
     def Mkdir(self, path):
         """Make a directory on the remote endpoint."""
-        _, _, data = self.api.endpoint_mkdir(self.remote_endpoint, path)
+        self.WaitForActivation()
+        _, _, data = self.Call('endpoint_mkdir', self.remote_endpoint, path)
         print data['message']
 
     ########################
@@ -100,81 +455,753 @@ class AsyncTaskQueue(object):
     For example, recurisvely removing a directory would make dozens of calls to api.Delete().
     Rather than sending the requests individually, we batch them together here,
     reducing network overhead and improving performance.
+
+    With a journal, queued changes survive crashes and unmounts: whatever hasn't been pushed
+    when the process stops is pushed by the next mount.
     """
 
-    def __init__(self, api):
+    def __init__(self, api, journal_path=None):
         # Store tasks as a list (queue).
-        # Each entry is a 2-tuple:
+        # Each entry is a 3-tuple:
         #     descriptor tuple e.g. ('delete', 'go#ep1')
         #     Globus api_client task to submit
+        #     journal sequence numbers of its items
         self.queue = []
 
         self.api = api  # GlobusAPI() wrapper (has access to SubmissionID)
-        self.direct_api = api.api  # Underlying api object.
         self.lock = threading.Lock()
         self.last_change = time.time()  # Time of last task submission.
         self.closing = False  # Flag to indicate when the process should close.
+        self.wake = threading.Event()  # Set to push the queue right away (see Flush()).
+        self.pending_task_id = None  # Last task pushed until it completes; the next one waits.
+        self.pushing = False  # Set while HandleTasks() submits tasks taken off the queue.
+
+        self.batch_window = 3  # Push once no task has been added for this many seconds,
+        self.poll_interval = 10  # checking this often.
+        self.order_timeout = 30  # Max seconds to wait for a task before submitting the next.
+        self.shutdown_grace = 5  # Seconds Finish() lets a push in progress complete.
+
+        # Pick up the changes an earlier process queued but didn't push.
+        self.journal = Journal(journal_path)
+        for descriptor, items, submission_id, seqs in self.journal.Pending():
+            task = self._NewTask(descriptor)
+            task.submission_id = submission_id
+            for item in items:
+                self._AddItem(task, descriptor, item)
+            self.queue.append((descriptor, task, seqs))
+        self.journal.Checkpoint()
+        if self.queue:
+            print 'Resuming {0} queued tasks from {1}'.format(len(self.queue), journal_path)
+            self.wake.set()
+
         self.handler_thread = threading.Thread(target=self.HandleTasks)
+        self.handler_thread.daemon = True  # Never holds up exit; the journal has the rest.
         self.handler_thread.start()
 
     def Finish(self):
-        """Wait until all pending changes have synced and the thread quits."""
+        """Stop pushing changes and let the thread quit.
+
+        Without a journal, this waits until all pending changes have synced. With one, it only
+        gives a push in progress shutdown_grace seconds and checkpoints the journal.
+        """
         self.closing = True
-        self.handler_thread.join()
+        self.wake.set()
+        if not self.journal.path:
+            self.handler_thread.join()
+            return
+        self.handler_thread.join(self.shutdown_grace)
+        self.journal.Checkpoint()
+        self.journal.Close()
+        count = len(self.journal.items)
+        if count:
+            print 'EXIT: {0} queued changes saved in {1}'.format(count, self.journal.path)
+
+    def Flush(self):
+        """Push the queued tasks now rather than at the end of the batch window."""
+        self.wake.set()
 
     def HandleTasks(self):
         """Async function: wake up every so often and process the pending tasks."""
+        self._Reconcile()
         while True:
-            # Copy the relevant tasks so the lock can be released.            
-            if self.closing or time.time() - self.last_change > 3:
-                # We're closing or the last change was more than 3 seconds ago; push changes.
+            # Copy the relevant tasks so the lock can be released.
+            closing, flush = self.closing, self.wake.is_set()
+            self.wake.clear()
+            if closing and self.journal.path:
+                return  # The next mount pushes what's left.
+            if closing or flush or time.time() - self.last_change > self.batch_window:
+                # We're closing, flushing or the batch window has passed; push changes.
                 queue_copy = []
                 with self.lock:
                     # Copy relevant tasks into a separate queue so we can work on them.
                     queue_copy.extend(self.queue)
                     self.queue = []
+                    self.pushing = bool(queue_copy)
 
                 # print 'Clearing task queue...'
-                pending_task_id = None
-                for descriptor, task in queue_copy:
-                    if pending_task_id:
-                        # We need to wait at least 30 secs for the last task to finish before
-                        # submitting the next. The ordering of deletes/moves may be important.
-                        for _ in xrange(30):
-                            status, msg, data = self.direct_api.task(pending_task_id)
-                            if data['completion_time']:
-                                break
-                            time.sleep(1)
-                    if descriptor[0] == 'delete':
-                        _, _, data = self.direct_api.delete(task)
-                        pending_task_id = data['task_id']
-                        print '\t' + data['message']
-                    else:  # Transfer
-                        _, _, data = self.direct_api.transfer(task)
-                        pending_task_id = data['task_id']
-                        print '\t' + data['message']
-            if self.closing:
+                try:
+                    self._Push(queue_copy)
+                except (api_client.APIError, EnvironmentError, httplib.HTTPException), e:
+                    # Whatever wasn't submitted goes back to the front of the queue.
+                    with self.lock:
+                        self.queue[:0] = queue_copy
+                    print 'Pushing {0} queued tasks failed: {1}'.format(len(queue_copy), e)
+                    if closing:
+                        print 'EXIT: {0} queued tasks were not pushed'.format(len(queue_copy))
+                finally:
+                    self.pushing = False
+            if closing:
                 return
-            time.sleep(10)
+            if self.pending_task_id and not self.queue:
+                self._CheckPending()
+            if self.journal.CheckpointDue():
+                try:
+                    self.journal.Checkpoint()  # Bounds the file, and replay time at the next mount.
+                except EnvironmentError, e:
+                    print 'Checkpointing {0} failed: {1}'.format(self.journal.path, e)
+            self.wake.wait(self.poll_interval)
 
-    def AddDeletion(self, endpoint, path):
-        descriptor = ('delete', endpoint)
+    def Idle(self):
+        """True if every queued change has been pushed and its task has completed."""
         with self.lock:
-            if self.queue and self.queue[-1][0] == descriptor:
-                self.queue[-1][1].add_item(path)
+            return not (self.queue or self.pushing or self.pending_task_id)
+
+    def _CheckPending(self):
+        """Forget the last task pushed once it has completed, so the queue can be Idle()."""
+        task_id = self.pending_task_id
+        try:
+            if self.api.TaskStatus(task_id)['completion_time']:
+                self.journal.Done(task_id)
+                self.pending_task_id = None
+        except (api_client.APIError, EnvironmentError, httplib.HTTPException), e:
+            print 'Checking task {0} failed: {1}'.format(task_id, e)
+
+    def _Reconcile(self):
+        """Forget the journaled tasks of earlier processes that have completed since.
+
+        The last one still running is waited for before the first new push, as usual.
+        """
+        for task_id in list(self.journal.in_flight):
+            try:
+                if self.api.TaskStatus(task_id)['completion_time']:
+                    self.journal.Done(task_id)
+                    continue
+            except api_client.APIError, e:
+                if e.status_code == 404:
+                    self.journal.Done(task_id)  # Too old for Globus to remember.
+                    continue
+                print 'Checking task {0} failed: {1}'.format(task_id, e)
+            except (EnvironmentError, httplib.HTTPException), e:
+                print 'Checking task {0} failed: {1}'.format(task_id, e)
+            self.pending_task_id = task_id
+
+    def _Push(self, queue_copy):
+        """Submit queued tasks in order, removing each from queue_copy once Globus has it."""
+        if queue_copy:
+            self.api.WaitForActivation()
+        while queue_copy:
+            descriptor, task, seqs = queue_copy[0]
+            if self.pending_task_id:
+                # We need to wait for the last task to finish before submitting the
+                # next. The ordering of deletes/moves may be important.
+                for _ in xrange(self.order_timeout):
+                    if self.api.TaskStatus(self.pending_task_id)['completion_time']:
+                        self.journal.Done(self.pending_task_id)
+                        self.pending_task_id = None
+                        break
+                    time.sleep(1)
+            ticket = TransferTicket(BACKGROUND)
+            self.api.scheduler.Acquire(ticket)
+            try:
+                if task.submission_id is None:
+                    # Kept if the submission fails, so a retry can't submit the task twice.
+                    # Journaled before the task is sent: after a crash, it is sent again with
+                    # the same id, which Globus accepts at most once.
+                    task.submission_id = self.api.SubmissionID()
+                    self.journal.Submit(seqs, task.submission_id)
+                if descriptor[0] == 'delete':
+                    _, _, data = self.api.Call('delete', task)
+                else:  # Transfer
+                    _, _, data = self.api.Call('transfer', task)
+                task_id = _TaskID(data)
+            except:
+                self.api.scheduler.Release(ticket)
+                raise
+            self.api.scheduler.Assign(ticket, task_id)
+            self.journal.Submitted(task.submission_id, task_id)
+            self.pending_task_id = task_id
+            queue_copy.pop(0)
+            print '\t' + data['message']
+
+    def _Mergeable(self, descriptor):
+        """True if a new item can join the last queued task. Call with self.lock held.
+
+        A task that has been submitted once (and put back after a failure) must be submitted
+        again exactly as it was.
+        """
+        if not (self.queue and self.queue[-1][0] == descriptor and
+                self.queue[-1][1].submission_id is None):
+            return False
+        max_files = self.api.profiles[SUBTREE].max_files
+        return descriptor[0] == 'delete' or not max_files or len(self.queue[-1][2]) < max_files
+
+    def _NewTask(self, descriptor):
+        # The submission id is fetched when the task is pushed, outside the lock.
+        if descriptor[0] == 'delete':
+            return api_client.Delete(None, descriptor[1], recursive=True)
+        return self.api.profiles[SUBTREE].Transfer(None, descriptor[1], descriptor[2])
+
+    @staticmethod
+    def _AddItem(task, descriptor, item):
+        if descriptor[0] == 'delete':
+            task.add_item(*item)
+        else:
+            task.add_item(*item, recursive=True)
+
+    def _Add(self, descriptor, item):
+        with self.lock:
+            seq = self.journal.Add(descriptor, item)
+            if self._Mergeable(descriptor):
+                self._AddItem(self.queue[-1][1], descriptor, item)
+                self.queue[-1][2].append(seq)
             else:
-                task = api_client.Delete(self.api.SubmissionID(), endpoint, recursive=True)
-                task.add_item(path)
-                self.queue.append((descriptor, task))
+                task = self._NewTask(descriptor)
+                self._AddItem(task, descriptor, item)
+                self.queue.append((descriptor, task, [seq]))
             self.last_change = time.time()
 
+    def AddDeletion(self, endpoint, path):
+        self._Add(('delete', endpoint), (path,))
+
     def AddTransfer(self, src_endpoint, src_path, dest_endpoint, dest_path):
-        descriptor = ('transfer', src_endpoint, dest_endpoint)
+        self._Add(('transfer', src_endpoint, dest_endpoint), (src_path, dest_path))
+
+
+class Journal(object):
+    """Append-only log of the task queue, so queued changes survive the process.
+
+    Each line is a JSON record:
+        {"add": seq, "descriptor": [...], "item": [...]}   an item was queued
+        {"submit": submission_id, "seqs": [...]}            a task of those items is being sent
+        {"submitted": submission_id, "task_id": task_id}    Globus accepted it
+        {"done": task_id}                                   it has completed
+    Loading replays the records; Checkpoint() rewrites the file with just the current state,
+    which the task queue does whenever CheckpointDue(). Records are flushed as they are written,
+    so they survive a crash of the process (though not necessarily of the machine until the next
+    checkpoint). With no path, nothing is kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()  # Maps seq to (descriptor, item) not yet accepted.
+        self.submissions = {}  # Maps submission id to the seqs of its task.
+        self.in_flight = []  # Ids of accepted tasks not known to have completed, oldest first.
+        self.seq = 0  # Last sequence number given out.
+        self.written = 0  # Records appended since the last checkpoint.
+        self.checkpoint_records = 1000  # Records after which a checkpoint is due regardless.
+        self.file = None
+        if path:
+            self._Load()
+
+    def _Load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Cut short by a crash; nothing after it was written.
+                    self._Apply(record)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _Apply(self, record):
+        if 'add' in record:
+            self.seq = max(self.seq, record['add'])
+            self.items[record['add']] = (tuple(record['descriptor']), tuple(record['item']))
+        elif 'submit' in record:
+            self.submissions[record['submit']] = record['seqs']
+        elif 'submitted' in record:
+            for seq in self.submissions.pop(record['submitted'], ()):
+                self.items.pop(seq, None)
+            self.in_flight.append(record['task_id'])
+        elif 'done' in record:
+            if record['done'] in self.in_flight:
+                self.in_flight.remove(record['done'])
+
+    def _Write(self, record):
         with self.lock:
-            if self.queue and self.queue[-1][0] == descriptor:
-                self.queue[-1][1].add_item(src_path, dest_path, recursive=True)
+            self._Apply(record)
+            if self.file:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+                self.written += 1
+
+    def Add(self, descriptor, item):
+        """Record a queued item. Returns its sequence number."""
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        self._Write({'add': seq, 'descriptor': descriptor, 'item': item})
+        return seq
+
+    def Submit(self, seqs, submission_id):
+        self._Write({'submit': submission_id, 'seqs': list(seqs)})
+
+    def Submitted(self, submission_id, task_id):
+        self._Write({'submitted': submission_id, 'task_id': task_id})
+
+    def Done(self, task_id):
+        self._Write({'done': task_id})
+
+    def Pending(self):
+        """The queued tasks to push, in order: (descriptor, items, submission id, seqs).
+
+        Tasks that were being sent keep their submission id and items; other items are grouped
+        like AsyncTaskQueue does.
+        """
+        owner = {}
+        for submission_id, seqs in self.submissions.iteritems():
+            for seq in seqs:
+                owner[seq] = submission_id
+        tasks, seen = [], set()
+        for seq, (descriptor, item) in self.items.iteritems():
+            submission_id = owner.get(seq)
+            if submission_id in seen:
+                continue
+            if submission_id:
+                seen.add(submission_id)
+                seqs = [s for s in self.submissions[submission_id] if s in self.items]
+                tasks.append((descriptor, [self.items[s][1] for s in seqs], submission_id, seqs))
+            elif tasks and tasks[-1][0] == descriptor and tasks[-1][2] is None:
+                tasks[-1][1].append(item)
+                tasks[-1][3].append(seq)
+            else:
+                tasks.append((descriptor, [item], None, [seq]))
+        return tasks
+
+    def CheckpointDue(self):
+        """True if a checkpoint would shrink the file a lot: records have been appended since the
+        last one and nothing is queued any more, or checkpoint_records of them have been."""
+        return bool(self.written) and (not self.items or
+                                       self.written >= self.checkpoint_records)
+
+    def Checkpoint(self):
+        """Atomically rewrite the journal with the current state, and keep appending to it."""
+        if not self.path:
+            return
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            records = [{'add': seq, 'descriptor': descriptor, 'item': item}
+                       for seq, (descriptor, item) in self.items.iteritems()]
+            records.extend({'submit': submission_id, 'seqs': seqs}
+                           for submission_id, seqs in self.submissions.iteritems())
+            records.extend({'submitted': None, 'task_id': task_id} for task_id in self.in_flight)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+            if self.file:
+                self.file.close()
+            self.file = open(self.path, 'a')
+            self.written = 0
+
+    def Close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def _Transient(error):
+    """True if the APIError may go away when the call is retried.
+
+    Globus also answers 502 when the endpoint itself fails the request (an ExternalError code,
+    e.g. a missing path or a directory that already exists); retrying won't change that.
+    """
+    if (error.code or '').startswith('ExternalError'):
+        return False
+    return error.status_code in RETRY_STATUSES
+
+
+def _TaskID(data):
+    """The id of a task Globus accepted (or had already accepted, for a repeated submission)."""
+    task_id = data.get('task_id')
+    if not task_id:
+        raise IOError(errno.EIO, 'Globus returned no task id: {0}'.format(data.get('message')))
+    return task_id
+
+
+class RateLimiter(object):
+    """Keep calls to the Globus API within the service's limits.
+
+    A token bucket spaces calls out to rate per second (with bursts of up to burst calls), and a
+    congestion window caps how many are in flight. Both grow a little with every successful call
+    and are halved, at most once per cooldown seconds, when the service throttles us (429/503)
+    or a call times out (AIMD). Slow calls alone don't count: a listing of a huge directory is
+    slow however idle the service is.
+    """
+
+    def __init__(self, rate=10.0, burst=20, window=4.0):
+        self.rate = float(rate)
+        self.min_rate = 0.5
+        self.max_rate = 50.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.window = float(window)
+        self.max_window = 16.0
+        self.in_flight = 0
+        self.cooldown = 2
+        self.decreased = 0  # Time of the last decrease.
+        self.cond = threading.Condition()
+
+    def Acquire(self):
+        """Block until a call may start."""
+        with self.cond:
+            while True:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.in_flight >= int(self.window):
+                    self.cond.wait()
+                elif self.tokens < 1:
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+
+    def Release(self, throttled=False, succeeded=False):
+        """Account for a finished call; every Acquire() must be matched by one.
+
+        Args:
+            throttled: True if the service refused the call because of its limits, or it timed
+                out.
+            succeeded: True if the call went through.
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                if time.time() - self.decreased >= self.cooldown:
+                    self.decreased = time.time()
+                    self.window = max(1.0, self.window / 2)
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    print 'Globus is busy: now {0:.1f} calls/s, {1} at once'.format(
+                        self.rate, int(self.window))
+            elif succeeded:
+                self.window = min(self.max_window, self.window + 1 / self.window)
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+            self.cond.notify_all()
+
+
+class TransferProfile(object):
+    """Globus options for the transfer tasks of one workload class.
+
+    Options left at None are Globus' defaults. parallelism (streams per file) and concurrency
+    (files in flight) may only be honored up to the limits the endpoints allow.
+
+    Files can only be read while they are being transferred (see InOrder()) with parallelism 1.
+    """
+
+    def __init__(self, parallelism=None, concurrency=None, encrypt=False, verify_checksum=False,
+                 sync_level=None, max_files=None):
+        self.parallelism = parallelism
+        self.concurrency = concurrency
+        self.encrypt = encrypt
+        self.verify_checksum = verify_checksum
+        self.sync_level = sync_level  # 0-3: skip files that exist / same size / newer / checksum.
+        self.max_files = max_files  # Most files batched into one task (None: no limit).
+
+    def InOrder(self):
+        """True if files arrive front to back. Parallel streams (Globus' default may use several)
+        write different parts of a file at once, leaving holes behind the furthest one."""
+        return self.parallelism == 1
+
+    def Options(self):
+        """The task document fields this profile sets."""
+        options = {'encrypt_data': self.encrypt, 'verify_checksum': self.verify_checksum}
+        for field, value in (('perf_p', self.parallelism), ('perf_cc', self.concurrency),
+                             ('sync_level', self.sync_level)):
+            if value is not None:
+                options[field] = value
+        return options
+
+    def Transfer(self, submission_id, source_endpoint, destination_endpoint, sync_level=None,
+                 **kwargs):
+        """A new api_client.Transfer task with this profile's options; a sync_level given here
+        takes precedence over the profile's."""
+        options = self.Options()
+        if sync_level is not None:
+            options['sync_level'] = sync_level
+        return _ProfiledTransfer(submission_id, source_endpoint, destination_endpoint, options,
+                                 **kwargs)
+
+
+class _ProfiledTransfer(api_client.Transfer):
+    """api_client.Transfer with extra task document fields, which it has no arguments for."""
+
+    def __init__(self, submission_id, source_endpoint, destination_endpoint, options, **kwargs):
+        api_client.Transfer.__init__(
+            self, submission_id, source_endpoint, destination_endpoint, **kwargs)
+        self.options = options
+
+    def as_data(self):
+        data = api_client.Transfer.as_data(self)
+        data.update(self.options)
+        return data
+
+
+class TransferTicket(object):
+    """A request for a task slot. Its priority may be raised while it waits (see Promote())."""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.arrival = time.time()
+        self.task_id = None  # Set once the task has been submitted.
+
+
+class TransferScheduler(object):
+    """Share Globus task slots between the priority classes.
+
+    A task takes a slot before it is submitted and gives it back once it has been seen complete.
+    At most slots tasks run at once, and prefetches and background work have smaller caps, so
+    opens always find a slot. A waiting request goes before every less urgent one, but moves up
+    a class for every aging seconds it has waited, so background work is never starved.
+    """
+
+    def __init__(self, status, slots=4, prefetch_cap=1, background_cap=2, aging=60):
+        """
+        Args:
+            status: Function(task_id) checking a task; it must call Finished() once the task
+                has completed. Used to notice tasks nobody else is watching.
+        """
+        self.status = status
+        self.slots = slots
+        self.prefetch_cap = prefetch_cap
+        self.background_cap = background_cap
+        self.aging = aging
+        self.reclaim_interval = 5  # Seconds between checks of the running tasks while full.
+        self.last_reclaim = 0
+        self.cond = threading.Condition()  # Guards everything below.
+        self.waiting = []  # TransferTickets waiting for a slot.
+        self.running = set()  # TransferTickets holding a slot.
+        self.tasks = {}  # Maps task id to its running TransferTicket.
+
+    def _Cap(self, priority):
+        return {FOREGROUND: self.slots, PREFETCH: self.prefetch_cap,
+                BACKGROUND: self.background_cap}[priority]
+
+    def _Next(self):
+        """The waiting ticket that gets the next free slot, or None. Call with cond held."""
+        if len(self.running) >= self.slots:
+            return None
+        counts = {}
+        for ticket in self.running:
+            counts[ticket.priority] = counts.get(ticket.priority, 0) + 1
+        now = time.time()
+        candidates = [ticket for ticket in self.waiting
+                      if counts.get(ticket.priority, 0) < self._Cap(ticket.priority)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda ticket: (
+            ticket.priority - (now - ticket.arrival) / self.aging, ticket.arrival))
+
+    def Acquire(self, ticket, timeout=None):
+        """Block until ticket holds a slot, or timeout seconds have passed (None: no limit).
+
+        Returns:
+            True if ticket holds a slot, False if it timed out (and no longer waits).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            self.waiting.append(ticket)
+        try:
+            while True:
+                with self.cond:
+                    if self._Next() is ticket:
+                        self.waiting.remove(ticket)
+                        self.running.add(ticket)
+                        self.cond.notify_all()  # Another slot may still be free.
+                        return True
+                    wait = self.reclaim_interval
+                    if deadline is not None:
+                        if time.time() >= deadline:
+                            self.waiting.remove(ticket)
+                            self.cond.notify_all()  # It may have been next in line.
+                            return False
+                        wait = min(wait, deadline - time.time())
+                    self.cond.wait(wait)
+                    if time.time() - self.last_reclaim < self.reclaim_interval:
+                        continue
+                    self.last_reclaim = time.time()
+                    task_ids = self.tasks.keys()
+                for task_id in task_ids:
+                    try:
+                        self.status(task_id)  # Frees the slot if the task is done.
+                    except Exception, e:
+                        print 'Status of task {0} failed: {1}'.format(task_id, e)
+        except:
+            with self.cond:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+            raise
+
+    def Assign(self, ticket, task_id):
+        """Record the task submitted with a slot."""
+        with self.cond:
+            ticket.task_id = task_id
+            self.tasks[task_id] = ticket
+
+    def Promote(self, ticket, priority):
+        """Raise a ticket to priority (e.g. an open now waits for a prefetch)."""
+        with self.cond:
+            ticket.priority = min(ticket.priority, priority)
+            self.cond.notify_all()
+
+    def Finished(self, task_id):
+        """Give back the slot of a completed task."""
+        with self.cond:
+            ticket = self.tasks.pop(task_id, None)
+            if ticket:
+                self.running.discard(ticket)
+                self.cond.notify_all()
+
+    def Release(self, ticket):
+        """Give back a slot whose task couldn't be submitted."""
+        with self.cond:
+            self.running.discard(ticket)
+            self.cond.notify_all()
+
+
+class ThroughputEstimator(object):
+    """Predict how long a transfer from one endpoint takes, learning from completed tasks.
+
+    A task is modelled as a fixed latency (queueing, activation, connection setup) followed by
+    its bytes at the endpoint's throughput. Small tasks are dominated by the former and large
+    ones by the latter, so each completed task updates one of the two moving averages.
+    """
+
+    def __init__(self, latency=10.0, throughput=1024 * 1024, weight=0.3, small_size=1024 * 1024):
+        """
+        Args:
+            latency: Initial guess of the fixed cost of a task, in seconds.
+            throughput: Initial guess of the transfer rate, in bytes per second.
+            weight: Weight of each new observation in the moving averages.
+            small_size: Tasks below this many bytes only measure latency.
+        """
+        self.latency = float(latency)
+        self.throughput = float(throughput)
+        self.weight = weight
+        self.small_size = small_size
+        self.lock = threading.Lock()
+
+    def Observe(self, size, elapsed):
+        """Account for a task that moved size bytes in elapsed seconds."""
+        with self.lock:
+            if size < self.small_size:
+                self.latency += self.weight * (elapsed - self.latency)
             else:
-                task = api_client.Transfer(self.api.SubmissionID(), src_endpoint, dest_endpoint)
-                task.add_item(src_path, dest_path, recursive=True)
-                self.queue.append((descriptor, task))
-            self.last_change = time.time()
\ No newline at end of file
+                # Attribute whatever the latency doesn't explain to the transfer itself.
+                rate = size / max(elapsed - self.latency, 1.0)
+                self.throughput += self.weight * (rate - self.throughput)
+
+    def Estimate(self, size):
+        """Expected seconds for a task of size bytes."""
+        return self.latency + size / self.throughput
+
+
+class HTTPSDataPlane(object):
+    """Read byte ranges of remote files through the endpoint's HTTPS interface.
+
+    This is an alternative to CopyToLocal() for large files: rather than transferring the whole
+    file before the first byte can be read, only the ranges that are actually needed are fetched.
+    Any HTTP(S) server that honors the Range header can stand in for the endpoint.
+    """
+
+    def __init__(self, base_url, token=None, timeout=60):
+        """
+        Args:
+            base_url: URL under which the remote endpoint's files are served,
+                e.g. 'https://xxxx.data.globus.org'
+            token: Bearer token sent with every request (None for no authorization header).
+            timeout: Seconds a connection may stall (connecting, or between bytes of a reply)
+                before the request fails.
+        """
+        url = urlparse.urlparse(base_url)
+        self.scheme, self.netloc = url.scheme, url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.headers = {'Authorization': 'Bearer ' + token} if token else {}
+        self.timeout = timeout
+        self.local = threading.local()  # One persistent connection per thread.
+
+    def _Connection(self):
+        if getattr(self.local, 'conn', None) is None:
+            if self.scheme == 'https':
+                self.local.conn = httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                self.local.conn = httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+        return self.local.conn
+
+    def _Reset(self):
+        if getattr(self.local, 'conn', None) is not None:
+            self.local.conn.close()
+            self.local.conn = None
+
+    def ReadRange(self, path, offset, size):
+        """Return size bytes of the remote file starting at offset (fewer at end of file).
+
+        Raises:
+            IOError: the request failed or stalled, the server ignored the Range header (200), or
+                it replied with other bytes than those asked for. The body of such a reply isn't
+                read: it may be the whole file.
+        """
+        headers = dict(self.headers, Range='bytes={0}-{1}'.format(offset, offset + size - 1))
+        url = self.prefix + urllib.quote(path.encode('utf-8'))
+        for attempt in xrange(2):
+            try:
+                conn = self._Connection()
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+                if response.status == 206:
+                    length = _RangeLength(response.getheader('Content-Range'), offset, size)
+                    if length is None:
+                        break
+                    data = response.read()
+                    if len(data) != length:
+                        raise IOError('Range request for {0} returned {1} of {2} bytes'.format(
+                            path, len(data), length))
+                    return data
+                if response.status == 416:  # Range starts past the end of the file.
+                    response.read()
+                    return ''
+                break
+            except (httplib.HTTPException, socket.error):
+                # Stale keep-alive connection; reconnect once before giving up.
+                self._Reset()
+                if attempt == 1:
+                    raise IOError('Range request for {0} failed'.format(path))
+
+        self._Reset()  # The unread body is still on the connection.
+        raise IOError('Range request for {0} returned {1} {2} (Content-Range: {3})'.format(
+            path, response.status, response.reason, response.getheader('Content-Range')))
+
+
+def _RangeLength(content_range, offset, size):
+    """The length of a 206 reply to a request for size bytes at offset, or None if its
+    Content-Range ('bytes first-last/total') isn't a prefix of the requested range."""
+    try:
+        unit, _, spec = (content_range or '').partition(' ')
+        first, last = (int(n) for n in spec.partition('/')[0].split('-'))
+    except ValueError:
+        return None
+    if unit != 'bytes' or first != offset or not offset <= last < offset + size:
+        return None
+    return last - first + 1
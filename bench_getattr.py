@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Microbenchmark of getattr throughput, from FUSE's upcall to the filled stat buffer.
+
+Compares building the c_stat from the metadata dict on every call (as before) with copying the
+c_stat GlobusFS keeps per entry (see globusfs.StatStructs). Nothing is mounted and Globus isn't
+contacted:
+
+    python bench_getattr.py --entries 10000 --rounds 20
+"""
+
+import argparse
+import ctypes
+import errno
+import time
+
+from fuse import FUSE, FuseOSError, Operations, c_stat
+
+import cache
+import globusfs
+
+
+class _FakeAPI(object):
+    """Lists a flat directory of files at the root."""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def EndpointList(self, path):
+        if path != '/':
+            return []
+        return [{'name': 'file{0:06d}'.format(i), 'type': 'file', 'permissions': '0644',
+                 'size': i * 1024, 'last_modified': '2016-03-22 20:58:37+00:00'}
+                for i in xrange(self.entries)]
+
+
+class _Getattr(Operations):
+    def __init__(self, metadata, prebuilt):
+        self.metadata = metadata
+        self.structs = globusfs.StatStructs(metadata) if prebuilt else None
+
+    def getattr(self, path, fh=None):
+        st = self.structs.Stat(path) if self.structs else self.metadata.Stat(path)
+        if st is None:
+            raise FuseOSError(errno.ENOENT)
+        return st
+
+
+def _Run(metadata, paths, rounds, prebuilt):
+    """getattr calls per second through FUSE.fgetattr."""
+    fuse = object.__new__(FUSE)  # Just the upcall handlers; nothing is mounted.
+    fuse.raw_fi = True
+    fuse.encoding = 'utf-8'
+    fuse._bind_operations(_Getattr(metadata, prebuilt))
+    buf = ctypes.pointer(c_stat())
+    for path in paths:
+        fuse.fgetattr(path, buf, None)  # Warm up: listings loaded, structs built.
+    start = time.time()
+    for _ in xrange(rounds):
+        for path in paths:
+            fuse.fgetattr(path, buf, None)
+    return rounds * len(paths) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure getattr throughput.')
+    parser.add_argument('--entries', type=int, default=10000, help='Files in the directory')
+    parser.add_argument('--rounds', type=int, default=20, help='Times each file is stat\'ed')
+    args = parser.parse_args()
+
+    metadata = cache.MetaData(_FakeAPI(args.entries))
+    paths = ['/' + name for name in metadata.Listdir('/')[2:]]
+    before = _Run(metadata, paths, args.rounds, prebuilt=False)
+    after = _Run(metadata, paths, args.rounds, prebuilt=True)
+    print 'dict -> c_stat per call: {0:10.0f} getattr/s'.format(before)
+    print 'pre-built c_stat:        {0:10.0f} getattr/s ({1:.1f}x)'.format(after, after / before)
+
+
+if __name__ == '__main__':
+    main()
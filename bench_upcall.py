@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Microbenchmark of the fixed cost of a FUSE upcall in fuse.py.
+
+Times the Python side of an upcall, from the function libfuse calls to the operation and back,
+for operations that do no work of their own. The old dispatch (functools.partial, _wrapper,
+path.decode, Operations.__call__ and getattr on every call) is reproduced here for comparison.
+Nothing is mounted:
+
+    python bench_upcall.py --calls 200000
+"""
+
+import argparse
+import ctypes
+import errno
+import functools
+import time
+import traceback
+
+from fuse import FUSE, Operations, c_stat, make_c_stat
+
+
+class _Noop(Operations):
+    """Operations that return at once, so only the dispatch is measured."""
+
+    def __init__(self):
+        self.st = make_c_stat({'st_mode': 0100644, 'st_nlink': 1, 'st_size': 4096})
+
+    def access(self, path, amode):
+        return 0
+
+    def getattr(self, path, fh=None):
+        return self.st
+
+
+def _OldWrapper(func, *args, **kwargs):
+    """fuse.FUSE._wrapper before the dispatch table."""
+    try:
+        return func(*args, **kwargs) or 0
+    except OSError, e:
+        return -(e.errno or errno.EFAULT)
+    except:
+        traceback.print_exc()
+        return -errno.EFAULT
+
+
+def _OldHandlers(fuse):
+    """access and getattr upcalls as dispatched before the dispatch table."""
+    operations = fuse.operations
+
+    def access(path, amode):
+        return operations('access', path.decode(fuse.encoding), amode)
+
+    def fgetattr(path, buf, fip):
+        if not fip:
+            fh = fip
+        attrs = operations('getattr', path.decode(fuse.encoding), fh)
+        if isinstance(attrs, c_stat):
+            ctypes.memmove(buf, ctypes.byref(attrs), ctypes.sizeof(c_stat))
+            return 0
+
+    def getattr(path, buf):
+        return fgetattr(path, buf, None)
+
+    return (functools.partial(_OldWrapper, access), functools.partial(_OldWrapper, getattr))
+
+
+def _Time(func, args, calls):
+    """Nanoseconds per call."""
+    start = time.time()
+    for _ in xrange(calls):
+        func(*args)
+    return (time.time() - start) * 1e9 / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the overhead of a FUSE upcall.')
+    parser.add_argument('--calls', type=int, default=200000, help='Upcalls per measurement')
+    args = parser.parse_args()
+
+    fuse = object.__new__(FUSE)  # Just the upcall handlers; nothing is mounted.
+    fuse.raw_fi = True
+    fuse.encoding = 'utf-8'
+    fuse._bind_operations(_Noop())
+    old_access, old_getattr = _OldHandlers(fuse)
+    new_access, new_getattr = FUSE._handler(fuse.access), FUSE._handler(fuse.getattr)
+
+    path = '/some/directory/file.dat'
+    buf = ctypes.pointer(c_stat())
+    cases = [
+        ('access', (path, 0), fuse.operations.access, (path.decode('utf-8'), 0),
+         old_access, new_access),
+        ('getattr', (path, buf), fuse.operations.getattr, (path.decode('utf-8'),),
+         old_getattr, new_getattr),
+    ]
+    print '{0:<10}{1:>12}{2:>12}{3:>12}{4:>16}'.format(
+        'upcall', 'operation', 'old', 'new', 'overhead saved')
+    for name, upcall_args, operation, operation_args, old, new in cases:
+        base = _Time(operation, operation_args, args.calls)
+        old_ns = _Time(old, upcall_args, args.calls)
+        new_ns = _Time(new, upcall_args, args.calls)
+        print '{0:<10}{1:>10.0f}ns{2:>10.0f}ns{3:>10.0f}ns{4:>15.0f}%'.format(
+            name, base, old_ns, new_ns, 100 * (old_ns - new_ns) / max(old_ns - base, 1))
+
+
+if __name__ == '__main__':
+    main()
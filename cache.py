@@ -1,62 +1,305 @@
 """Handles metadata cache (memory) and file cache (local endpoint)."""
+import bisect
+import calendar
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
 import os
 import shutil
 import stat
+import threading
 import time
 
+import api
+
+CACHE_DIR = '.globusfs-cache'  # Under the local path: cached files, their index, the journal.
+
+
+def _ParseTimestamp(last_modified):
+    """Convert a Globus 'last_modified' string (e.g. '2016-03-22 20:58:37+00:00') to epoch secs."""
+    try:
+        return calendar.timegm(time.strptime(last_modified[:19], '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+# Positioned I/O leaves the file offset alone, so handles sharing a descriptor never race on it.
+# os.pread/os.pwrite only exist from Python 3.3 on; use libc directly otherwise.
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong]
+_libc.pread.restype = ctypes.c_ssize_t
+_libc.pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong]
+_libc.pwrite.restype = ctypes.c_ssize_t
+
+
+def _CheckErrno(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def preadinto(fd, buf, size, offset):
+    """Read up to size bytes at offset straight into a ctypes buffer. Returns bytes read."""
+    return _CheckErrno(_libc.pread(fd, buf, size, offset))
+
+
+def pwritefrom(fd, buf, size, offset):
+    """Write size bytes from a ctypes buffer at offset. Returns bytes written."""
+    return _CheckErrno(_libc.pwrite(fd, buf, size, offset))
+
+
+if hasattr(os, 'pread'):
+    pread, pwrite = os.pread, os.pwrite
+else:
+    def pread(fd, size, offset):
+        """Read up to size bytes at offset without moving the file offset."""
+        buf = ctypes.create_string_buffer(size)
+        count = preadinto(fd, buf, size, offset)
+        return buf.raw[:count]
+
+    def pwrite(fd, data, offset):
+        """Write data at offset without moving the file offset. Returns bytes written."""
+        return _CheckErrno(_libc.pwrite(fd, data, len(data), offset))
+
+
+_FICLONE = 0x40049409  # Linux ioctl: make a file share another's data, copy-on-write.
+
+
+def _Clone(src, dest):
+    """Create dest as a reflink of src. Raises EnvironmentError where that isn't supported."""
+    with open(src, 'rb') as f:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        try:
+            fcntl.ioctl(fd, _FICLONE, f.fileno())
+        except:
+            os.close(fd)
+            os.remove(dest)
+            raise
+        os.close(fd)
+
+
+def _MD5(local_path):
+    """Hex MD5 digest of a file, as Globus computes it for sync_level 3."""
+    digest = hashlib.md5()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _Stamp(local_path):
+    """(inode, size, mtime) of a file, which change whenever it is rewritten; None if missing."""
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+def _Unshare(local_path):
+    """Give a cached copy that is hard-linked elsewhere (see FileCache.Export()) its own inode,
+    so writing it leaves the other names alone."""
+    try:
+        if os.stat(local_path).st_nlink < 2:
+            return
+    except OSError:
+        return
+    tmp_path = local_path + '.unshare'
+    shutil.copy2(local_path, tmp_path)
+    os.rename(tmp_path, local_path)
+
+
+class _KeyedLocks(object):
+    """One lock per key (e.g. per path), created on demand and dropped when no longer used."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}  # Maps key to [lock, number of threads holding or waiting for it].
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
 
 class MetaData(object):
-    """Keep filesystem metadata in memory."""
+    """Keep filesystem metadata in memory.
+
+    self.lock guards the dicts and is only held for in-memory updates. Remote listings are
+    serialized per directory, so a slow listing never blocks lookups in other directories.
+
+    Listings are kept within max_entries: once there are more entries, the least recently used
+    listings are dropped as a whole (and listed again on next use). The root and listings holding
+    an open file or one of its ancestors are never dropped. Neither are listings changed by
+    deletes and renames, until the task queue has pushed them, nor those with files created or
+    written here: those changes are never pushed, so they stay in memory beyond max_entries.
+    """
 
     def __init__(self, api):
         self.api = api
+        self.lock = threading.RLock()
+        self.dir_locks = _KeyedLocks()
 
-        # Map file path to stat() file info dicts.
+        # Map file path to stat() file info dicts. A changed entry gets a new dict, so anything
+        # derived from one stays valid for as long as the path maps to that same dict.
         self.files = {}
 
         # Map dirpath to list of files. This is technically redundant information,
         # (we could read it from self.files), but this makes listdir() faster.
         self.dirs = {}
-        self.NewFile('/', stat.S_IFDIR | 0755)
-        self._LoadRemoteDir('/')
+
+        # Eviction: listings in the order they were loaded or last given a second chance, and
+        # those used since (see _Evict()). Each entry takes about half a kilobyte.
+        self.max_entries = 2 * 1000 * 1000
+        self.loaded = collections.OrderedDict()
+        self.used = set()
+        self.local = set()  # Listings with files created or resized here, which are never pushed.
+        self.unsynced = set()  # Listings changed by deletes or renames that may not be pushed yet.
+        self.queue = None  # api.AsyncTaskQueue pushing those; GlobusFS points this at its own.
+        self.open_files = {}  # Paths of open files; GlobusFS points this at FileCache.refs.
+        self.evictions = 0
+
+        # Map dirpath to a number that changes whenever its listing does (see Generation()).
+        self.generations = {}
+        self.generation_counter = itertools.count(1)
+
+        self.NewFile('/', stat.S_IFDIR | 0755)  # The root is listed on first use, like the rest.
 
     def _LoadRemoteDir(self, path):
         """Load information from a remote directory if it isn't in memory already."""
         if path in self.dirs:
+            self.used.add(path)
             return
 
-        data = self.api.EndpointList(path)
-
-        # Add list of files to the directory.
-        self.dirs[path] = [x['name'] for x in data]
-
-        # Add file metadata.
-        for file_info in data:
-            f_type = stat.S_IFDIR if file_info['type'] == 'dir' else stat.S_IFREG
-            permissions = int(file_info['permissions'], 8)  # permissions are octal
-            now = time.time()
-            self.files[os.path.join(path, file_info['name'])] = {
-                'st_atime': now,
-                'st_mtime': now,  # TODO: grab last_modified time from response
-                'st_ctime': now,
-                'st_nlink': 2,
-                'st_mode': (f_type | permissions),
-                'st_size': file_info['size']
-            }
+        with self.dir_locks(path):
+            if path in self.dirs:
+                return  # Another thread loaded it while we waited.
+            data = self.api.EndpointList(path)
+
+            # Build file metadata.
+            entries = {}
+            for file_info in data:
+                f_type = stat.S_IFDIR if file_info['type'] == 'dir' else stat.S_IFREG
+                permissions = int(file_info['permissions'], 8)  # permissions are octal
+                mtime = _ParseTimestamp(file_info.get('last_modified')) or time.time()
+                entries[os.path.join(path, file_info['name'])] = {
+                    'st_atime': mtime,
+                    'st_mtime': mtime,
+                    'st_ctime': mtime,
+                    'st_nlink': 2,
+                    'st_mode': (f_type | permissions),
+                    'st_size': file_info['size']
+                }
+
+            with self.lock:
+                self.files.update(entries)
+                # Add list of files to the directory.
+                self.dirs[path] = [x['name'] for x in data]
+                self.generations[path] = next(self.generation_counter)
+                self.loaded[path] = True
+                self.used.add(path)
+                self._Evict(path)
+
+    def _Evict(self, keep='/'):
+        """Drop cold listings until the entries fit in max_entries. Call with self.lock held.
+
+        keep is a listing to leave alone, e.g. the one just loaded for a caller about to use it.
+
+        Listings are visited oldest first; one used since its last visit gets a second chance
+        (CLOCK), which approximates LRU without reordering anything on lookups. Evicting goes
+        on to 90% of the budget, so it isn't needed again on the very next listing.
+        """
+        if not self.max_entries or len(self.files) <= self.max_entries:
+            return
+        pinned = set(['/', keep])
+        for path in list(self.open_files):
+            while path != '/':
+                path = os.path.dirname(path)
+                pinned.add(path)
+        if self.queue is None or self.queue.Idle():
+            self.unsynced.clear()  # The endpoint has caught up; listing them again is the same.
+        target = self.max_entries * 9 / 10
+        for _ in xrange(2 * len(self.loaded)):
+            if len(self.files) <= target or not self.loaded:
+                break
+            dirpath, _ = self.loaded.popitem(last=False)
+            if (dirpath in self.used or dirpath in pinned or dirpath in self.local or
+                    dirpath in self.unsynced):
+                self.used.discard(dirpath)
+                self.loaded[dirpath] = True
+                continue
+            self.generations.pop(dirpath, None)
+            for name in self.dirs.pop(dirpath):
+                filepath = os.path.join(dirpath, name)
+                self.files.pop(filepath, None)
+            self.evictions += 1
 
     ##############
     #    Read    #
     ##############
 
+    def _Listing(self, path):
+        """The listing of a directory, loaded if need be (again, if it is evicted meanwhile)."""
+        while True:
+            self._LoadRemoteDir(path)
+            listing = self.dirs.get(path)
+            if listing is not None:
+                return listing
+
     def Listdir(self, path):
         """List directory contents."""
-        self._LoadRemoteDir(path)
-        return ['.', '..'] + self.dirs[path]
+        listing = self._Listing(path)
+        with self.lock:
+            return ['.', '..'] + listing
+
+    def Count(self, path):
+        """Number of entries in a directory (not counting . and ..), without copying its listing."""
+        return len(self._Listing(path))
+
+    def Generation(self, path):
+        """A number that changes whenever the listing of a directory does, e.g. to tell whether
+        something derived from the listing is still current. Loads the listing if need be."""
+        while True:
+            self._Listing(path)
+            with self.lock:
+                generation = self.generations.get(path)
+            if generation is not None:
+                return generation
 
     def Stat(self, path):
         """Return stat() info for a file or None if the file doesn't exist."""
-        self._LoadRemoteDir(os.path.dirname(path))
-        return self.files.get(path, None)
+        if path == '/':
+            return self.files.get(path, None)
+        dirpath = os.path.dirname(path)
+        while True:
+            self._LoadRemoteDir(dirpath)
+            attrs = self.files.get(path, None)
+            if attrs is not None or dirpath in self.dirs:
+                return attrs
+
+    def Unchanged(self, path, attrs):
+        """True if attrs, returned by Stat(path) earlier, is still the entry of path. Counts as a
+        use of its listing, like Stat()."""
+        if self.files.get(path) is not attrs:
+            return False
+        self.used.add(path.rpartition('/')[0] or '/')
+        return True
 
     ##############
     #   Modify   #
@@ -65,71 +308,1192 @@ class MetaData(object):
     def _AddFileToParentDir(self, path):
         if path != '/':
             self.dirs[os.path.dirname(path)].append(os.path.basename(path))
+            self.generations[os.path.dirname(path)] = next(self.generation_counter)
 
     def _RemoveFileFromParentDir(self, path):
         self.dirs[os.path.dirname(path)].remove(os.path.basename(path))
+        self.generations[os.path.dirname(path)] = next(self.generation_counter)
 
     def ChangeFileSize(self, path, size):
-        self.files[path]['st_size'] = size
+        with self.lock:
+            self.files[path] = dict(self.files[path], st_size=size)
+            self.local.add(os.path.dirname(path))
 
     def NewDirectory(self, path):
-        """Create a new entry for the directory."""
-        self.NewFile(path, stat.S_IFDIR | 0755)  # TODO: use given mode rather than hard-code?
-        self.dirs[path] = []
+        """Create a new entry for a directory already made on the endpoint."""
+        with self.lock:
+            self._NewEntry(path, stat.S_IFDIR | 0755)  # TODO: use given mode rather than hard-code?
+            self.dirs[path] = []
+            self.generations[path] = next(self.generation_counter)
+            self.loaded[path] = True
 
     def NewFile(self, path, mode):
-        """Create a new entry for the given path."""
+        """Create a new entry for the given path, which only exists here."""
+        with self.lock:
+            self._NewEntry(path, mode)
+            if path != '/':
+                self.local.add(os.path.dirname(path))
+
+    def _NewEntry(self, path, mode):
+        """Add an entry for path to its parent's listing. Call with self.lock held."""
         now = time.time()
         self.files[path] = {'st_atime': now, 'st_mtime': now, 'st_ctime': now,
                             'st_nlink': 2, 'st_mode': mode, 'st_size': 0}
         self._AddFileToParentDir(path)
 
     def Remove(self, path):
-        """Remove file entry."""
-        self.files[path] = None
-        self._RemoveFileFromParentDir(path)
+        """Remove file entry. Call after queueing the delete (see _Evict())."""
+        with self.lock:
+            self.files[path] = None
+            self._RemoveFileFromParentDir(path)
+            self.unsynced.add(os.path.dirname(path))
 
     def Rename(self, old_path, new_path):
-        """Move a file entry to a new path."""
-        self.files[new_path] = self.files[old_path]
-        self._AddFileToParentDir(new_path)
-        self.Remove(old_path)
+        """Move a file entry to a new path. Call after queueing the rename."""
+        with self.lock:
+            self.files[new_path] = self.files[old_path]
+            self._AddFileToParentDir(new_path)
+            self.unsynced.add(os.path.dirname(new_path))
+            if os.path.dirname(old_path) in self.local:
+                self.local.add(os.path.dirname(new_path))  # It may be one of the local files.
+            self.Remove(old_path)
+
+    def Forget(self, path):
+        """Drop the listings of a directory and everything under it.
+
+        They are loaded from the endpoint again on next access, picking up remote changes.
+        Entries created locally under path are lost; the entry of path itself is kept, so the root
+        stays reachable.
+        """
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for dirpath in [d for d in self.dirs if d == path or d.startswith(prefix)]:
+                del self.dirs[dirpath]
+                self.generations.pop(dirpath, None)
+                self.loaded.pop(dirpath, None)
+                self.used.discard(dirpath)
+                self.local.discard(dirpath)
+                self.unsynced.discard(dirpath)
+            for filepath in [f for f in self.files if f.startswith(prefix) and f != path]:
+                del self.files[filepath]
 
 
 class FileCache(object):
-    """Handles reading/writing to the file cache."""
+    """Handles reading/writing to the file cache.
+
+    Cached copies mirror the remote directory tree under cache_dir/data, so every remote path has
+    its own local copy. A sidecar index (cache_dir/index.json) records the remote size and mtime
+    of each copy; a later mount adopts the copies whose metadata still matches the remote file.
+    """
 
-    def __init__(self, api, path):
-        """Initialize cache under the local endpoint path."""
+    def __init__(self, api, metadata, path, data_plane=None, ranged_min_size=64 * 1024 * 1024,
+                 shared=None):
+        """Initialize cache under the local endpoint path, adopting copies from earlier mounts.
+
+        Args:
+            api: GlobusAPI() wrapper.
+            metadata: MetaData() cache, used to validate cached copies.
+            path: Directory visible to the local endpoint.
+            data_plane: Optional api.HTTPSDataPlane(). Files opened read-only and at least
+                ranged_min_size bytes large are then read block by block instead of transferred.
+            ranged_min_size: See data_plane.
+            shared: Optional sharedcache.SharedCacheClient(). Files opened read-only that
+                aren't cached here are then read from the host's shared cache instead.
+        """
         self.api = api
-        self.cache_dir = os.path.join(path, '.globusfs-cache')
-        if os.path.exists(self.cache_dir):
-            shutil.rmtree(self.cache_dir)
-        os.mkdir(self.cache_dir)
+        self.metadata = metadata
+        self.data_plane = data_plane
+        self.ranged_min_size = ranged_min_size
+        self.shared = shared
+        self.cache_dir = os.path.join(path, CACHE_DIR)
+        self.data_dir = os.path.join(self.cache_dir, 'data')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
         os.chmod(self.cache_dir, 0777)
-        self.cache = {}  # Maps remote filepath to local file object.
+        os.chmod(self.data_dir, 0777)
+
+        # Maps remote filepath to {'size', 'mtime', 'dirty', 'md5'} of the local copy (md5 is
+        # only there once something needed it, see _CopyMD5(); never for dirty copies).
+        # Dirty copies have local changes and are never adopted by a later mount.
+        self.index = {}
+        self.index_changed = False  # The index has changes its file doesn't (see _IndexChanged()).
+        self.index_saved = 0  # Time the file was last written.
+        self.index_interval = 5  # Most seconds changes wait before the file is rewritten.
+        self._AdoptExisting()
+        self.handles = {}  # Maps FUSE file handle number to _Handle.
+        self.refs = {}  # Maps remote filepath to number of open handles.
+        self.sizes = {}  # Maps remote filepath to its size while open for writing.
+        self.fh_counter = itertools.count(1)
+        self.sparse = {}  # Maps remote filepath to SparseFile for ranged reads.
+
+        # Sibling prefetching: once prefetch_trigger files of a directory have been opened in
+        # (sorted) order, the next prefetch_count siblings are fetched in one background transfer,
+        # as long as they fit in prefetch_budget bytes.
+        self.prefetch_trigger = 2
+        self.prefetch_count = 8
+        self.prefetch_budget = 256 * 1024 * 1024
+        self.lock = threading.Lock()  # Guards handles, sparse files and pending transfers.
+        self.index_lock = threading.Lock()  # Guards the index and its file.
+        self.path_locks = _KeyedLocks()  # Serializes fetch decisions for one file.
+        self.dir_locks = _KeyedLocks()  # Serializes prefetch tracking for one directory.
+        self.pending = {}  # Maps remote filepath to the _Batch that is fetching it.
+        self.batches = {}  # Maps dirpath to its active prefetch _Batch.
+        self.sequence = {}  # Maps dirpath to (index of last opened sibling, run length).
+        self.siblings = {}  # Maps dirpath to (listing generation, sorted regular file names).
+        self.opened = {}  # Maps remote filepath to its index entry when it was last opened.
+
+        # Serve reads of a file while it is still being transferred (see Open()).
+        self.progressive = True
+
+        self.hydrations = {}  # Maps dirpath to the _Hydration fetching its subtree.
+        self.hydration_poll = 2  # Seconds between progress checks of a hydration.
+
+        # Local directories the local endpoint can write to, so Export() can transfer into them.
+        self.endpoint_roots = [os.path.abspath(path)]
+
+        # An outdated copy is refreshed in place by a transfer with this sync_level, which skips
+        # it if its checksum (3) still matches; a copy left untouched keeps its pages in the
+        # kernel. None to always replace copies whole.
+        self.sync_level = 3
+
+    def _AdoptExisting(self):
+        """Load the index left by an earlier mount and drop copies that can't be trusted."""
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)['files']
+        except (IOError, ValueError, KeyError):
+            index = {}
+
+        for path, entry in index.iteritems():
+            local_path = self.LocalPath(path)
+            if (not entry.get('dirty') and os.path.isfile(local_path) and
+                    os.path.getsize(local_path) == entry['size']):
+                self.index[path] = entry
+
+        self._SaveIndex()
+        print 'Adopted {0} cached files'.format(len(self.index))
+
+        # Everything else (partial transfers, local changes, files missing from the index) is
+        # removed in the background, so a large leftover cache doesn't hold up the mount.
+        thread = threading.Thread(target=self._RemoveLeftovers, args=(time.time(),))
+        thread.daemon = True
+        thread.start()
+
+    def _RemoveLeftovers(self, mount_time):
+        """Async function: delete the files of earlier mounts that weren't adopted.
+
+        Only files whose inode hasn't changed since the mount started are considered: anything
+        written, fetched or renamed by this mount has a later ctime.
+        """
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(unicode(self.data_dir)):
+            for name in filenames:
+                local_path = os.path.join(dirpath, name)
+                try:
+                    if (self.RemotePath(local_path) not in self.index and
+                            os.lstat(local_path).st_ctime < mount_time):
+                        os.remove(local_path)
+                        removed += 1
+                except OSError:
+                    pass  # Removed or replaced meanwhile.
+        if removed:
+            print 'Removed {0} stale cache files'.format(removed)
+
+    def _SaveIndex(self):
+        """Atomically write the index next to the cached data."""
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'files': self.index}, f)
+        os.rename(tmp_path, self.index_path)
+        self.index_changed = False
+        self.index_saved = time.time()
+
+    def _IndexChanged(self, now=False):
+        """Note a change to the index. Call with index_lock held.
+
+        The whole file is rewritten, so changes are saved in bulk: at most every index_interval
+        seconds, and when a batch or hydration finishes (see _FlushIndex()). A later mount
+        misses unsaved changes, which only costs it cached copies; changes it mustn't miss (a
+        clean copy turning dirty) are saved now.
+        """
+        self.index_changed = True
+        if now or time.time() - self.index_saved >= self.index_interval:
+            self._SaveIndex()
+
+    def _FlushIndex(self):
+        """Save the changes to the index that haven't been saved yet."""
+        with self.index_lock:
+            if self.index_changed:
+                self._SaveIndex()
+
+    def _IsFresh(self, path, remote=None):
+        """True if the local copy of path can be served without a transfer.
+
+        Callers holding self.lock pass the remote stat() info of path, looked up beforehand:
+        looking it up may have to list the directory on the endpoint.
+        """
+        entry = self.index.get(path)
+        if entry is None:
+            return False
+        if entry.get('dirty'):
+            return True  # Local changes are authoritative (writes are never pushed).
+        if remote is None:
+            remote = self.metadata.Stat(path)
+        return (remote is not None and entry['size'] == remote['st_size'] and
+                entry['mtime'] == remote['st_mtime'])
+
+    def _Record(self, path, dirty=False):
+        """Record the local copy of path in the index."""
+        remote = self.metadata.Stat(path)
+        with self.index_lock:
+            entry = self.index.get(path)
+            self.index[path] = {
+                'size': remote['st_size'], 'mtime': remote['st_mtime'], 'dirty': dirty}
+            self._IndexChanged(now=dirty and entry is not None and not entry['dirty'])
 
-    def Destroy(self):
-        """Destroy the cache."""
-        shutil.rmtree(self.cache_dir)
-        print 'Deleted local cache', self.cache_dir
+    def _RecordFetched(self, path, stamp=None):
+        """Record a copy that a transfer has just brought up to date.
 
-    def Get(self, path):
-        """Get file descriptor for the given path."""
-        return self.cache[path]
+        stamp is the _Stamp() of the outdated copy the transfer refreshed in place, if any. If
+        the copy still has it, the transfer skipped the file (its data hadn't changed) and the
+        old index entry is kept, so Open() still lets the kernel keep the pages it has.
+        """
+        remote = self.metadata.Stat(path)
+        if not remote:
+            return
+        untouched = stamp is not None and _Stamp(self.LocalPath(path)) == stamp
+        with self.index_lock:
+            entry = self.index.get(path)
+            if entry and not entry['dirty'] and untouched:
+                entry.update(size=remote['st_size'], mtime=remote['st_mtime'])
+            else:
+                self.index[path] = {'size': remote['st_size'], 'mtime': remote['st_mtime'],
+                                    'dirty': False}
+            self._IndexChanged()
+
+    def _CopyMD5(self, path):
+        """MD5 of the cached copy of path, kept in its index entry once computed."""
+        entry = self.index.get(path)
+        if entry and entry.get('md5'):
+            return entry['md5']
+        md5 = _MD5(self.LocalPath(path))
+        with self.index_lock:
+            if entry and self.index.get(path) is entry and not entry['dirty']:
+                entry['md5'] = md5
+                self._IndexChanged()
+        return md5
+
+    def _KeepForRefresh(self, batch, path):
+        """Leave the outdated copy of path in place for batch to refresh (see _Refreshable())."""
+        batch.refresh = True
+        batch.stamps[path] = _Stamp(self.LocalPath(path))
+
+    def _Refreshable(self, path):
+        """True if the outdated copy of path can stay in place while a transfer refreshes it."""
+        entry = self.index.get(path)
+        if (self.sync_level is None or entry is None or entry['dirty'] or self.IsOpen(path) or
+                path in self.sparse):
+            return False
+        try:
+            # A copy hard-linked elsewhere (see Export()) must not be written in place.
+            return os.stat(self.LocalPath(path)).st_nlink == 1
+        except OSError:
+            return False
+
+    def _MakeParentDirs(self, local_path):
+        """Create the parents of a cache file; the local endpoint must be able to write them."""
+        parent = os.path.dirname(local_path)
+        try:
+            os.makedirs(parent)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        while parent != self.data_dir:
+            os.chmod(parent, 0777)
+            parent = os.path.dirname(parent)
+
+    def LocalPath(self, path):
+        """Path of the cached copy of a remote file."""
+        return os.path.join(self.data_dir, path.lstrip('/'))
+
+    def RemotePath(self, local_path):
+        """Inverse of LocalPath()."""
+        return '/' + os.path.relpath(local_path, self.data_dir)
+
+    def Close(self):
+        """Persist the index so the next mount can reuse the cached files."""
+        for handle in self.handles.values():
+            self.Release(handle.fh)
+        for sparse in self.sparse.itervalues():
+            sparse.Close()
+        for batch in self.batches.itervalues():
+            self._CancelBatch(batch)
+        for hydration in self.hydrations.itervalues():
+            batch = hydration.batch
+            if batch and batch.task_id and not batch.done.is_set():
+                self.api.CancelTask(batch.task_id)
+        with self.index_lock:
+            self._SaveIndex()
+        print 'Saved cache index', self.index_path
+
+    def _NewHandle(self, path, fd, writable=False, keep_cache=False):
+        """Register an open file and return its FUSE file handle number."""
+        handle = _Handle(next(self.fh_counter), path, fd, writable, keep_cache)
+        with self.lock:
+            self.handles[handle.fh] = handle
+            self.refs[path] = self.refs.get(path, 0) + 1
+            if writable and path not in self.sizes:
+                self.sizes[path] = os.fstat(fd).st_size
+        return handle.fh
+
+    def IsOpen(self, path):
+        """True if any handle to path is open."""
+        return self.refs.get(path, 0) > 0
+
+    def KeepCache(self, fh):
+        """True if the kernel may keep the pages it cached for the file during an earlier open."""
+        return self.handles[fh].keep_cache
+
+    def OpenSize(self, path):
+        """Size of path as written through open handles, or None if it isn't open for writing."""
+        return self.sizes.get(path)
 
     def Create(self, path):
-        """Create and open a new file."""
-        cache_file = os.path.join(self.cache_dir, os.path.basename(path))
-        self.cache[path] = open(cache_file, mode='w+')
+        """Create and open a new file. Returns a file handle number."""
+        cache_file = self.LocalPath(path)
+        self._MakeParentDirs(cache_file)
+        _Unshare(cache_file)
+        fd = os.open(cache_file, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        self._Record(path, dirty=True)
+        return self._NewHandle(path, fd, writable=True)
 
     def Open(self, path, flags):
-        """Open the given file, downloading it if necessary."""
-        cache_file = os.path.join(self.cache_dir, os.path.basename(path))
-        if path not in self.cache:
-            if not self.api.CopyToLocal(path, cache_file):
+        """Open the given file, starting a download if necessary.
+
+        Read-only opens return as soon as the transfer has been accepted; Read() then waits for
+        the data it needs. Writable opens wait for the whole file, for as long as the remote
+        endpoint's throughput suggests it should take.
+
+        Returns:
+            A file handle number, or None if the file couldn't be fetched.
+
+        Raises:
+            IOError: ETIMEDOUT if the transfer is taking too long. It carries on in the
+                background; opening the file again waits for the same transfer. Also if no
+                transfer slot freed up in time (see api.SubmitCopyToLocal()).
+        """
+        cache_file = self.LocalPath(path)
+        writable = flags & (os.O_WRONLY | os.O_RDWR)
+        with self.path_locks(path):
+            if self._OpenSparse(path, writable):
+                return self._NewHandle(path, None)  # Reads go through self.sparse.
+            if (self.shared and not writable and path not in self.pending and
+                    not self._IsFresh(path)):
+                # Fetched by the daemon, once for every mount of the host; nothing is copied here.
+                return self._NewHandle(path, os.open(self.shared.Fetch(path), os.O_RDONLY))
+
+            self._TrackAccess(path)
+            batch = None
+            if not self._IsFresh(path):
+                batch = self._StartFetch(path)
+                if batch and self.progressive and not writable:
+                    return self._NewHandle(path, None)  # Opened by Read() once data arrives.
+
+        # Wait outside the lock: other threads may still open this file progressively.
+        if batch:
+            if not batch.done.wait(self.api.TransferTimeout(batch.size)):
+                raise IOError(errno.ETIMEDOUT, 'Timed out waiting for {0}'.format(path))
+            if not self._IsFresh(path):
                 return None
 
-        # Open the file and return a file handle.
-        self.cache[path] = os.fdopen(os.open(cache_file, flags))
-        return self.cache[path]
\ No newline at end of file
+        if writable:
+            _Unshare(cache_file)
+            if not self.index[path]['dirty']:
+                self._Record(path, dirty=True)
+
+        # Every new local copy gets a new index entry, so if this is the entry the file had when
+        # it was last opened, the kernel's cached pages still match it. Local changes don't
+        # qualify: they may not have gone through the page cache (direct_io).
+        entry = self.index.get(path)
+        keep_cache = entry is not None and not entry['dirty'] and self.opened.get(path) is entry
+        self.opened[path] = entry
+
+        # Offsets always come from FUSE, so O_APPEND would only confuse pwrite().
+        return self._NewHandle(
+            path, os.open(cache_file, flags & ~os.O_APPEND), writable, keep_cache)
+
+    def Flush(self, fh):
+        """Return the current size of a file open for writing (None for read-only handles)."""
+        handle = self.handles[fh]
+        return self.sizes.get(handle.path) if handle.writable else None
+
+    def Release(self, fh):
+        """Close a file handle. Returns the final size if it was the last writable handle."""
+        size = None
+        with self.lock:
+            handle = self.handles.pop(fh)
+            self.refs[handle.path] -= 1
+            if not self.refs[handle.path]:
+                del self.refs[handle.path]
+            if handle.writable and not any(
+                    h.writable and h.path == handle.path for h in self.handles.itervalues()):
+                size = self.sizes.pop(handle.path, None)
+        if handle.fd is not None:
+            os.close(handle.fd)
+        return size
+
+    def _StartFetch(self, path, priority=api.FOREGROUND):
+        """Submit a transfer of path into the cache, or attach to one that's already bringing it
+        in (e.g. a prefetch), raising that one to priority. Returns the tracking _Batch, or None
+        if path is now cached.
+        """
+        while True:
+            remote = self.metadata.Stat(path)
+            with self.lock:
+                batch = self.pending.get(path)
+                if batch is None:
+                    if self._IsFresh(path, remote):
+                        return None  # A transfer finished since the caller looked.
+                    batch = self.pending[path] = _Batch([path], remote['st_size'], priority)
+                    break
+                if not batch.cancelled:
+                    batch.attached = True  # Someone is waiting on it now; don't cancel it.
+                    self.api.scheduler.Promote(batch.ticket, priority)
+                    return batch
+            batch.done.wait()  # A cancelled prefetch may still be writing the file.
+
+        if self._Refreshable(path):
+            self._KeepForRefresh(batch, path)
+        print '{0} {1} in local cache...'.format(
+            'Refreshing' if batch.refresh else 'Copying', path)
+        try:
+            if not batch.refresh:
+                self.Remove(path)
+            self._MakeParentDirs(self.LocalPath(path))
+            self._Submit(batch, [(path, self.LocalPath(path))])
+        except:
+            batch.cancelled = True
+            self._FinishBatch(batch)
+            raise
+        thread = threading.Thread(target=self._FinishBatch, args=(batch,))
+        thread.daemon = True
+        thread.start()
+        return batch
+
+    def _Submit(self, batch, items, recursive=False, profile=None):
+        """Submit the transfer task of a batch (see api.SubmitCopyToLocal() for the arguments)."""
+        profile = profile or self.api.ProfileFor(items, batch.size, recursive)
+        batch.in_order = self.api.profiles[profile].InOrder()
+        batch.task_id = self.api.SubmitCopyToLocal(
+            items, batch.size, recursive=recursive, ticket=batch.ticket, profile=profile,
+            sync_level=self.sync_level if batch.refresh else None)
+
+    def _WaitForRange(self, path, batch, end):
+        """Block until the partial copy of path is at least end bytes long or its transfer ends.
+
+        Only a transfer that writes files front to back (batch.in_order) can be read before the
+        file has landed. With several streams per file, the copy may reach its full length while
+        earlier parts are still holes; and a copy being refreshed in place (batch.refresh) is at
+        its full length from the start.
+        """
+        end = min(end, self.metadata.Stat(path)['st_size'])
+        local_path = self.LocalPath(path)
+        progressive = batch.in_order and not batch.refresh
+        have = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+        remaining = max(end - have, 0)
+        if len(batch.paths) > 1 or not progressive:
+            remaining = batch.size  # Other files (or parts) may have to arrive first.
+        deadline = time.time() + self.api.TransferTimeout(remaining)
+        while not batch.done.wait(0.1):
+            if not progressive:
+                # Only the file's landing counts (hydrations record files as they land).
+                if self.pending.get(path) is not batch:
+                    break
+            elif os.path.exists(local_path) and os.path.getsize(local_path) >= end:
+                return
+            if time.time() > deadline:
+                raise IOError('Timed out waiting for {0}'.format(path))
+        if not self._IsFresh(path):
+            raise IOError('Transfer of {0} failed'.format(path))
+
+    def _OpenSparse(self, path, writable):
+        """Serve path through the ranged data plane if possible. Returns True on success."""
+        sparse = self.sparse.get(path)
+        remote = self.metadata.Stat(path)
+        if sparse and not writable and sparse.size == remote['st_size']:
+            return True
+        if (self.data_plane is None or writable or self._IsFresh(path) or
+                remote['st_size'] < self.ranged_min_size):
+            return False
+
+        self.Remove(path)
+        cache_file = self.LocalPath(path)
+        self._MakeParentDirs(cache_file)
+        sparse = SparseFile(self.data_plane, path, cache_file, remote['st_size'])
+        with self.lock:
+            self.sparse[path] = sparse
+        return True
+
+    ##################
+    #   Prefetching  #
+    ##################
+
+    def _Siblings(self, dirpath):
+        """Sorted names of the regular files in a directory."""
+        generation = self.metadata.Generation(dirpath)
+        cached = self.siblings.get(dirpath)
+        if cached is None or cached[0] != generation:
+            names = []
+            for name in self.metadata.Listdir(dirpath)[2:]:
+                attrs = self.metadata.Stat(os.path.join(dirpath, name))
+                if attrs and stat.S_ISREG(attrs['st_mode']):
+                    names.append(name)
+            # Should the listing change meanwhile, the next call sorts it again.
+            cached = self.siblings[dirpath] = (generation, sorted(names))
+        return cached[1]
+
+    def _TrackAccess(self, path):
+        """Detect files of a directory being opened one after another and prefetch the next ones."""
+        with self.dir_locks(os.path.dirname(path)):
+            self._TrackAccessLocked(path)
+
+    def _TrackAccessLocked(self, path):
+        dirpath, name = os.path.split(path)
+        siblings = self._Siblings(dirpath)
+        i = bisect.bisect_left(siblings, name)
+        if i == len(siblings) or siblings[i] != name:
+            return
+
+        last = self.sequence.get(dirpath)
+        run = last[1] + 1 if last and i == last[0] + 1 else 1
+        self.sequence[dirpath] = (i, run)
+
+        batch = self.batches.get(dirpath)
+        if batch and not batch.done.is_set():
+            if run == 1 and path not in batch.paths:
+                self._CancelBatch(batch)  # The access pattern changed.
+            return
+        if run < self.prefetch_trigger:
+            return
+
+        # Collect the next siblings that aren't cached yet, within the byte budget.
+        items, budget = [], self.prefetch_budget
+        count = min(self.prefetch_count,
+                    self.api.profiles[api.SMALL].max_files or self.prefetch_count)
+        for sibling in siblings[i + 1:]:
+            if len(items) == count:
+                break
+            sibling_path = os.path.join(dirpath, sibling)
+            size = self.metadata.Stat(sibling_path)['st_size']
+            if size > budget or (self.data_plane and size >= self.ranged_min_size):
+                break
+            if sibling_path in self.pending or self._IsFresh(sibling_path):
+                continue
+            budget -= size
+            items.append(sibling_path)
+
+        remote = dict((item, self.metadata.Stat(item)) for item in items)
+        with self.lock:
+            items = [item for item in items
+                     if remote[item] and item not in self.pending and
+                     not self._IsFresh(item, remote[item])]
+            if not items:
+                return
+            size = sum(remote[item]['st_size'] for item in items)
+            batch = self.batches[dirpath] = _Batch(items, size, api.PREFETCH)
+            for item in items:
+                self.pending[item] = batch
+        thread = threading.Thread(target=self._RunBatch, args=(batch,))
+        thread.daemon = True
+        thread.start()
+
+    def _RunBatch(self, batch):
+        """Async function: submit a prefetch batch, then wait for it to land."""
+        try:
+            for path in batch.paths:
+                if self._Refreshable(path):
+                    self._KeepForRefresh(batch, path)
+                else:
+                    self.Remove(path)
+                self._MakeParentDirs(self.LocalPath(path))
+            print 'Prefetching {0} files from {1}...'.format(
+                len(batch.paths), os.path.dirname(batch.paths[0]))
+            self._Submit(batch, [(path, self.LocalPath(path)) for path in batch.paths])
+            if batch.cancelled:
+                self.api.CancelTask(batch.task_id)
+        except Exception, e:
+            print 'Prefetch failed: {0}'.format(e)
+            batch.cancelled = True
+        self._FinishBatch(batch)
+
+    def _FinishBatch(self, batch):
+        """Async function: wait for a batch's task and record its files once they have landed.
+
+        Files are recorded before anyone waiting is let in.
+        """
+        try:
+            # Wait for as long as the task lives, even past the deadline of whoever opened the
+            # file: it stays in self.pending so retries attach to it rather than starting over.
+            # Even a cancelled task must be waited for: it may still be writing into the cache.
+            succeeded = batch.task_id and self.api.WaitForTask(batch.task_id)
+            if succeeded and not batch.cancelled:
+                for path in batch.paths:
+                    self._RecordFetched(path, batch.stamps.get(path))
+        except Exception, e:
+            print 'Transfer of {0} failed: {1}'.format(batch.paths[0], e)
+        finally:
+            with self.lock:
+                for path in batch.paths:
+                    if self.pending.get(path) is batch:
+                        del self.pending[path]
+            batch.done.set()
+        self._FlushIndex()
+
+    def _CancelBatch(self, batch):
+        with self.lock:
+            if batch.attached or batch.cancelled:
+                return
+            batch.cancelled = True
+        if batch.task_id:
+            self.api.CancelTask(batch.task_id)
+
+    def Prefetch(self, path):
+        """Start fetching a file in the background. Returns False if it is already cached."""
+        with self.path_locks(path):
+            if self._IsFresh(path):
+                return False
+            return self._StartFetch(path, api.PREFETCH) is not None
+
+    def Evict(self, path):
+        """Drop the cached copies of a file or directory tree.
+
+        Copies that are open, being fetched or modified locally are kept.
+
+        Returns:
+            The number of files dropped.
+        """
+        prefix = path.rstrip('/') + '/'
+        with self.index_lock:
+            candidates = [p for p, entry in self.index.iteritems()
+                          if (p == path or p.startswith(prefix)) and not entry['dirty']]
+        candidates.extend(p for p in self.sparse.keys() if p == path or p.startswith(prefix))
+        evicted = 0
+        for p in candidates:
+            with self.path_locks(p):
+                if self.IsOpen(p) or p in self.pending:
+                    continue
+                self.Remove(p)
+                evicted += 1
+        return evicted
+
+    ##################
+    #     Export     #
+    ##################
+
+    def Export(self, path, dest):
+        """Put a copy of a file or directory tree at dest, a local path, without reading it
+        through the mount.
+
+        Files the cache has an up-to-date copy of are reflinked, hard-linked or, across
+        filesystems, copied from it. The rest are transferred straight to dest in one task if the
+        local endpoint can write there (see endpoint_roots); otherwise they are fetched into the
+        cache first (a directory is hydrated) and placed from there.
+
+        Exporting again to the same dest (with sync_level set) only replaces the files that
+        changed: the transfer skips files by sync_level, and cached copies are compared by
+        checksum.
+
+        Returns:
+            Counts of how the files were placed, e.g. {'transferred': 10, 'linked': 2,
+            'unchanged': 30}.
+
+        Raises:
+            IOError: path doesn't exist, dest can't be synced, or a transfer failed or timed out.
+        """
+        st = self.metadata.Stat(path)
+        if st is None:
+            raise IOError(errno.ENOENT, 'No such file or directory: {0}'.format(path))
+        dest = os.path.abspath(dest)
+        is_dir = stat.S_ISDIR(st['st_mode'])
+        exists = os.path.lexists(dest)
+        if exists and (self.sync_level is None or os.path.isdir(dest) != is_dir):
+            raise IOError(errno.EEXIST, 'Already exists: {0}'.format(dest))
+        if is_dir:
+            files = [(p, size, os.path.join(dest, os.path.relpath(p, path)))
+                     for p, size in self._ListTree(path)]
+        else:
+            files = [(path, st['st_size'], dest)]
+
+        counts = collections.Counter()
+        missing = [f for f in files if not self._IsFresh(f[0])]
+        if missing and self._Visible(dest):
+            skipped = self._TransferTo(missing, self.sync_level if exists else None)
+            counts['transferred'] = len(missing) - skipped
+            counts['unchanged'] = skipped
+            transferred = set(missing)
+            files = [f for f in files if f not in transferred]
+        elif missing:
+            self._FetchForExport(path, is_dir, sum(size for _, size, _ in missing))
+
+        for p, _, target in files:
+            if not self._IsFresh(p):
+                raise IOError(errno.EIO, 'Transfer of {0} failed'.format(p))
+            if os.path.lexists(target):
+                if self._Unchanged(p, target):
+                    counts['unchanged'] += 1
+                    continue
+                os.remove(target)
+            counts[self._Place(self.LocalPath(p), target, p in self.sizes)] += 1
+        return dict((how, count) for how, count in counts.iteritems() if count)
+
+    def _Unchanged(self, path, target):
+        """True if target has the contents of the cached copy of path."""
+        local_path = self.LocalPath(path)
+        if not os.path.isfile(target) or os.path.getsize(target) != os.path.getsize(local_path):
+            return False
+        if os.path.samefile(target, local_path):
+            return True  # Hard-linked by an earlier export.
+        return _MD5(target) == self._CopyMD5(path)
+
+    def _Visible(self, local_path):
+        """True if local_path is under one of endpoint_roots."""
+        return any(local_path == root or local_path.startswith(root.rstrip('/') + '/')
+                   for root in self.endpoint_roots)
+
+    def _TransferTo(self, files, sync_level=None):
+        """Transfer (path, size, local destination) triples with a single task and wait for it.
+
+        Returns the number of files the task skipped (see api.SubmitCopyToLocal()).
+        """
+        for _, _, target in files:
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+        size = sum(size for _, size, _ in files)
+        print 'Exporting {0} files, {1} bytes...'.format(len(files), size)
+        task_id = self.api.SubmitCopyToLocal(
+            [(p, target) for p, _, target in files], size, sync_level=sync_level)
+        if not self.api.WaitForTask(task_id, self.api.TransferTimeout(size)):
+            raise IOError(errno.EIO, 'Export transfer {0} did not succeed'.format(task_id))
+        return self.api.TaskStatus(task_id).get('files_skipped') or 0
+
+    def _FetchForExport(self, path, is_dir, size):
+        """Bring a file or directory tree into the cache and wait for it."""
+        if is_dir:
+            hydration = self.Hydrate(path)
+            while not hydration.Finished():
+                time.sleep(self.hydration_poll)
+            return
+        with self.path_locks(path):
+            batch = None if self._IsFresh(path) else self._StartFetch(path)
+        if batch and not batch.done.wait(self.api.TransferTimeout(size)):
+            raise IOError(errno.ETIMEDOUT, 'Timed out waiting for {0}'.format(path))
+
+    def _Place(self, local_path, target, private):
+        """Give target the contents of a cached copy. Returns 'cloned', 'linked' or 'copied'.
+
+        A private copy (e.g. of a file open for writing) is never hard-linked.
+        """
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        try:
+            _Clone(local_path, target)
+            return 'cloned'
+        except EnvironmentError:
+            pass
+        if not private:
+            try:
+                os.link(local_path, target)
+                return 'linked'
+            except OSError:
+                pass
+        shutil.copyfile(local_path, target)
+        return 'copied'
+
+    ##################
+    #    Hydration   #
+    ##################
+
+    def Hydrate(self, path):
+        """Start bringing every file under a directory into the cache with one transfer task.
+
+        Files already cached or being fetched are left alone. If there are none, the directory is
+        transferred recursively; otherwise the task lists the missing files. Each file is
+        recorded as soon as Globus reports it delivered, so it can be opened before the rest of
+        the subtree arrives.
+
+        Returns:
+            The _Hydration tracking progress. Hydrating a directory again while its hydration
+            is running returns the running one.
+        """
+        with self.lock:
+            hydration = self.hydrations.get(path)
+            if hydration and not hydration.Finished():
+                return hydration
+            hydration = self.hydrations[path] = _Hydration(path)
+        thread = threading.Thread(target=self._RunHydration, args=(hydration,))
+        thread.daemon = True
+        thread.start()
+        return hydration
+
+    def _ListTree(self, path):
+        """Return (path, size) of every regular file under a directory, loading its listings."""
+        files, dirs = [], [path]
+        while dirs:
+            dirpath = dirs.pop()
+            for name in self.metadata.Listdir(dirpath)[2:]:
+                child = os.path.join(dirpath, name)
+                child_stat = self.metadata.Stat(child)
+                if stat.S_ISDIR(child_stat['st_mode']):
+                    dirs.append(child)
+                elif stat.S_ISREG(child_stat['st_mode']):
+                    files.append((child, child_stat['st_size']))
+        return files
+
+    def _RunHydration(self, hydration):
+        """Async function: list a subtree, submit its transfer and record files as they land."""
+        batch = None
+        try:
+            files = self._ListTree(hydration.path)
+            remote = dict((path, self.metadata.Stat(path)) for path, _ in files)
+            with self.lock:
+                missing = [(path, size) for path, size in files
+                           if remote[path] and path not in self.pending and
+                           path not in self.sparse and not self._IsFresh(path, remote[path])]
+                batch = _Batch([path for path, _ in missing], sum(size for _, size in missing),
+                               api.BACKGROUND)
+                batch.attached = True  # Never cancelled as a prefetch.
+                for path in batch.paths:
+                    self.pending[path] = batch
+            hydration.batch = batch
+            hydration.files_total = len(files)
+            hydration.bytes_total = sum(size for _, size in files)
+            hydration.files_done = len(files) - len(missing)
+            hydration.bytes_cached = hydration.bytes_done = hydration.bytes_total - batch.size
+            if not batch.paths:
+                hydration.status = 'SUCCEEDED'
+                return
+
+            for path in batch.paths:
+                if self._Refreshable(path):
+                    self._KeepForRefresh(batch, path)  # Outdated copies are refreshed in place.
+                else:
+                    self.Remove(path)  # Partial copies.
+                self._MakeParentDirs(self.LocalPath(path))
+            recursive = len(missing) == len(files)
+            if recursive:
+                # Both sides of a recursive item must be directory paths.
+                items = [(hydration.path.rstrip('/') + '/',
+                          self.LocalPath(hydration.path).rstrip('/') + '/')]
+            else:
+                items = [(path, self.LocalPath(path)) for path in batch.paths]
+            print 'Hydrating {0}: {1} files, {2} bytes...'.format(
+                hydration.path, len(batch.paths), batch.size)
+            self._Submit(batch, items, recursive, api.SUBTREE)
+            hydration.status = 'ACTIVE'
+
+            marker = None
+            while True:
+                task = self.api.TaskStatus(batch.task_id)
+                landed, next_marker = self.api.SuccessfulTransfers(batch.task_id, marker)
+                self._Landed(hydration, landed)
+                transferred = task.get('bytes_transferred') or 0
+                hydration.bytes_done = hydration.bytes_cached + transferred
+                if next_marker:
+                    marker = next_marker  # More pages already waiting.
+                    continue
+                if task['completion_time']:
+                    break
+                time.sleep(self.hydration_poll)
+
+            if task['status'] == 'SUCCEEDED':
+                self._Landed(hydration, batch.paths)  # In case any weren't listed.
+                hydration.bytes_done = hydration.bytes_total
+            hydration.status = task['status']
+        except Exception, e:
+            print 'Hydration of {0} failed: {1}'.format(hydration.path, e)
+            hydration.status = 'FAILED'
+        finally:
+            if batch:
+                with self.lock:
+                    for path in batch.paths:
+                        if self.pending.get(path) is batch:
+                            del self.pending[path]
+                batch.done.set()
+            self._FlushIndex()
+            print 'Hydration of {0}: {1}'.format(hydration.path, hydration.Progress())
+
+    def _Landed(self, hydration, paths):
+        """Record the files of a hydration that have been delivered."""
+        batch = hydration.batch
+        for path in paths:
+            if self.pending.get(path) is not batch or not self.metadata.Stat(path):
+                continue  # Already recorded, or not part of this hydration.
+            self._RecordFetched(path, batch.stamps.get(path))
+            with self.lock:
+                if self.pending.get(path) is batch:
+                    del self.pending[path]
+            hydration.files_done += 1
+        if paths:
+            print 'Hydrating {0}: {1}'.format(hydration.path, hydration.Progress())
+
+    def _Readable(self, fh, size, offset):
+        """Wait until size bytes at offset of an open file can be read. Returns its _Handle."""
+        handle = self.handles[fh]
+        path = handle.path
+        batch = self.pending.get(path)
+        if batch:
+            self._WaitForRange(path, batch, offset + size)
+        elif handle.fd is None and not self._IsFresh(path):
+            raise IOError('Transfer of {0} failed'.format(path))
+
+        if handle.fd is None:
+            fd = os.open(self.LocalPath(path), os.O_RDONLY)
+            with self.lock:
+                if handle.fd is None:
+                    handle.fd, fd = fd, None
+            if fd is not None:
+                os.close(fd)  # Another thread got there first.
+        return handle
+
+    def Read(self, fh, size, offset):
+        """Read size bytes at offset from an open file."""
+        sparse = self.sparse.get(self.handles[fh].path)
+        if sparse:
+            return sparse.Read(offset, size)
+        return pread(self._Readable(fh, size, offset).fd, size, offset)
+
+    def ReadInto(self, fh, buf, size, offset):
+        """Like Read(), but fill the ctypes buffer buf. Returns the number of bytes read."""
+        sparse = self.sparse.get(self.handles[fh].path)
+        if sparse:
+            return sparse.ReadInto(buf, offset, size)
+        return preadinto(self._Readable(fh, size, offset).fd, buf, size, offset)
+
+    def Write(self, fh, data, offset):
+        """Write data at offset to an open file. Returns the number of bytes written."""
+        handle = self.handles[fh]
+        count = pwrite(handle.fd, data, offset)
+        self._Grow(handle.path, offset + count)
+        return count
+
+    def WriteFrom(self, fh, buf, size, offset):
+        """Like Write(), but take the data from a ctypes buffer."""
+        handle = self.handles[fh]
+        count = pwritefrom(handle.fd, buf, size, offset)
+        self._Grow(handle.path, offset + count)
+        return count
+
+    def _Grow(self, path, end):
+        if end > self.sizes[path]:
+            with self.lock:
+                self.sizes[path] = max(self.sizes[path], end)
+
+    def Remove(self, path):
+        """Drop the cached copy of a file or directory tree."""
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            sparse = [self.sparse.pop(p) for p in self.sparse.keys()
+                      if p == path or p.startswith(prefix)]
+        for sparse_file in sparse:
+            sparse_file.Close()
+        with self.index_lock:
+            removed = [p for p in self.index if p == path or p.startswith(prefix)]
+            for p in removed:
+                del self.index[p]
+            if removed:
+                self._IndexChanged()
+        local_path = self.LocalPath(path)
+        if os.path.isdir(local_path):
+            shutil.rmtree(local_path)
+        elif os.path.exists(local_path):
+            os.remove(local_path)
+
+    def Rename(self, old_path, new_path):
+        """Move the cached copy of a file or directory tree."""
+        old_local, new_local = self.LocalPath(old_path), self.LocalPath(new_path)
+        if not os.path.exists(old_local):
+            return
+        self.Remove(new_path)
+        self._MakeParentDirs(new_local)
+        os.rename(old_local, new_local)
+
+        prefix = old_path.rstrip('/') + '/'
+        with self.index_lock:
+            for p in [p for p in self.index if p == old_path or p.startswith(prefix)]:
+                self.index[new_path + p[len(old_path):]] = self.index.pop(p)
+            self._IndexChanged()
+        with self.lock:
+            for handle in self.handles.itervalues():
+                if handle.path == old_path or handle.path.startswith(prefix):
+                    handle.path = new_path + handle.path[len(old_path):]
+            for p in [p for p in self.refs if p == old_path or p.startswith(prefix)]:
+                self.refs[new_path + p[len(old_path):]] = self.refs.pop(p)
+            for p in [p for p in self.sizes if p == old_path or p.startswith(prefix)]:
+                self.sizes[new_path + p[len(old_path):]] = self.sizes.pop(p)
+            for p in [p for p in self.sparse if p == old_path or p.startswith(prefix)]:
+                self.sparse[new_path + p[len(old_path):]] = self.sparse.pop(p)
+                self.sparse[new_path + p[len(old_path):]].remote_path = new_path + p[len(old_path):]
+
+
+class _Handle(object):
+    """An open file: one per FUSE file handle."""
+
+    def __init__(self, fh, path, fd, writable, keep_cache=False):
+        self.fh = fh
+        self.path = path
+        self.fd = fd  # Raw descriptor of the cached copy; None until it can be opened.
+        self.writable = writable
+        self.keep_cache = keep_cache  # The cached copy hasn't changed since the last open.
+
+
+class _Batch(object):
+    """A group of files fetched with a single transfer task."""
+
+    def __init__(self, paths, size, priority=api.FOREGROUND):
+        self.paths = paths
+        self.size = size  # Total bytes of the files.
+        self.ticket = api.TransferTicket(priority)  # Its request for a task slot.
+        self.refresh = False  # Some files are outdated copies, left in place to be refreshed.
+        self.stamps = {}  # Maps the path of each of those to its _Stamp() before the transfer.
+        self.in_order = False  # Set if its task writes files front to back (see _Submit()).
+        self.task_id = None
+        self.cancelled = False
+        self.attached = False  # Set once an open waits on the batch.
+        self.done = threading.Event()  # Set once the task has finished, failed or been cancelled.
+
+
+class _Hydration(object):
+    """Progress of fetching a whole directory tree (see FileCache.Hydrate())."""
+
+    def __init__(self, path):
+        self.path = path
+        self.batch = None  # The _Batch of missing files, once the tree has been listed.
+        self.status = 'LISTING'  # Then ACTIVE, and finally SUCCEEDED or FAILED.
+        self.files_total = self.files_done = 0
+        self.bytes_total = self.bytes_done = 0
+        self.bytes_cached = 0  # Bytes that were already cached when the hydration started.
+
+    def Finished(self):
+        return self.status in ('SUCCEEDED', 'FAILED')
+
+    def Progress(self):
+        """One-line summary, e.g. 'ACTIVE 12/40 files 1048576/5242880 bytes'."""
+        return '{0} {1}/{2} files {3}/{4} bytes'.format(
+            self.status, self.files_done, self.files_total, self.bytes_done, self.bytes_total)
+
+
+def _Runs(blocks):
+    """Split a sorted list of block numbers into (first, last) runs of consecutive blocks."""
+    runs = []
+    for block in blocks:
+        if runs and runs[-1][1] == block - 1:
+            runs[-1][1] = block
+        else:
+            runs.append([block, block])
+    return runs
+
+
+class SparseFile(object):
+    """Local copy of a remote file that is filled in block by block as it is read.
+
+    Only the blocks covering a read are fetched, plus a few blocks of read-ahead when the file is
+    read sequentially. Reading the header of a huge file thus costs one small range request.
+    Sparse copies are not recorded in the index, so the next mount discards them.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, data_plane, remote_path, local_path, size, readahead=4):
+        self.data_plane = data_plane
+        self.remote_path = remote_path
+        self.size = size
+        self.readahead = readahead  # Number of blocks to fetch ahead of a sequential reader.
+        self.present = set()  # Blocks already written to the local file.
+        self.fetching = set()  # Blocks some thread is currently fetching.
+        self.cond = threading.Condition()
+        self.last_block = -1  # Last block touched by Read().
+        self.reading_ahead = False  # A read-ahead is in flight; there is one at most.
+        self.fd = os.open(local_path, os.O_RDWR | os.O_CREAT, 0644)
+        os.ftruncate(self.fd, size)
+
+    def Close(self):
+        os.close(self.fd)
+
+    def _Readable(self, offset, size):
+        """Fetch the blocks covering size bytes at offset. Returns the size clipped to EOF."""
+        size = max(0, min(size, self.size - offset))
+        if size == 0:
+            return 0
+        first, last = offset // self.BLOCK_SIZE, (offset + size - 1) // self.BLOCK_SIZE
+        self._Fetch(first, last)
+
+        # Sequential reader: fetch the next few blocks in the background.
+        last_file_block = (self.size - 1) // self.BLOCK_SIZE
+        if self.readahead and first in (self.last_block, self.last_block + 1) and \
+                last < last_file_block:
+            self._StartReadAhead(last + 1, min(last + self.readahead, last_file_block))
+        self.last_block = last
+        return size
+
+    def Read(self, offset, size):
+        """Return size bytes at offset, fetching missing blocks first."""
+        size = self._Readable(offset, size)
+        return pread(self.fd, size, offset) if size else ''
+
+    def ReadInto(self, buf, offset, size):
+        """Like Read(), but fill the ctypes buffer buf. Returns the number of bytes read."""
+        size = self._Readable(offset, size)
+        return preadinto(self.fd, buf, size, offset) if size else 0
+
+    def _StartReadAhead(self, first, last):
+        """Fetch blocks first..last in the background, unless a read-ahead is still in flight or
+        they are all present already. The reader catches up with the next one."""
+        with self.cond:
+            if self.reading_ahead or all(b in self.present or b in self.fetching
+                                         for b in xrange(first, last + 1)):
+                return
+            self.reading_ahead = True
+        thread = threading.Thread(target=self._ReadAhead, args=(first, last))
+        thread.daemon = True
+        thread.start()
+
+    def _ReadAhead(self, first, last):
+        try:
+            self._Fetch(first, last)
+        except IOError, e:
+            print 'Read-ahead of {0} failed: {1}'.format(self.remote_path, e)
+        finally:
+            with self.cond:
+                self.reading_ahead = False
+
+    def _Fetch(self, first, last):
+        """Make blocks first..last present; contiguous missing blocks share one range request."""
+        with self.cond:
+            claimed = [b for b in xrange(first, last + 1)
+                       if b not in self.present and b not in self.fetching]
+            self.fetching.update(claimed)
+
+        try:
+            for run_first, run_last in _Runs(claimed):
+                offset = run_first * self.BLOCK_SIZE
+                size = min((run_last + 1) * self.BLOCK_SIZE, self.size) - offset
+                data = self.data_plane.ReadRange(self.remote_path, offset, size)
+                if len(data) != size:
+                    raise IOError('Short range read of {0}'.format(self.remote_path))
+                pwrite(self.fd, data, offset)
+                with self.cond:
+                    self.present.update(xrange(run_first, run_last + 1))
+        finally:
+            with self.cond:
+                self.fetching.difference_update(claimed)
+                self.cond.notify_all()
+
+        # Wait for blocks that other threads (e.g. read-ahead) are fetching.
+        with self.cond:
+            for block in xrange(first, last + 1):
+                while block not in self.present:
+                    if block not in self.fetching:
+                        raise IOError('Fetching block {0} of {1} failed'.format(
+                            block, self.remote_path))
+                    self.cond.wait()
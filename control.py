@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Runtime control of a mounted GlobusFS.
+
+A mount serves a virtual file, /.globusfs/control. Each line written to it is a command. Reading it
+back through the same file handle returns the replies; reading it without writing returns the
+status of the mount. Run this module to send one command from the shell:
+
+    python control.py mnt flush
+    python control.py mnt set prefetch_count 16
+    python control.py mnt fetch datasets/run42 ./run42
+"""
+
+import argparse
+import os
+import shlex
+import stat
+import sys
+import threading
+
+CONTROL_DIR = '/.globusfs'
+CONTROL_PATH = CONTROL_DIR + '/control'
+
+HELP = """\
+Commands:
+  status                  Show queued work, cache usage and all settings.
+  flush                   Push queued deletes and renames to Globus now.
+  forget PATH             Drop the metadata of a directory tree; it is listed again on next use.
+  refresh PATH            Like forget, then list the directory again right away.
+  prefetch PATH           Start fetching a file, or a whole directory tree, into the cache.
+  evict PATH              Drop cached copies of a file or tree (open or modified files are kept).
+  fetch PATH DEST         Copy a file or tree to the local path DEST without reading it through
+                          the mount: transferred straight there, or linked from the cache.
+                          Fetching to DEST again only replaces the files that changed.
+  get [NAME]              Show one setting, or all of them.
+  set NAME VALUE          Change a setting on the live mount.
+  help                    Show this message.
+"""
+
+# Adjustable settings: name -> (object holding it, attribute, description).
+# The object is one of 'fs', 'api', 'limiter', 'scheduler', 'queue', 'metadata', 'cache' or a
+# transfer profile: 'small', 'large' or 'subtree' (see Controller._Target()).
+SETTINGS = {
+    'timeout_factor': ('api', 'timeout_factor', 'waits last this many estimated transfer times'),
+    'min_timeout': ('api', 'min_timeout', 'shortest transfer wait, in seconds'),
+    'expiry_factor': ('api', 'expiry_factor', 'Globus abandons a task after this many timeouts'),
+    'max_attempts': ('api', 'max_attempts', 'tries of a Globus API call before giving up'),
+    'large_file_size': ('api', 'large_file_size',
+                        'files of this many bytes are transferred with the large profile'),
+    'max_api_rate': ('limiter', 'max_rate', 'most Globus API calls per second'),
+    'max_api_calls': ('limiter', 'max_window', 'most Globus API calls in flight'),
+    'transfer_slots': ('scheduler', 'slots', 'most transfer tasks running at once'),
+    'prefetch_slots': ('scheduler', 'prefetch_cap', 'most prefetch tasks running at once'),
+    'background_slots': ('scheduler', 'background_cap',
+                         'most background tasks (deletes, renames, hydrations) at once'),
+    'aging': ('scheduler', 'aging', 'seconds of waiting that raise a transfer one priority class'),
+    'batch_window': ('queue', 'batch_window', 'seconds without new deletes/renames before a push'),
+    'poll_interval': ('queue', 'poll_interval', 'seconds between checks of the task queue'),
+    'order_timeout': ('queue', 'order_timeout', 'seconds to wait for a task before the next one'),
+    'shutdown_grace': ('queue', 'shutdown_grace',
+                       'seconds an unmount waits for a push in progress (with a journal)'),
+    'max_metadata_entries': ('metadata', 'max_entries',
+                             'most directory entries kept in memory (0: no limit)'),
+    'prefetch_trigger': ('cache', 'prefetch_trigger', 'sequential opens that start a prefetch'),
+    'prefetch_count': ('cache', 'prefetch_count', 'files per prefetch'),
+    'prefetch_budget': ('cache', 'prefetch_budget', 'most bytes per prefetch'),
+    'ranged_min_size': ('cache', 'ranged_min_size', 'files of this many bytes are read in ranges'),
+    'progressive': ('cache', 'progressive', 'serve reads while a file is being transferred'),
+    'hydration_poll': ('cache', 'hydration_poll', 'seconds between hydration progress checks'),
+    'sync_level': ('cache', 'sync_level',
+                   'outdated copies are refreshed in place, skipped if unchanged by this measure '
+                   '(1: size, 2: mtime, 3: checksum; none: always copy whole)'),
+    'direct_io_size': ('fs', 'direct_io_size', 'files of this many bytes bypass the page cache'),
+}
+for _profile in ('small', 'large', 'subtree'):
+    for _attr, _description in (
+            ('parallelism', 'streams per file'), ('concurrency', 'files in flight'),
+            ('encrypt', 'encrypt the data'), ('verify_checksum', 'verify checksums'),
+            ('sync_level', 'skip files that exist (0), match in size (1), are newer (2) or '
+                           'match in checksum (3)'),
+            ('max_files', 'most files in one task')):
+        SETTINGS[_profile + '_' + _attr] = (
+            _profile, _attr, '{0} (transfers of the {1} profile)'.format(_description, _profile))
+
+
+class ControlError(Exception):
+    """A command that can't be carried out; the message is returned to the caller."""
+
+
+class Controller(object):
+    """Serve the control file of a GlobusFS mount."""
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.lock = threading.Lock()
+        self.handles = {}  # Maps file handle number to [unfinished input line, replies].
+        self.fh_counter = 0
+
+    ####################
+    #   File Handles   #
+    ####################
+
+    def Open(self):
+        """Open the control file. Returns a file handle number."""
+        with self.lock:
+            self.fh_counter += 1
+            self.handles[self.fh_counter] = ['', None]
+            return self.fh_counter
+
+    def Read(self, fh, size, offset):
+        """Read the replies to the commands written through fh (or the status if there are none)."""
+        handle = self.handles[fh]
+        if handle[1] is None:
+            handle[1] = self._Status([])
+        return handle[1][offset:offset + size]
+
+    def Write(self, fh, data):
+        """Run every complete line written through fh. Returns the number of bytes consumed."""
+        handle = self.handles[fh]
+        lines = (handle[0] + data).split('\n')
+        handle[0] = lines.pop()
+        for line in lines:
+            self._Reply(handle, line)
+        return len(data)
+
+    def Release(self, fh):
+        """Close fh, running a last command that wasn't terminated by a newline."""
+        handle = self.handles.pop(fh)
+        if handle[0].strip():
+            self._Reply(handle, handle[0])
+
+    def _Reply(self, handle, line):
+        reply = self.Execute(line)
+        handle[1] = (handle[1] or '') + reply
+
+    ####################
+    #     Commands     #
+    ####################
+
+    def Execute(self, line):
+        """Run one command line and return its reply, which ends with a newline."""
+        try:
+            args = shlex.split(line)
+        except ValueError, e:
+            return 'error: {0}\n'.format(e)
+        if not args:
+            return ''
+        command = self.COMMANDS.get(args[0])
+        if command is None:
+            return 'error: unknown command {0!r}; try help\n'.format(args[0])
+        try:
+            return command(self, args[1:])
+        except ControlError, e:
+            return 'error: {0}\n'.format(e)
+        except Exception, e:
+            return 'error: {0} failed: {1}\n'.format(args[0], e)
+
+    def _Path(self, args):
+        """The single path argument of a command, which must exist."""
+        if len(args) != 1:
+            raise ControlError('expected one path')
+        path = u'/' + args[0].decode('utf-8').strip('/')
+        st = self.fs.metadata.Stat(path)
+        if st is None:
+            raise ControlError('{0}: no such file or directory'.format(path))
+        return path, st
+
+    def _Dir(self, args):
+        path, st = self._Path(args)
+        if not stat.S_ISDIR(st['st_mode']):
+            raise ControlError('{0}: not a directory'.format(path))
+        return path
+
+    def _Target(self, name):
+        """The object and attribute behind a setting name."""
+        if name not in SETTINGS:
+            raise ControlError('unknown setting {0!r}'.format(name))
+        target, attr, _ = SETTINGS[name]
+        objects = {'fs': self.fs, 'api': self.fs.api, 'limiter': self.fs.api.limiter,
+                   'scheduler': self.fs.api.scheduler, 'queue': self.fs.api.task_queue,
+                   'metadata': self.fs.metadata, 'cache': self.fs.file_cache}
+        objects.update(self.fs.api.profiles)
+        return objects[target], attr
+
+    def _Status(self, args):
+        file_cache, metadata = self.fs.file_cache, self.fs.metadata
+        lines = [
+            'queued tasks: {0}'.format(len(self.fs.api.task_queue.queue)),
+            'metadata: {0} entries in {1} listings, {2} listings evicted'.format(
+                len(metadata.files), len(metadata.dirs), metadata.evictions),
+            'open files: {0}'.format(len(file_cache.handles)),
+            'cached files: {0}'.format(len(file_cache.index)),
+            'transfers in flight: {0}'.format(len(set(file_cache.pending.values()))),
+            'task slots in use: {0}, waiting: {1}'.format(
+                len(self.fs.api.scheduler.running), len(self.fs.api.scheduler.waiting)),
+            'API calls: {0:.1f}/s, {1} at once'.format(
+                self.fs.api.limiter.rate, int(self.fs.api.limiter.window)),
+        ]
+        for path, hydration in sorted(file_cache.hydrations.items()):
+            lines.append('hydration {0}: {1}'.format(path, hydration.Progress()))
+        return '\n'.join(lines) + '\n' + self._Get([])
+
+    def _Flush(self, args):
+        self.fs.api.task_queue.Flush()
+        return 'ok\n'
+
+    def _Forget(self, args):
+        path = self._Dir(args)
+        self.fs.metadata.Forget(path)
+        return 'ok\n'
+
+    def _Refresh(self, args):
+        path = self._Dir(args)
+        self.fs.metadata.Forget(path)
+        return '{0} entries\n'.format(len(self.fs.metadata.Listdir(path)) - 2)
+
+    def _Prefetch(self, args):
+        path, st = self._Path(args)
+        if stat.S_ISDIR(st['st_mode']):
+            return self.fs.file_cache.Hydrate(path).Progress() + '\n'
+        return 'fetching\n' if self.fs.file_cache.Prefetch(path) else 'cached\n'
+
+    def _Evict(self, args):
+        path, _ = self._Path(args)
+        return 'evicted {0} files\n'.format(self.fs.file_cache.Evict(path))
+
+    def _Fetch(self, args):
+        if len(args) != 2:
+            raise ControlError('usage: fetch PATH DEST')
+        path, _ = self._Path(args[:1])
+        if not os.path.isabs(args[1]):
+            raise ControlError('DEST must be an absolute path')
+        try:
+            counts = self.fs.file_cache.Export(path, args[1])
+        except EnvironmentError, e:
+            raise ControlError(e.strerror or str(e))
+        return ', '.join('{0} {1}'.format(count, how)
+                         for how, count in sorted(counts.items())) + '\n'
+
+    def _Get(self, args):
+        if len(args) > 1:
+            raise ControlError('usage: get [NAME]')
+        lines = []
+        for name in args or sorted(SETTINGS):
+            obj, attr = self._Target(name)
+            lines.append('{0} = {1!r}  # {2}'.format(name, getattr(obj, attr), SETTINGS[name][2]))
+        return '\n'.join(lines) + '\n'
+
+    def _Set(self, args):
+        if len(args) != 2:
+            raise ControlError('usage: set NAME VALUE')
+        obj, attr = self._Target(args[0])
+        setattr(obj, attr, _ParseValue(args[1], getattr(obj, attr)))
+        return self._Get(args[:1])
+
+    def _Help(self, args):
+        return HELP
+
+    COMMANDS = {
+        'status': _Status, 'flush': _Flush, 'forget': _Forget, 'refresh': _Refresh,
+        'prefetch': _Prefetch, 'evict': _Evict, 'fetch': _Fetch, 'get': _Get, 'set': _Set,
+        'help': _Help,
+    }
+
+
+def _ParseValue(text, current):
+    """Convert text to the type of a setting's current value."""
+    if text.lower() == 'none':
+        return None
+    try:
+        if isinstance(current, bool):
+            if text.lower() not in ('true', 'false', '1', '0', 'yes', 'no', 'on', 'off'):
+                raise ValueError(text)
+            return text.lower() in ('true', '1', 'yes', 'on')
+        if isinstance(current, float):
+            return float(text)
+        return int(text)
+    except ValueError:
+        raise ControlError('invalid value {0!r}'.format(text))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Send a command to a mounted GlobusFS.', epilog=HELP,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mountpoint', help='Local mount path')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Command and its arguments')
+    args = parser.parse_args()
+
+    if len(args.command) == 3 and args.command[0] == 'fetch':
+        args.command[2] = os.path.abspath(args.command[2])  # The mount has its own cwd.
+    line = ' '.join(_Quote(arg) for arg in args.command or ['status'])
+    control_file = os.path.join(args.mountpoint, CONTROL_PATH.lstrip('/'))
+    try:
+        fd = os.open(control_file, os.O_RDWR)
+    except OSError, e:
+        exit('Cannot open {0}: {1}'.format(control_file, os.strerror(e.errno)))
+    try:
+        os.write(fd, line + '\n')
+        os.lseek(fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    reply = ''.join(chunks)
+    sys.stdout.write(reply)
+    if reply.startswith('error:'):
+        sys.exit(1)
+
+
+def _Quote(arg):
+    """Quote a command argument so that shlex.split() gives it back unchanged."""
+    if arg and not any(c.isspace() or c in '\'"\\' for c in arg):
+        return arg
+    return "'" + arg.replace("'", "'\"'\"'") + "'"
+
+
+if __name__ == '__main__':
+    main()
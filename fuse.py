@@ -327,6 +327,14 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+def make_c_stat(attrs):
+    'Builds a c_stat from an attribute dict, for getattr to return ready-made'
+
+    st = c_stat()
+    set_st_attrs(st, attrs)
+    return st
+
+
 def fuse_get_context():
     'Returns a (uid, gid, pid) tuple'
 
@@ -340,6 +348,10 @@ class FuseOSError(OSError):
         super(FuseOSError, self).__init__(errno, strerror(errno))
 
 
+def _unsupported(*args):
+    raise FuseOSError(EFAULT)
+
+
 class FUSE(object):
     '''
     This class is the lower level interface and should not be subclassed under
@@ -364,9 +376,9 @@ class FUSE(object):
         This gives you access to direct_io, keep_cache, etc.
         '''
 
-        self.operations = operations
         self.raw_fi = raw_fi
         self.encoding = encoding
+        self._bind_operations(operations)
 
         args = ['fuse']
 
@@ -384,7 +396,7 @@ class FUSE(object):
         fuse_ops = fuse_operations()
         for name, prototype in fuse_operations._fields_:
             if prototype != c_voidp and getattr(operations, name, None):
-                op = partial(self._wrapper, getattr(self, name))
+                op = self._handler(getattr(self, name))
                 setattr(fuse_ops, name, prototype(op))
 
         try:
@@ -412,23 +424,68 @@ class FUSE(object):
             else:
                 yield '%s=%s' % (key, value)
 
-    @staticmethod
-    def _wrapper(func, *args, **kwargs):
-        'Decorator for the methods that follow'
+    # Most paths decoded recently are kept (see _decode), up to this many.
+    PATH_CACHE_SIZE = 65536
+
+    def _bind_operations(self, operations):
+        '''
+        Looks up every operation once, so that upcalls don't go through
+        Operations.__call__ and getattr. Operations whose class overrides
+        __call__ (e.g. LoggingMixIn) are still called through it.
+        '''
+
+        self.operations = operations
+        call = getattr(type(operations).__call__, 'im_func', None)
+        direct = call is Operations.__call__.im_func
+
+        self._dispatch = {}
+        names = [name for name, prototype in fuse_operations._fields_]
+        names.extend(('readinto', 'writefrom', 'readdir_from'))
+        for name in names:
+            if not hasattr(operations, name):
+                self._dispatch[name] = _unsupported
+            elif direct:
+                self._dispatch[name] = getattr(operations, name)
+            else:
+                self._dispatch[name] = partial(operations, name)
+
+        self._readinto = bool(getattr(operations, 'readinto', None))
+        self._writefrom = bool(getattr(operations, 'writefrom', None))
+        self._readdir_from = bool(getattr(operations, 'readdir_from', None))
+        self._paths = {}
+
+    def _decode(self, path):
+        '''
+        Decodes a path, reusing the result for the same path. Operations then
+        see the same unicode object (with its hash already computed) every
+        time. The table is emptied once it holds PATH_CACHE_SIZE paths.
+        '''
 
         try:
-            return func(*args, **kwargs) or 0
-        except OSError, e:
-            return -(e.errno or EFAULT)
-        except:
-            print_exc()
-            return -EFAULT
+            return self._paths[path]
+        except KeyError:
+            if len(self._paths) >= self.PATH_CACHE_SIZE:
+                self._paths.clear()
+            decoded = self._paths[path] = path.decode(self.encoding)
+            return decoded
+
+    @staticmethod
+    def _handler(func):
+        'Wraps the methods that follow for libfuse, which expects -errno'
+
+        def handler(*args):
+            try:
+                return func(*args) or 0
+            except OSError, e:
+                return -(e.errno or EFAULT)
+            except:
+                print_exc()
+                return -EFAULT
 
-    def getattr(self, path, buf):
-        return self.fgetattr(path, buf, None)
+        return handler
 
     def readlink(self, path, buf, bufsize):
-        ret = self.operations('readlink', path.decode(self.encoding)) \
+        ret = self._dispatch['readlink'](self._decode(path)) \
                   .encode(self.encoding)
 
         # copies a string into the given buffer
@@ -438,35 +495,35 @@ class FUSE(object):
         return 0
 
     def mknod(self, path, mode, dev):
-        return self.operations('mknod', path.decode(self.encoding), mode, dev)
+        return self._dispatch['mknod'](self._decode(path), mode, dev)
 
     def mkdir(self, path, mode):
-        return self.operations('mkdir', path.decode(self.encoding), mode)
+        return self._dispatch['mkdir'](self._decode(path), mode)
 
     def unlink(self, path):
-        return self.operations('unlink', path.decode(self.encoding))
+        return self._dispatch['unlink'](self._decode(path))
 
     def rmdir(self, path):
-        return self.operations('rmdir', path.decode(self.encoding))
+        return self._dispatch['rmdir'](self._decode(path))
 
     def symlink(self, source, target):
         'creates a symlink `target -> source` (e.g. ln -s source target)'
 
-        return self.operations('symlink', target.decode(self.encoding),
-                                          source.decode(self.encoding))
+        return self._dispatch['symlink'](self._decode(target),
+                                         self._decode(source))
 
     def rename(self, old, new):
-        return self.operations('rename', old.decode(self.encoding),
-                                         new.decode(self.encoding))
+        return self._dispatch['rename'](self._decode(old),
+                                        self._decode(new))
 
     def link(self, source, target):
         'creates a hard link `target -> source` (e.g. ln source target)'
 
-        return self.operations('link', target.decode(self.encoding),
-                                       source.decode(self.encoding))
+        return self._dispatch['link'](self._decode(target),
+                                      self._decode(source))
 
     def chmod(self, path, mode):
-        return self.operations('chmod', path.decode(self.encoding), mode)
+        return self._dispatch['chmod'](self._decode(path), mode)
 
     def chown(self, path, uid, gid):
         # Check if any of the arguments is a -1 that has overflowed
@@ -475,18 +532,18 @@ class FUSE(object):
         if c_gid_t(gid + 1).value == 0:
             gid = -1
 
-        return self.operations('chown', path.decode(self.encoding), uid, gid)
+        return self._dispatch['chown'](self._decode(path), uid, gid)
 
     def truncate(self, path, length):
-        return self.operations('truncate', path.decode(self.encoding), length)
+        return self._dispatch['truncate'](self._decode(path), length)
 
     def open(self, path, fip):
         fi = fip.contents
         if self.raw_fi:
-            return self.operations('open', path.decode(self.encoding), fi)
+            return self._dispatch['open'](self._decode(path), fi)
         else:
-            fi.fh = self.operations('open', path.decode(self.encoding),
-                                            fi.flags)
+            fi.fh = self._dispatch['open'](self._decode(path),
+                                           fi.flags)
 
             return 0
 
@@ -496,8 +553,13 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        ret = self.operations('read', path.decode(self.encoding), size,
-                                      offset, fh)
+        if self._readinto:
+            # The operation fills the kernel's buffer itself: no intermediate string.
+            return self._dispatch['readinto'](self._decode(path), buf,
+                                              size, offset, fh)
+
+        ret = self._dispatch['read'](self._decode(path), size,
+                                     offset, fh)
 
         if not ret: return 0
 
@@ -505,24 +567,27 @@ class FUSE(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
         memmove(buf, ret, retsize)
         return retsize
 
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
-
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
-        return self.operations('write', path.decode(self.encoding), data,
-                                        offset, fh)
+        if self._writefrom:
+            # The operation reads the kernel's buffer itself: no intermediate string.
+            return self._dispatch['writefrom'](self._decode(path), buf,
+                                               size, offset, fh)
+
+        data = string_at(buf, size)
+        return self._dispatch['write'](self._decode(path), data,
+                                       offset, fh)
 
     def statfs(self, path, buf):
         stv = buf.contents
-        attrs = self.operations('statfs', path.decode(self.encoding))
+        attrs = self._dispatch['statfs'](self._decode(path))
         for key, val in attrs.items():
             if hasattr(stv, key):
                 setattr(stv, key, val)
@@ -535,7 +600,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('flush', path.decode(self.encoding), fh)
+        return self._dispatch['flush'](self._decode(path), fh)
 
     def release(self, path, fip):
         if self.raw_fi:
@@ -543,7 +608,7 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        return self.operations('release', path.decode(self.encoding), fh)
+        return self._dispatch['release'](self._decode(path), fh)
 
     def fsync(self, path, datasync, fip):
         if self.raw_fi:
@@ -551,17 +616,18 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('fsync', path.decode(self.encoding), datasync,
-                                        fh)
+        return self._dispatch['fsync'](self._decode(path), datasync,
+                                       fh)
 
     def setxattr(self, path, name, value, size, options, *args):
-        return self.operations('setxattr', path.decode(self.encoding),
-                               name.decode(self.encoding),
-                               string_at(value, size), options, *args)
+        return self._dispatch['setxattr'](self._decode(path),
+                                          name.decode(self.encoding),
+                                          string_at(value, size), options,
+                                          *args)
 
     def getxattr(self, path, name, value, size, *args):
-        ret = self.operations('getxattr', path.decode(self.encoding),
-                                          name.decode(self.encoding), *args)
+        ret = self._dispatch['getxattr'](self._decode(path),
+                                         name.decode(self.encoding), *args)
 
         retsize = len(ret)
         # allow size queries
@@ -576,7 +642,7 @@ class FUSE(object):
         return retsize
 
     def listxattr(self, path, namebuf, size):
-        attrs = self.operations('listxattr', path.decode(self.encoding)) or ''
+        attrs = self._dispatch['listxattr'](self._decode(path)) or ''
         ret = '\x00'.join(attrs).encode(self.encoding) + '\x00'
 
         retsize = len(ret)
@@ -592,20 +658,25 @@ class FUSE(object):
         return retsize
 
     def removexattr(self, path, name):
-        return self.operations('removexattr', path.decode(self.encoding),
-                                              name.decode(self.encoding))
+        return self._dispatch['removexattr'](self._decode(path),
+                                             name.decode(self.encoding))
 
     def opendir(self, path, fip):
         # Ignore raw_fi
-        fip.contents.fh = self.operations('opendir',
-                                          path.decode(self.encoding))
+        fip.contents.fh = self._dispatch['opendir'](self._decode(path))
 
         return 0
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path.decode(self.encoding),
-                                               fip.contents.fh):
+        if self._readdir_from:
+            items = self._dispatch['readdir_from'](self._decode(path),
+                                                   offset, fip.contents.fh)
+        else:
+            items = self._dispatch['readdir'](self._decode(path),
+                                              fip.contents.fh)
+
+        for item in items:
 
             if isinstance(item, basestring):
                 name, st, offset = item, None, 0
@@ -624,31 +695,31 @@ class FUSE(object):
 
     def releasedir(self, path, fip):
         # Ignore raw_fi
-        return self.operations('releasedir', path.decode(self.encoding),
-                                             fip.contents.fh)
+        return self._dispatch['releasedir'](self._decode(path),
+                                            fip.contents.fh)
 
     def fsyncdir(self, path, datasync, fip):
         # Ignore raw_fi
-        return self.operations('fsyncdir', path.decode(self.encoding),
-                                           datasync, fip.contents.fh)
+        return self._dispatch['fsyncdir'](self._decode(path),
+                                          datasync, fip.contents.fh)
 
     def init(self, conn):
-        return self.operations('init', '/')
+        return self._dispatch['init']('/')
 
     def destroy(self, private_data):
-        return self.operations('destroy', '/')
+        return self._dispatch['destroy']('/')
 
     def access(self, path, amode):
-        return self.operations('access', path.decode(self.encoding), amode)
+        return self._dispatch['access'](self._decode(path), amode)
 
     def create(self, path, mode, fip):
         fi = fip.contents
-        path = path.decode(self.encoding)
+        path = self._decode(path)
 
         if self.raw_fi:
-            return self.operations('create', path, mode, fi)
+            return self._dispatch['create'](path, mode, fi)
         else:
-            fi.fh = self.operations('create', path, mode)
+            fi.fh = self._dispatch['create'](path, mode)
             return 0
 
     def ftruncate(self, path, length, fip):
@@ -657,13 +728,10 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('truncate', path.decode(self.encoding),
-                                           length, fh)
+        return self._dispatch['truncate'](self._decode(path),
+                                          length, fh)
 
-    def fgetattr(self, path, buf, fip):
-        memset(buf, 0, sizeof(c_stat))
-
-        st = buf.contents
+    def fgetattr(self, path, buf, fip=None):
         if not fip:
             fh = fip
         elif self.raw_fi:
@@ -671,18 +739,26 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        attrs = self.operations('getattr', path.decode(self.encoding), fh)
-        set_st_attrs(st, attrs)
+        attrs = self._dispatch['getattr'](self._decode(path), fh)
+        if isinstance(attrs, c_stat):
+            # Built in advance (see make_c_stat): a single copy into the kernel's buffer.
+            memmove(buf, byref(attrs), sizeof(c_stat))
+            return 0
+
+        memset(buf, 0, sizeof(c_stat))
+        set_st_attrs(buf.contents, attrs)
         return 0
 
+    getattr = fgetattr  # One upcall less per stat() of a path.
+
     def lock(self, path, fip, cmd, lock):
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
-        return self.operations('lock', path.decode(self.encoding), fh, cmd,
-                                       lock)
+        return self._dispatch['lock'](self._decode(path), fh, cmd,
+                                      lock)
 
     def utimens(self, path, buf):
         if buf:
@@ -692,11 +768,11 @@ class FUSE(object):
         else:
             times = None
 
-        return self.operations('utimens', path.decode(self.encoding), times)
+        return self._dispatch['utimens'](self._decode(path), times)
 
     def bmap(self, path, blocksize, idx):
-        return self.operations('bmap', path.decode(self.encoding), blocksize,
-                                       idx)
+        return self._dispatch['bmap'](self._decode(path), blocksize,
+                                      idx)
 
 
 import datetime
@@ -763,6 +839,9 @@ class Operations(object):
 
         st_atime, st_mtime and st_ctime should be floats.
 
+        A c_stat may be returned instead (see make_c_stat); it is copied to
+        the kernel as is, which is faster for entries stat'ed over and over.
+
         NOTE: There is an incombatibility between Linux and Mac OS X
         concerning st_nlink of directories. Mac OS X counts all files inside
         the directory, while Linux counts only the subdirectories.
@@ -823,6 +902,11 @@ class Operations(object):
 
         raise FuseOSError(EIO)
 
+    # readinto(self, path, buf, size, offset, fh) may be defined instead of
+    # read. It copies at most size bytes into the ctypes buffer buf and
+    # returns the number of bytes copied, which avoids building a string.
+    readinto = None
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
@@ -831,6 +915,12 @@ class Operations(object):
 
         return ['.', '..']
 
+    # readdir_from(self, path, offset, fh) may be defined instead of readdir.
+    # It yields (name, attrs, next_offset) tuples for the entries from offset
+    # on, with next_offset > 0, so that each call resumes where the kernel's
+    # buffer filled up instead of walking the directory from the start.
+    readdir_from = None
+
     def readlink(self, path):
         raise FuseOSError(ENOENT)
 
@@ -882,6 +972,11 @@ class Operations(object):
     def write(self, path, data, offset, fh):
         raise FuseOSError(EROFS)
 
+    # writefrom(self, path, buf, size, offset, fh) may be defined instead of
+    # write. It takes size bytes from the ctypes buffer buf and returns the
+    # number of bytes written, which avoids building a string.
+    writefrom = None
+
 
 class LoggingMixIn:
     log = logging.getLogger('fuse.log-mixin')
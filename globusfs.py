@@ -7,13 +7,58 @@
 """Mount a Globus endpoint with FUSE."""
 
 import argparse
+import ctypes
 import errno
+import fnmatch
+import itertools
 import os
+import stat
+import sys
+import time
 
-from fuse import FUSE, FuseOSError, Operations
+from fuse import FUSE, FuseOSError, Operations, make_c_stat
 
 import api
 import cache
+import control
+import sharedcache
+import workload
+
+
+# Setting this attribute on a directory fetches its whole subtree into the cache; reading it back
+# reports progress. E.g. setfattr -n user.globusfs.hydrate -v 1 mnt/inputs
+HYDRATE_XATTR = 'user.globusfs.hydrate'
+# Linux reports a missing attribute as ENODATA, BSD and OS X as ENOATTR.
+ENOATTR = getattr(errno, 'ENOATTR', errno.ENODATA)
+
+
+class StatStructs(object):
+    """MetaData entries as c_stats, which FUSE copies to the kernel as is.
+
+    A c_stat is built on first use and kept for as long as its path maps to the same entry dict
+    (MetaData replaces the dict whenever the entry changes). Those of entries that have changed or
+    gone are dropped once they outnumber the entries.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.structs = {}  # Maps path to (its entry, the entry as a c_stat).
+
+    def Stat(self, path):
+        """Like MetaData.Stat(), but as a c_stat. Don't modify it."""
+        built = self.structs.get(path)
+        if built is not None and self.metadata.Unchanged(path, built[0]):
+            return built[1]
+        attrs = self.metadata.Stat(path)
+        if attrs is None:
+            return None
+        if len(self.structs) > 2 * len(self.metadata.files):
+            files = self.metadata.files
+            self.structs = dict((other, other_built) for other, other_built in self.structs.items()
+                                if files.get(other) is other_built[0])
+        st = make_c_stat(attrs)
+        self.structs[path] = (attrs, st)
+        return st
 
 
 class GlobusFS(Operations):
@@ -24,7 +69,9 @@ class GlobusFS(Operations):
     # TODO: queue requests into batches (e.g. rm -r should not send so many reqs)
     # TODO: we probably must update cache every now and then to pull updates
 
-    def __init__(self, local_endpoint, local_path, remote_endpoint):
+    def __init__(self, local_endpoint, local_path, remote_endpoint, https_url=None,
+                 https_token=None, direct_io_size=None, direct_io_patterns=(), globus_api=None,
+                 shared_cache=None, endpoint_roots=()):
         """Initialize the FUSE wrapper.
 
         Args:
@@ -32,15 +79,48 @@ class GlobusFS(Operations):
             local_path: Directory visible to the local endpoint. Cache will be stored under this
                 directory.
             remote_endpoint: Name of the remote endpoint to be mounted.
+            https_url: Optional HTTPS base URL of the remote endpoint. If given, large files are
+                read in ranges over HTTPS rather than transferred whole.
+            https_token: Bearer token for https_url.
+            direct_io_size: Files of at least this many bytes bypass the kernel page cache
+                (None to never bypass it by size).
+            direct_io_patterns: Shell-style patterns of paths that bypass the kernel page cache.
+            globus_api: GlobusAPI() wrapper to use instead of connecting to Globus (e.g. the
+                simulated endpoint of replay.py).
+            shared_cache: Optional unix socket of the host's cache daemon (see sharedcache.py).
+                Listings and read-only file data then come from the daemon.
+            endpoint_roots: Local directories besides local_path that the local endpoint can
+                write to; the control file's fetch command transfers straight into them.
         """
         # Wrapper around the globus API.
-        self.api = api.GlobusAPI(local_endpoint, remote_endpoint)
+        self.api = globus_api or api.GlobusAPI(
+            local_endpoint, remote_endpoint,
+            journal_path=os.path.join(local_path, cache.CACHE_DIR, 'journal'))
 
         # Cache file metadata in memory.
-        self.metadata = cache.MetaData(self.api)
+        shared = shared_cache and sharedcache.SharedCacheClient(shared_cache, remote_endpoint)
+        self.metadata = cache.MetaData(shared or self.api)
 
         # Cache file data in local endpoint.
-        self.file_cache = cache.FileCache(self.api, local_path)
+        data_plane = api.HTTPSDataPlane(https_url, https_token) if https_url else None
+        self.file_cache = cache.FileCache(self.api, self.metadata, local_path, data_plane,
+                                          shared=shared)
+        self.file_cache.endpoint_roots.extend(os.path.abspath(root) for root in endpoint_roots)
+        self.metadata.open_files = self.file_cache.refs  # Their listings stay in memory.
+        self.metadata.queue = self.api.task_queue  # So do those it hasn't pushed changes of.
+        self.structs = StatStructs(self.metadata)
+
+        # Streaming files are read once; caching their pages would only evict hot files.
+        self.direct_io_size = direct_io_size
+        self.direct_io_patterns = direct_io_patterns
+
+        # Virtual /.globusfs/control file for runtime commands (see control.py).
+        self.controller = control.Controller(self)
+        self.mount_time = time.time()
+
+        # Maps directory handle number to the listing taken when the directory was opened.
+        self.dir_snapshots = {}
+        self.dir_counter = itertools.count(1)
 
         print 'Ready!'
 
@@ -48,89 +128,216 @@ class GlobusFS(Operations):
     #    FS Commands   #
     ####################
 
-    def create(self, path, mode, fi=None):
+    # FUSE is started with raw_fi, so operations on open files get the whole fuse_file_info.
+    # Its fh field holds the FileCache handle number, or the Controller's for the control file.
+
+    def create(self, path, mode, fi):
         """Create a new file."""
-        self.file_cache.Create(path)
+        self._CheckNotControl(path)
         self.metadata.NewFile(path, mode)
+        fi.fh = self.file_cache.Create(path)
+        fi.direct_io = self._DirectIO(path)
         return 0
 
     def destroy(self, path):
         """Called on filesystem destruction. Path is always /"""
         print 'EXIT: Waiting to sync pending changes...'
         self.api.Close()
-        self.file_cache.Destroy()
+        self.file_cache.Close()
 
-    def flush(self, path, fh):
-        """Flush the internal I/O buffer when reading a file."""
-        self.file_cache.Get(path).flush()
+    def flush(self, path, fi):
+        """Publish the size of a file being written."""
+        if path == control.CONTROL_PATH:
+            return 0
+        self._PublishSize(path, self.file_cache.Flush(fi.fh))
         return 0
 
-    def getattr(self, path, fh=None):
+    def getattr(self, path, fi=None):
         """Get metadata for a specific file/directory."""
-        stat = self.metadata.Stat(path)
-        if stat:
-            return stat
+        if path in (control.CONTROL_DIR, control.CONTROL_PATH):
+            mode = stat.S_IFDIR | 0700 if path == control.CONTROL_DIR else stat.S_IFREG | 0600
+            return {'st_atime': self.mount_time, 'st_mtime': self.mount_time,
+                    'st_ctime': self.mount_time, 'st_nlink': 2, 'st_mode': mode, 'st_size': 0}
+        size = self.file_cache.OpenSize(path)
+        if size is None:
+            st = self.structs.Stat(path)  # Copied to the kernel as is.
+        else:
+            st = self.metadata.Stat(path)
+            if st:
+                st = dict(st, st_size=size)  # Writes not yet published to metadata.
+        if st:
+            return st
         else:
             # File doesn't exist.
             raise FuseOSError(errno.ENOENT)
     
+    def getxattr(self, path, name, position=0):
+        """Report the progress of a directory's hydration."""
+        hydration = self.file_cache.hydrations.get(path)
+        if name != HYDRATE_XATTR or hydration is None:
+            raise FuseOSError(ENOATTR)
+        return hydration.Progress()
+
+    def listxattr(self, path):
+        return [HYDRATE_XATTR] if path in self.file_cache.hydrations else []
+
     def mkdir(self, path, mode):
         """Make a new directory."""
+        self._CheckNotControl(path)
         self.api.Mkdir(path)
         self.metadata.NewDirectory(path)
 
-    def open(self, path, flags):
-        """Open a file. This will require copying to the disk cache if we haven't already."""
-        f = self.file_cache.Open(path, flags)
-        if f:
-            return f.fileno()
-        else:
+    def open(self, path, fi):
+        """Open a file. This will start a copy to the disk cache if we haven't already.
+
+        Files whose cached copy is unchanged since they were last opened keep their pages in the
+        kernel, so re-reads never reach us; streaming files bypass the page cache altogether.
+        """
+        if path == control.CONTROL_PATH:
+            fi.fh = self.controller.Open()
+            fi.direct_io = True  # Replies are generated on read; the file's size is always 0.
+            return 0
+        try:
+            fh = self.file_cache.Open(path, fi.flags)
+        except IOError, e:
+            raise FuseOSError(e.errno or errno.EIO)
+        if fh is None:
             # File timeout or other problem.
-            return FuseOSError(errno.EROFS)
+            raise FuseOSError(errno.EROFS)
+        fi.fh = fh
+        fi.direct_io = self._DirectIO(path)
+        fi.keep_cache = not fi.direct_io and self.file_cache.KeepCache(fh)
+        return 0
 
-    def read(self, path, size, offset, fh):
+    def opendir(self, path):
+        """Snapshot a directory's listing; readdir_from() pages through it until releasedir()."""
+        if path == control.CONTROL_DIR:
+            listing = ['.', '..', os.path.basename(control.CONTROL_PATH)]
+        else:
+            listing = self.metadata.Listdir(path)  # A new list, not shared with the cache.
+        fh = next(self.dir_counter)
+        self.dir_snapshots[fh] = listing
+        return fh
+
+    def read(self, path, size, offset, fi):
         """Returns a string containing the file data requested."""
-        f = self.file_cache.Get(path)
-        f.seek(offset)
-        return f.read(size)
+        if path == control.CONTROL_PATH:
+            return self.controller.Read(fi.fh, size, offset)
+        try:
+            return self.file_cache.Read(fi.fh, size, offset)
+        except IOError:
+            raise FuseOSError(errno.EIO)
+
+    def readinto(self, path, buf, size, offset, fi):
+        """Read file data straight into the buffer FUSE provided; returns the byte count."""
+        if path == control.CONTROL_PATH:
+            data = self.controller.Read(fi.fh, size, offset)
+            ctypes.memmove(buf, data, len(data))
+            return len(data)
+        try:
+            return self.file_cache.ReadInto(fi.fh, buf, size, offset)
+        except IOError:
+            raise FuseOSError(errno.EIO)
 
-    def readdir(self, path, fh):
-        """List contents of a directory (e.g. from ls)."""
-        return self.metadata.Listdir(path)
+    def readdir_from(self, path, offset, fh):
+        """List contents of a directory (e.g. from ls), resuming at offset.
+
+        Each entry's offset is its position + 1 in the snapshot, so the kernel can page through
+        a huge directory without entries being skipped or repeated, or the listing rebuilt.
+        """
+        listing = self.dir_snapshots[fh]
+        for i in xrange(offset, len(listing)):
+            yield listing[i], None, i + 1
 
-    def release(self, path, fh):
+    def release(self, path, fi):
         """Release a file after reading it."""
-        self.file_cache.Get(path).close()
+        if path == control.CONTROL_PATH:
+            self.controller.Release(fi.fh)
+            return 0
+        self._PublishSize(path, self.file_cache.Release(fi.fh))
+        return 0
+
+    def releasedir(self, path, fh):
+        """Drop the snapshot taken by opendir()."""
+        self.dir_snapshots.pop(fh, None)
         return 0
 
     def rename(self, old, new):
         """Rename a file/directory by submitting a transfer."""
+        self._CheckNotControl(old)
+        self._CheckNotControl(new)
         self.api.Rename(old, new)
         self.metadata.Rename(old, new)
+        self.file_cache.Rename(old, new)
 
     def rmdir(self, path):
         """Remove an empty directory."""
-        if len(self.metadata.Listdir(path)) > 2:
+        self._CheckNotControl(path)
+        if self.metadata.Count(path):
             # Directory not empty.
             raise FuseOSError(errno.ENOTEMPTY)
         return self.unlink(path)
 
+    def setxattr(self, path, name, value, options, position=0):
+        """Setting user.globusfs.hydrate on a directory fetches its subtree in the background."""
+        if name != HYDRATE_XATTR:
+            raise FuseOSError(errno.ENOTSUP)
+        st = self.metadata.Stat(path)
+        if st is None:
+            raise FuseOSError(errno.ENOENT)
+        if not stat.S_ISDIR(st['st_mode']):
+            raise FuseOSError(errno.ENOTDIR)
+        self.file_cache.Hydrate(path)
+        return 0
+
+    def truncate(self, path, length, fi=None):
+        """Only the control file can be truncated (e.g. by echo cmd > control); it's a no-op."""
+        if path != control.CONTROL_PATH:
+            raise FuseOSError(errno.EROFS)
+        return 0
+
     def unlink(self, path):
         """Unlink (remove) a file."""
+        self._CheckNotControl(path)
         self.api.Delete(path)
         self.metadata.Remove(path)
+        self.file_cache.Remove(path)
         return 0
 
-    def write(self, path, data, offset, fh):
+    def write(self, path, data, offset, fi):
         """Write data to a file."""
-        # Write data to the local cache.
-        f = self.file_cache.Get(path)
-        f.seek(offset)
-        f.write(data)
-        # Update file size.
-        f_size = self.metadata.Stat(path)['st_size']
-        self.metadata.ChangeFileSize(path, max(f_size, offset + len(data)))
-        return len(data)
+        if path == control.CONTROL_PATH:
+            return self.controller.Write(fi.fh, data)
+        return self.file_cache.Write(fi.fh, data, offset)
+
+    def writefrom(self, path, buf, size, offset, fi):
+        """Write data to a file straight from the buffer FUSE provided."""
+        if path == control.CONTROL_PATH:
+            return self.controller.Write(fi.fh, ctypes.string_at(buf, size))
+        return self.file_cache.WriteFrom(fi.fh, buf, size, offset)
+
+    def _CheckNotControl(self, path):
+        """The control directory shadows the remote one; it can't be modified."""
+        if path == control.CONTROL_DIR or path.startswith(control.CONTROL_DIR + '/'):
+            raise FuseOSError(errno.EPERM)
+
+    def _DirectIO(self, path):
+        """True if reads and writes of path should bypass the kernel page cache."""
+        if any(fnmatch.fnmatch(path, pattern) for pattern in self.direct_io_patterns):
+            return True
+        if self.direct_io_size is None:
+            return False  # Not by size; no need to look the file up.
+        st = self.metadata.Stat(path)
+        return st is not None and st['st_size'] >= self.direct_io_size
+
+    def _PublishSize(self, path, size):
+        """Record the size of a written file in the metadata cache."""
+        if size is not None and self.metadata.Stat(path):
+            self.metadata.ChangeFileSize(path, size)
+
+
+class RecordingGlobusFS(workload.RecordingMixIn, GlobusFS):
+    """GlobusFS that records its operations for replay.py (see globusfs.py --record)."""
 
 
 def main():
@@ -144,13 +351,44 @@ def main():
         'cache_dir', help='Directory visible from the local endpoint. Cache will be stored here.')
     parser.add_argument('remote_endpoint', help='Globus endoint name')
     parser.add_argument('mountpoint', help='Local mount path')
+    parser.add_argument('--https-url', help='HTTPS base URL of the remote endpoint, used for '
+                        'ranged reads of large files')
+    parser.add_argument('--https-token', help='Bearer token for --https-url')
+    parser.add_argument('--direct-io-size', type=int, metavar='MB',
+                        help='Files of at least this many MB bypass the kernel page cache')
+    parser.add_argument('--direct-io', action='append', default=[], metavar='PATTERN',
+                        help='Files matching this shell pattern (e.g. "*.mp4") bypass the '
+                        'kernel page cache. May be repeated.')
+    parser.add_argument('--shared-cache', metavar='SOCKET',
+                        help='Unix socket of the host\'s cache daemon (see sharedcache.py)')
+    parser.add_argument('--endpoint-root', action='append', default=[], metavar='DIR',
+                        help='Another local directory the local endpoint can write to, so '
+                        'fetches into it skip the cache. May be repeated.')
+    parser.add_argument('--record', metavar='TRACE',
+                        help='Record every operation into this file, for replay.py')
     args = parser.parse_args()
 
     if os.geteuid() != 0:
         exit('You must run as root to use FUSE.')
 
-    globus_fs = GlobusFS(args.local_endpoint, args.cache_dir, args.remote_endpoint)
-    FUSE(globus_fs, args.mountpoint, nothreads=True, foreground=True)
+    direct_io_size = None
+    if args.direct_io_size is not None:
+        direct_io_size = args.direct_io_size * 1024 * 1024
+    fs_class = RecordingGlobusFS if args.record else GlobusFS
+    globus_fs = fs_class(args.local_endpoint, args.cache_dir, args.remote_endpoint,
+                         args.https_url, args.https_token, direct_io_size, args.direct_io,
+                         shared_cache=args.shared_cache, endpoint_roots=args.endpoint_root)
+    if args.record:
+        globus_fs.trace = workload.TraceWriter(args.record)
+    options = {}
+    if sys.platform.startswith('linux'):
+        # Let the kernel send writes of up to 128 KB rather than one upcall per 4 KB page.
+        options.update(big_writes=True, max_write=128 * 1024)
+    try:
+        FUSE(globus_fs, args.mountpoint, foreground=True, raw_fi=True, **options)
+    finally:
+        if args.record:
+            globus_fs.trace.Close()
 
 
 if __name__ == '__main__':
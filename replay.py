@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+"""Replay a recorded workload against a GlobusFS backed by a simulated endpoint.
+
+Record a trace by mounting with --record, then replay it without FUSE or Globus:
+
+    sudo python globusfs.py --record trace.bin local-endpoint cache-directory remote-endpoint mnt
+    python replay.py trace.bin remote-copy /tmp/replay-cache --speed 10
+
+The simulated endpoint serves a local directory (remote-copy) with a fixed latency per transfer
+task and a throughput that depends on the task's transfer profile; --set changes the profiles
+(or any other setting) to compare them on the same trace. With --synthesize, that directory is
+first filled with sparse files of the sizes the trace saw, so production traces can be replayed
+without production data.
+Operations are issued in their recorded order, at their recorded times divided by --speed;
+a replayed operation that takes longer delays the ones after it. Latencies per operation are
+reported at the end, next to the recorded ones.
+"""
+
+import argparse
+import ctypes
+import datetime
+import errno
+import hashlib
+import itertools
+import os
+import shutil
+import stat
+import threading
+import time
+
+from fuse import fuse_file_info
+
+import api
+import control
+import globusfs
+import workload
+
+REMOTE_ENDPOINT = 'globusfs#simulated-remote'
+LOCAL_ENDPOINT = 'globusfs#simulated-local'
+
+
+class SimulatedEndpoint(object):
+    """Stand-in for a TransferAPIClient, serving a local directory as the remote endpoint.
+
+    Every transfer task waits latency seconds, then copies its files. With perf_p 1 a file is
+    written front to back, so progressive reads see the destination grow as they would with
+    Globus; with several streams (or Globus' default) the destination is first extended to its
+    full size, as parallel streams leave holes behind the furthest one. The task's profile
+    options are modeled: perf_cc files are copied at once, each after file_overhead seconds of
+    setup, over perf_p streams of throughput bytes per second (all streams of a task share
+    bandwidth, if given). Encrypted data moves encrypt_factor as fast, and verified files are
+    read back at checksum_rate before they count as delivered. Files a task's sync_level finds up
+    to date are skipped. A task still running at its deadline is cancelled, as Globus expires it.
+    Deletes take latency seconds. Local endpoint paths are local filesystem paths.
+    """
+
+    def __init__(self, root, latency=1.0, throughput=10 * 1024 * 1024, bandwidth=None,
+                 file_overhead=0.05, encrypt_factor=0.5, checksum_rate=200 * 1024 * 1024):
+        self.root = root
+        self.latency = latency
+        self.throughput = throughput
+        self.bandwidth = bandwidth
+        self.file_overhead = file_overhead
+        self.encrypt_factor = encrypt_factor
+        self.checksum_rate = checksum_rate
+        self.lock = threading.Lock()
+        self.tasks = {}  # Maps task id to its task document.
+        self.landed = {}  # Maps task id to the source paths it has delivered.
+        self.cancelled = set()
+        self.expired = set()  # Tasks cancelled by their deadline.
+        self.timers = {}  # Maps task id to the timer that expires it at its deadline.
+        self.ids = itertools.count(1)
+
+    def _Path(self, endpoint, path):
+        if endpoint == REMOTE_ENDPOINT:
+            return os.path.join(self.root, path.lstrip('/'))
+        return path
+
+    def _NewTask(self, target, data):
+        task_id = 'simulated-{0}'.format(next(self.ids))
+        with self.lock:
+            self.tasks[task_id] = {'status': 'ACTIVE', 'completion_time': None,
+                                   'bytes_transferred': 0, 'files': 0, 'files_skipped': 0}
+            self.landed[task_id] = []
+        if data.get('deadline'):
+            deadline = datetime.datetime.strptime(data['deadline'][:19], '%Y-%m-%d %H:%M:%S')
+            lifetime = (deadline - datetime.datetime.utcnow()).total_seconds()
+            timer = self.timers[task_id] = threading.Timer(
+                max(lifetime, 0), self._Expire, args=(task_id,))
+            timer.daemon = True
+            timer.start()
+        thread = threading.Thread(target=self._Run, args=(task_id, target, data))
+        thread.daemon = True
+        thread.start()
+        return 202, 'Accepted', {'task_id': task_id, 'message': 'The task was accepted'}
+
+    def _Expire(self, task_id):
+        """Async function: cancel a task that hasn't completed by its deadline."""
+        with self.lock:
+            if self.tasks[task_id]['completion_time'] is None:
+                self.cancelled.add(task_id)
+                self.expired.add(task_id)
+
+    def _Run(self, task_id, target, data):
+        """Async function: run a task and fill in its completion."""
+        time.sleep(self.latency)
+        try:
+            target(task_id, data)
+            status = 'FAILED' if task_id in self.cancelled else 'SUCCEEDED'
+        except (IOError, OSError), e:
+            print 'Simulated task {0} failed: {1}'.format(task_id, e)
+            status = 'FAILED'
+        with self.lock:
+            self.tasks[task_id].update(status=status, completion_time=str(
+                datetime.datetime.utcnow().replace(microsecond=0)) + '+00:00')
+            timer = self.timers.pop(task_id, None)
+        if timer:
+            timer.cancel()
+
+    def _Transfer(self, task_id, data):
+        files = list(self._Files(data))
+        concurrency = max(min(data.get('perf_cc') or 1, len(files)), 1)
+        rate = float(self.throughput) * (data.get('perf_p') or 1)
+        if self.bandwidth:
+            rate = min(rate, float(self.bandwidth) / concurrency)
+        if data.get('encrypt_data'):
+            rate *= self.encrypt_factor
+        verify = data.get('verify_checksum')
+        in_order = data.get('perf_p') == 1
+        sync_level = data.get('sync_level')
+
+        remaining = iter(files)
+        errors = []
+
+        def CopyFiles():
+            try:
+                while True:
+                    with self.lock:
+                        item = next(remaining, None)
+                    if item is None:
+                        return
+                    if sync_level is not None and self._InSync(item[1], item[2], sync_level):
+                        with self.lock:
+                            self.tasks[task_id]['files_skipped'] += 1
+                        continue
+                    self._CopyFile(task_id, item[0], item[1], item[2], rate, verify, in_order)
+            except (IOError, OSError), e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=CopyFiles) for _ in xrange(concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _Files(self, data):
+        """(source path, local source, local destination) of every file a transfer moves."""
+        source, destination = data['source_endpoint'], data['destination_endpoint']
+        for item in data['DATA']:
+            src = self._Path(source, item['source_path'])
+            dest = self._Path(destination, item['destination_path'])
+            if not os.path.isdir(src):
+                yield item['source_path'], src, dest
+                continue
+            for dirpath, dirnames, filenames in os.walk(src):
+                relative = os.path.relpath(dirpath, src)
+                for name in sorted(filenames):
+                    yield (os.path.join(item['source_path'], relative, name),
+                           os.path.join(dirpath, name),
+                           os.path.normpath(os.path.join(dest, relative, name)))
+
+    def _InSync(self, src, dest, sync_level):
+        """True if a transfer with this sync_level skips dest: it exists (0), has the same size
+        (1), isn't older (2) or has the same checksum (3). Checksums cost a read of both files."""
+        if not os.path.isfile(dest):
+            return False
+        src_st, dest_st = os.stat(src), os.stat(dest)
+        if sync_level == 0:
+            return True
+        if src_st.st_size != dest_st.st_size:
+            return False
+        if sync_level == 1:
+            return True
+        if sync_level == 2:
+            return dest_st.st_mtime >= src_st.st_mtime
+        time.sleep(2.0 * src_st.st_size / self.checksum_rate)
+        return _Checksum(src) == _Checksum(dest)
+
+    def _CopyFile(self, task_id, source_path, src, dest, rate, verify, in_order=True):
+        """Copy one file at rate bytes per second, then verify it if asked to. Unless in_order,
+        the destination has its full size (with holes) from the start."""
+        time.sleep(self.file_overhead)
+        if not os.path.isdir(os.path.dirname(dest)):
+            try:
+                os.makedirs(os.path.dirname(dest))
+            except OSError, e:
+                if e.errno != errno.EEXIST:  # Another file of the task made it first.
+                    raise
+        chunk_size = max(min(1024 * 1024, int(rate / 10)), 1)  # Cancels take effect promptly.
+        copied = 0
+        with open(src, 'rb') as fin:
+            with open(dest, 'wb') as fout:
+                if not in_order:
+                    fout.truncate(os.fstat(fin.fileno()).st_size)
+                while task_id not in self.cancelled:
+                    chunk = fin.read(chunk_size)
+                    if not chunk:
+                        break
+                    time.sleep(len(chunk) / rate)
+                    if task_id in self.cancelled:
+                        break
+                    fout.write(chunk)
+                    fout.flush()
+                    copied += len(chunk)
+                    with self.lock:
+                        self.tasks[task_id]['bytes_transferred'] += len(chunk)
+        if task_id in self.cancelled:
+            return  # Cut short; the file doesn't count as delivered.
+        if verify:
+            time.sleep(float(copied) / self.checksum_rate)
+        with self.lock:
+            self.tasks[task_id]['files'] += 1
+            self.landed[task_id].append(os.path.normpath(source_path))
+
+    def _Delete(self, task_id, data):
+        for item in data['DATA']:
+            path = self._Path(data['endpoint'], item['path'])
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    #######################
+    #  TransferAPIClient  #
+    #######################
+
+    def close(self):
+        pass
+
+    def delete(self, task):
+        return self._NewTask(self._Delete, task.as_data())
+
+    def endpoint_autoactivate(self, endpoint):
+        return 200, 'OK', {'message': 'Endpoint {0} is simulated'.format(endpoint),
+                           'expire_time': None}
+
+    def endpoint_ls(self, endpoint, path='/'):
+        time.sleep(self.latency)
+        directory = self._Path(endpoint, path)
+        listing = []
+        for name in sorted(os.listdir(directory)):
+            st = os.stat(os.path.join(directory, name))
+            listing.append({
+                'name': name,
+                'type': 'dir' if stat.S_ISDIR(st.st_mode) else 'file',
+                'permissions': '{0:04o}'.format(stat.S_IMODE(st.st_mode)),
+                'size': st.st_size,
+                'last_modified': time.strftime(
+                    '%Y-%m-%d %H:%M:%S+00:00', time.gmtime(st.st_mtime)),
+            })
+        return 200, 'OK', {'DATA': listing}
+
+    def endpoint_mkdir(self, endpoint, path):
+        time.sleep(self.latency)
+        os.mkdir(self._Path(endpoint, path))
+        return 202, 'Accepted', {'message': 'The directory was created successfully'}
+
+    def task(self, task_id):
+        with self.lock:
+            return 200, 'OK', dict(self.tasks[task_id])
+
+    def task_cancel(self, task_id):
+        self.cancelled.add(task_id)
+        return 200, 'OK', {'message': 'The task has been cancelled'}
+
+    def task_successful_transfers(self, task_id, marker=None):
+        with self.lock:
+            landed = list(self.landed[task_id])
+        return 200, 'OK', {'DATA': [{'source_path': path} for path in landed],
+                           'next_marker': None}
+
+    def transfer(self, task):
+        return self._NewTask(self._Transfer, task.as_data())
+
+    def transfer_submission_id(self):
+        return 200, 'OK', {'value': 'simulated-submission-{0}'.format(next(self.ids))}
+
+
+def _Checksum(local_path):
+    with open(local_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class SimulatedAPI(api.GlobusAPI):
+    """GlobusAPI talking to a SimulatedEndpoint: no credentials, no network."""
+
+    def __init__(self, endpoint, session_path):
+        self.endpoint = endpoint
+        super(SimulatedAPI, self).__init__(LOCAL_ENDPOINT, REMOTE_ENDPOINT, session_path)
+
+    def _Authenticate(self):
+        return None
+
+    @property
+    def api(self):
+        return self.endpoint
+
+
+def Synthesize(records, root):
+    """Create the files and directories the trace found on the endpoint under root.
+
+    Sizes come from the getattr results in the trace; files are sparse. Paths the trace created
+    itself are left out, and existing files are kept.
+    """
+    created = set()
+    for record in records:
+        if record.op in ('create', 'mkdir', 'rename'):
+            created.add(record.name if record.op == 'rename' else record.path)
+        if (record.op != 'getattr' or record.errno or record.path in created or
+                record.path == '/' or record.path.startswith(control.CONTROL_DIR)):
+            continue
+        local_path = os.path.join(root, record.path.lstrip('/'))
+        if stat.S_ISDIR(record.arg):
+            if not os.path.isdir(local_path):
+                os.makedirs(local_path)
+        elif stat.S_ISREG(record.arg) and not os.path.exists(local_path):
+            if not os.path.isdir(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            with open(local_path, 'wb') as f:
+                f.truncate(record.result)
+
+
+class Replayer(object):
+    """Issue the operations of a trace against an Operations instance and time them."""
+
+    def __init__(self, fs, speed=1.0):
+        """speed: recorded times are divided by this; 0 to replay as fast as possible."""
+        self.fs = fs
+        self.speed = speed
+        self.files = {}  # Maps recorded file handle to the fuse_file_info opened by the replay.
+        self.dirs = {}  # Maps recorded directory handle to the replay's.
+        self.latencies = {}  # Maps op to the list of its replayed latencies.
+        self.recorded = {}  # Maps op to the list of its recorded latencies.
+        self.errors = {}  # Maps op to the number of replays that failed.
+        self.skipped = 0  # Operations on handles the replay couldn't open.
+
+    def Run(self, records):
+        start = time.time()
+        for record in records:
+            if record.op in ('init', 'destroy'):
+                continue  # The replay starts and stops the filesystem itself.
+            if self.speed:
+                delay = start + record.start / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            args = self._Args(record)
+            if args is None:
+                self.skipped += 1
+                continue
+            began = time.time()
+            try:
+                ret = self.fs(record.op, record.path, *args)
+                if record.op == 'readdir_from':
+                    list(ret)
+                elif record.op == 'opendir':
+                    self.dirs[record.fh] = ret
+                elif record.op in ('open', 'create') and not record.errno:
+                    self.files[record.fh] = args[-1]
+            except Exception, e:
+                if not isinstance(e, OSError):
+                    print 'Replay of {0} {1} failed: {2!r}'.format(record.op, record.path, e)
+                self.errors[record.op] = self.errors.get(record.op, 0) + 1
+            self.latencies.setdefault(record.op, []).append(time.time() - began)
+            self.recorded.setdefault(record.op, []).append(record.duration)
+            if record.op == 'release':
+                self.files.pop(record.fh, None)
+            elif record.op == 'releasedir':
+                self.dirs.pop(record.fh, None)
+
+    def _Args(self, record):
+        """Arguments to replay a record with (after its path), or None if it can't be."""
+        op = record.op
+        fi = self.files.get(record.fh)
+        if op in ('open', 'create'):
+            flags = record.arg if op == 'open' else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            fi = fuse_file_info(flags=flags)
+            return (fi,) if op == 'open' else (record.arg, fi)
+        if op in ('readdir_from', 'releasedir', 'readdir', 'fsyncdir'):
+            fh = self.dirs.get(record.fh)
+            if fh is None:
+                return None
+            return {'readdir_from': (record.offset, fh), 'releasedir': (fh,),
+                    'readdir': (fh,), 'fsyncdir': (0, fh)}[op]
+        if op in ('read', 'readinto', 'write', 'writefrom', 'flush', 'fsync', 'release'):
+            if fi is None:
+                return None
+            if op == 'read':
+                return record.size, record.offset, fi
+            if op == 'readinto':
+                return ctypes.create_string_buffer(record.size), record.size, record.offset, fi
+            if op == 'write':
+                return '\0' * record.size, record.offset, fi
+            if op == 'writefrom':
+                buf = ctypes.create_string_buffer(record.size)
+                return buf, record.size, record.offset, fi
+            return (0, fi) if op == 'fsync' else (fi,)
+        if op == 'getattr':
+            return (fi,)
+        if op == 'truncate':
+            return (record.size, fi) if fi else (record.size,)
+        if op in ('mkdir', 'chmod', 'access'):
+            return (record.arg,)
+        if op in ('rename', 'getxattr', 'removexattr'):
+            return (record.name,)
+        if op == 'setxattr':
+            return record.name, '1', 0
+        if op in ('unlink', 'rmdir', 'opendir', 'listxattr', 'statfs', 'readlink'):
+            return ()
+        return None
+
+    def Report(self):
+        """Latency distribution of each operation, replayed next to recorded, in milliseconds."""
+        lines = ['{0:<13}{1:>8}{2:>7}{3:>10}{4:>10}{5:>10}{6:>10}{7:>10}{8:>12}'.format(
+            'op', 'count', 'errors', 'mean', 'p50', 'p90', 'p99', 'max', 'rec. p50')]
+        for op in sorted(self.latencies):
+            times = sorted(self.latencies[op])
+            lines.append('{0:<13}{1:>8}{2:>7}{3:>10.2f}{4:>10.2f}{5:>10.2f}{6:>10.2f}{7:>10.2f}'
+                         '{8:>12.2f}'.format(
+                             op, len(times), self.errors.get(op, 0),
+                             1000 * sum(times) / len(times), 1000 * _Percentile(times, 50),
+                             1000 * _Percentile(times, 90), 1000 * _Percentile(times, 99),
+                             1000 * times[-1],
+                             1000 * _Percentile(sorted(self.recorded[op]), 50)))
+        if self.skipped:
+            lines.append('{0} operations skipped: their file wasn\'t opened'.format(self.skipped))
+        return '\n'.join(lines)
+
+
+def _Percentile(sorted_values, percent):
+    """Nearest-rank percentile of a sorted, non-empty list."""
+    rank = max(int(round(percent / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a GlobusFS trace against a simulated endpoint.')
+    parser.add_argument('trace', help='Trace written by globusfs.py --record')
+    parser.add_argument('remote_dir', help='Local directory served as the remote endpoint')
+    parser.add_argument('cache_dir', help='Directory for the replay\'s file cache')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay this many times faster than recorded (0: no waiting)')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='Seconds before a simulated task starts moving data')
+    parser.add_argument('--throughput', type=float, default=10.0,
+                        help='Simulated transfer throughput in MB/s')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='MB/s shared by the streams of a simulated task (0: no limit)')
+    parser.add_argument('--file-overhead', type=float, default=0.05,
+                        help='Seconds a simulated task spends setting up each file')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='Change a setting (see control.py help) before replaying, '
+                             'e.g. small_concurrency=8')
+    parser.add_argument('--synthesize', action='store_true',
+                        help='First create the files the trace saw under remote_dir')
+    args = parser.parse_args()
+
+    trace_start, records = workload.ReadTrace(args.trace)
+    print 'Replaying {0} operations recorded at {1}'.format(
+        len(records), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(trace_start)))
+    if args.synthesize:
+        Synthesize(records, args.remote_dir)
+
+    endpoint = SimulatedEndpoint(args.remote_dir, args.latency, args.throughput * 1024 * 1024,
+                                 args.bandwidth * 1024 * 1024, args.file_overhead)
+    session_path = os.path.join(args.cache_dir, 'replay-session.json')
+    globus_fs = globusfs.GlobusFS(LOCAL_ENDPOINT, args.cache_dir, REMOTE_ENDPOINT,
+                                  globus_api=SimulatedAPI(endpoint, session_path))
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        reply = globus_fs.controller.Execute('set {0} {1}'.format(name, value))
+        print reply,
+        if reply.startswith('error:'):
+            globus_fs.destroy('/')
+            exit(1)
+    replayer = Replayer(globus_fs, args.speed)
+    began = time.time()
+    try:
+        replayer.Run(records)
+    finally:
+        elapsed = time.time() - began
+        globus_fs.destroy('/')
+    print replayer.Report()
+    print 'Replayed in {0:.1f}s ({1:.1f}s recorded)'.format(
+        elapsed, records[-1].start if records else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""Host-wide cache shared by the GlobusFS mounts of one machine.
+
+One daemon per host owns the metadata and the file data of every remote endpoint its mounts use.
+Mounts reach it over a unix socket: directory listings come from the daemon's MetaData, and files
+opened read-only are fetched by the daemon (once, however many mounts open them at the same time)
+and read by the mounts straight from its store. Writes, local changes, prefetches and ranged reads
+stay with each mount.
+
+    sudo python sharedcache.py --budget 200000 local-endpoint cache-directory
+    sudo python globusfs.py --shared-cache /run/globusfs.sock local-endpoint cache-directory remote-endpoint mnt
+
+The protocol is one JSON object per line each way. Requests name an op ('list' or 'fetch'), an
+endpoint and a path; replies carry the result, or 'errno' and 'message' if it failed.
+"""
+
+import argparse
+import errno
+import json
+import os
+import shutil
+import socket
+import SocketServer
+import stat
+import threading
+import time
+import urllib
+
+from globusonline.transfer import api_client
+
+import api
+import cache
+
+SOCKET_PATH = '/run/globusfs.sock'
+SHARED_DIR = '.globusfs-shared'  # Under the daemon's cache directory.
+
+
+def _ListEntry(name, attrs):
+    """A MetaData entry in the format of Globus' endpoint_ls (see MetaData._LoadRemoteDir())."""
+    return {
+        'name': name,
+        'type': 'dir' if stat.S_ISDIR(attrs['st_mode']) else 'file',
+        'permissions': '{0:04o}'.format(stat.S_IMODE(attrs['st_mode'])),
+        'size': attrs['st_size'],
+        'last_modified': time.strftime('%Y-%m-%d %H:%M:%S+00:00', time.gmtime(attrs['st_mtime'])),
+    }
+
+
+class _Store(object):
+    """The daemon's metadata and cached files for one remote endpoint."""
+
+    def __init__(self, globus_api, data_dir):
+        self.api = globus_api
+        self.metadata = cache.MetaData(globus_api)
+        self.data_dir = data_dir
+        self.index = {}  # Maps remote filepath to {'size', 'mtime', 'atime'} of the copy.
+        self.pending = {}  # Maps remote filepath to an Event set once its fetch is over.
+
+    def LocalPath(self, path):
+        return os.path.join(self.data_dir, path.lstrip('/'))
+
+
+class SharedCache(object):
+    """State of the cache daemon: one _Store per remote endpoint, under one disk budget.
+
+    Copies are evicted least recently fetched first once they take more than budget bytes.
+    Copies fetched in the last grace seconds are kept, so a mount can open what it was just given.
+    A mount that has a file open keeps reading it after eviction; its space is freed on close.
+    """
+
+    def __init__(self, local_endpoint, cache_dir, budget=None):
+        self.local_endpoint = local_endpoint
+        self.root = os.path.join(cache_dir, SHARED_DIR)
+        self.budget = budget  # Bytes; None for no limit.
+        self.grace = 60
+        self.lock = threading.Lock()  # Guards stores, their indexes and pending fetches.
+        self.stores = {}  # Maps remote endpoint name to its _Store.
+        self.used = 0  # Bytes of all cached copies.
+        self.fetches = 0  # Transfers started...
+        self.shared = 0  # ...and fetches served by a copy or transfer another mount asked for.
+        self.evictions = 0
+
+        # Copies of an earlier daemon aren't indexed, so they can't be trusted.
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+        os.chmod(self.root, 0777)
+
+    def _Store(self, endpoint):
+        with self.lock:
+            store = self.stores.get(endpoint)
+            if store is None:
+                data_dir = os.path.join(self.root, urllib.quote(endpoint, safe=''))
+                store = self.stores[endpoint] = _Store(
+                    api.GlobusAPI(self.local_endpoint, endpoint), data_dir)
+            return store
+
+    def List(self, endpoint, path):
+        """The listing of a remote directory, in the format of endpoint_ls."""
+        metadata = self._Store(endpoint).metadata
+        listing = []
+        for name in metadata.Listdir(path)[2:]:
+            attrs = metadata.Stat(os.path.join(path, name))
+            if attrs:
+                listing.append(_ListEntry(name, attrs))
+        return listing
+
+    def Fetch(self, endpoint, path):
+        """Local path of an up-to-date copy of a remote file, fetching it if need be.
+
+        Raises:
+            IOError: the file doesn't exist or couldn't be transferred.
+        """
+        store = self._Store(endpoint)
+        attrs = store.metadata.Stat(path)
+        if attrs is None:
+            raise IOError(errno.ENOENT, 'No such file: {0}'.format(path))
+        if stat.S_ISDIR(attrs['st_mode']):
+            raise IOError(errno.EISDIR, 'Is a directory: {0}'.format(path))
+        local_path = store.LocalPath(path)
+
+        while True:
+            with self.lock:
+                entry = store.index.get(path)
+                if (entry and entry['size'] == attrs['st_size'] and
+                        entry['mtime'] == attrs['st_mtime']):
+                    entry['atime'] = time.time()
+                    self.shared += 1
+                    return local_path
+                done = store.pending.get(path)
+                if done is None:
+                    done = store.pending[path] = threading.Event()
+                    break
+            done.wait()  # Another mount is fetching it; use its copy if it worked.
+
+        try:
+            with self.lock:
+                outdated = store.index.pop(path, None)
+                if outdated:
+                    self.used -= outdated['size']
+                self.fetches += 1
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            if not os.path.isdir(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            if not store.api.CopyToLocal(path, local_path, attrs['st_size']):
+                raise IOError(errno.EIO, 'Transfer of {0} failed'.format(path))
+            with self.lock:
+                store.index[path] = {'size': attrs['st_size'], 'mtime': attrs['st_mtime'],
+                                     'atime': time.time()}
+                self.used += attrs['st_size']
+                self._Evict()
+        finally:
+            with self.lock:
+                del store.pending[path]
+            done.set()
+        return local_path
+
+    def _Evict(self):
+        """Remove the least recently fetched copies beyond the budget. Call with self.lock held."""
+        if self.budget is None or self.used <= self.budget:
+            return
+        now = time.time()
+        copies = sorted((entry['atime'], store, path)
+                        for store in self.stores.itervalues()
+                        for path, entry in store.index.iteritems()
+                        if now - entry['atime'] > self.grace and path not in store.pending)
+        for _, store, path in copies:
+            if self.used <= self.budget:
+                break
+            entry = store.index.pop(path)
+            try:
+                os.remove(store.LocalPath(path))
+            except OSError:
+                pass
+            self.used -= entry['size']
+            self.evictions += 1
+
+    def Close(self):
+        for store in self.stores.itervalues():
+            store.api.Close()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """Serve the requests of one mount connection (see the module docstring)."""
+
+    def handle(self):
+        shared_cache = self.server.shared_cache
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request['op'] == 'list':
+                    reply = {'DATA': shared_cache.List(request['endpoint'], request['path'])}
+                elif request['op'] == 'fetch':
+                    reply = {'local_path': shared_cache.Fetch(request['endpoint'],
+                                                              request['path'])}
+                else:
+                    reply = {'errno': errno.EINVAL,
+                             'message': 'Unknown op {0!r}'.format(request['op'])}
+            except EnvironmentError, e:
+                reply = {'errno': e.errno or errno.EIO, 'message': str(e)}
+            except (ValueError, KeyError, api_client.APIError), e:
+                reply = {'errno': errno.EIO, 'message': str(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class SharedCacheClient(object):
+    """A mount's connection to the cache daemon, for one remote endpoint.
+
+    Stands in for GlobusAPI as the source of MetaData's listings (see EndpointList()). Each
+    thread has its own connection, so concurrent fetches of one mount don't wait for each other.
+    """
+
+    def __init__(self, socket_path, endpoint):
+        self.socket_path = socket_path
+        self.endpoint = endpoint
+        self.local = threading.local()
+
+    def _Request(self, op, path):
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self.local.sock, self.local.rfile = sock, sock.makefile('rb')
+        try:
+            sock.sendall(json.dumps({'op': op, 'endpoint': self.endpoint, 'path': path}) + '\n')
+            line = self.local.rfile.readline()
+            if not line:
+                raise IOError(errno.ECONNRESET, 'The cache daemon closed the connection')
+        except EnvironmentError:
+            sock.close()
+            self.local.sock = None  # Reconnect on the next request.
+            raise
+        reply = json.loads(line)
+        if 'errno' in reply:
+            raise IOError(reply['errno'], reply['message'])
+        return reply
+
+    def EndpointList(self, path):
+        """List a remote directory, like GlobusAPI.EndpointList()."""
+        return self._Request('list', path)['DATA']
+
+    def Fetch(self, path):
+        """Local path of the daemon's copy of a remote file; blocks until it has arrived."""
+        return self._Request('fetch', path)['local_path']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve one cache to all GlobusFS mounts of this host.')
+    parser.add_argument('local_endpoint', help='Name of the Globus endpoint running locally')
+    parser.add_argument('cache_dir', help='Directory visible from the local endpoint. The shared '
+                        'cache is stored here.')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Unix socket to serve mounts on')
+    parser.add_argument('--budget', type=int, metavar='MB',
+                        help='Most disk space used by cached copies')
+    args = parser.parse_args()
+
+    budget = args.budget * 1024 * 1024 if args.budget is not None else None
+    shared_cache = SharedCache(args.local_endpoint, args.cache_dir, budget)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = _Server(args.socket, _Handler)
+    os.chmod(args.socket, 0600)  # Mounts run as root.
+    server.shared_cache = shared_cache
+    print 'Serving the shared cache on {0}'.format(args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        shared_cache.Close()
+
+
+if __name__ == '__main__':
+    main()
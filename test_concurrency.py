@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Concurrency stress test of GlobusFS against the simulated endpoint of replay.py.
+
+Many threads open, read, stat and list files at once, as FUSE does when multithreaded, while
+one directory's listing is stuck on the endpoint.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from fuse import fuse_file_info
+
+import globusfs
+import replay
+
+THREADS = 8
+OPS_PER_THREAD = 200
+
+
+class _GatedEndpoint(replay.SimulatedEndpoint):
+    """Simulated endpoint whose listings of the gated directories wait until opened."""
+
+    def __init__(self, root, latency):
+        replay.SimulatedEndpoint.__init__(self, root, latency, file_overhead=0)
+        self.gated = set()
+        self.gate = threading.Event()
+
+    def endpoint_ls(self, endpoint, path='/'):
+        if path in self.gated:
+            self.gate.wait()
+        return replay.SimulatedEndpoint.endpoint_ls(self, endpoint, path)
+
+
+def _Contents(path):
+    return (path.encode('utf-8') + '\n') * 100
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        remote_dir = os.path.join(self.tmp_dir, 'remote')
+        for dirpath, count in (('/hot', 40), ('/slow', 3)):
+            os.makedirs(remote_dir + dirpath)
+            for i in xrange(count):
+                path = '{0}/file{1:02d}'.format(dirpath, i)
+                with open(remote_dir + path, 'w') as f:
+                    f.write(_Contents(path))
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(cache_dir)
+        self.endpoint = _GatedEndpoint(remote_dir, latency=0.05)
+        self.fs = globusfs.GlobusFS(
+            replay.LOCAL_ENDPOINT, cache_dir, replay.REMOTE_ENDPOINT,
+            globus_api=replay.SimulatedAPI(self.endpoint, os.path.join(cache_dir, 'session')))
+        self.errors = []
+
+    def tearDown(self):
+        self.endpoint.gate.set()
+        while self.fs.file_cache.pending:
+            time.sleep(0.1)  # Let transfers finish writing into the cache before it goes.
+        self.fs.destroy('/')
+        shutil.rmtree(self.tmp_dir)
+
+    def _Read(self, path):
+        fi = fuse_file_info(flags=os.O_RDONLY)
+        self.fs.open(path, fi)
+        try:
+            return self.fs.read(path, 1 << 20, 0, fi)
+        finally:
+            self.fs.release(path, fi)
+
+    def _Stress(self, seed):
+        """Random opens, reads, stats and listings of /hot."""
+        rand = random.Random(seed)
+        try:
+            for _ in xrange(OPS_PER_THREAD):
+                path = u'/hot/file{0:02d}'.format(rand.randrange(40))
+                op = rand.randrange(3)
+                if op == 0:
+                    self.assertEqual(self._Read(path), _Contents(path))
+                elif op == 1:
+                    self.assertEqual(self.fs.getattr(path).st_size, len(_Contents(path)))
+                else:
+                    fh = self.fs.opendir(u'/hot')
+                    names = [name for name, _, _ in self.fs.readdir_from(u'/hot', 0, fh)]
+                    self.fs.releasedir(u'/hot', fh)
+                    self.assertEqual(len(names), 42)
+        except Exception, e:
+            self.errors.append(e)
+
+    def _Run(self, target, args=()):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def testSlowListingStallsNothingElse(self):
+        self.endpoint.gated.add('/slow')
+        stuck = [
+            self._Run(self.fs.getattr, (u'/slow/file00',)),
+            # Prefetching looks up the file's size, which needs the stuck listing.
+            self._Run(self.fs.file_cache.Prefetch, (u'/slow/file01',)),
+        ]
+        time.sleep(0.2)
+
+        start = time.time()
+        threads = [self._Run(self._Stress, (seed,)) for seed in xrange(THREADS)]
+        deadline = start + 60
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        self.assertFalse(any(thread.is_alive() for thread in threads), 'Stalled')
+        self.assertEqual(self.errors, [])
+        self.assertTrue(all(thread.is_alive() for thread in stuck))
+        print '{0} operations in {1:.1f}s while a listing was stuck'.format(
+            THREADS * OPS_PER_THREAD, time.time() - start)
+
+        self.endpoint.gate.set()
+        for thread in stuck:
+            thread.join(10)
+        self.assertEqual(self._Read(u'/slow/file01'), _Contents(u'/slow/file01'))
+
+    def testConcurrentOpensShareOneTransfer(self):
+        path = u'/hot/file07'
+        results = []
+        threads = [self._Run(lambda: results.append(self._Read(path)))
+                   for _ in xrange(THREADS)]
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(results, [_Contents(path)] * THREADS)
+        self.assertEqual(len(self.endpoint.tasks), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Tests of the control file of GlobusFS against the simulated endpoint of replay.py.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from fuse import FuseOSError, fuse_file_info
+
+import control
+import globusfs
+import replay
+
+
+class ControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        remote_dir = os.path.join(self.tmp_dir, 'remote')
+        os.makedirs(os.path.join(remote_dir, 'data'))
+        with open(os.path.join(remote_dir, 'data', 'file'), 'w') as f:
+            f.write('contents\n')
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(cache_dir)
+        self.endpoint = replay.SimulatedEndpoint(remote_dir, latency=0.01, file_overhead=0)
+        self.fs = globusfs.GlobusFS(
+            replay.LOCAL_ENDPOINT, cache_dir, replay.REMOTE_ENDPOINT,
+            globus_api=replay.SimulatedAPI(self.endpoint, os.path.join(cache_dir, 'session')))
+
+    def tearDown(self):
+        self.fs.destroy('/')
+        shutil.rmtree(self.tmp_dir)
+
+    def _Command(self, line):
+        """Write line to the control file and read back the reply."""
+        fi = fuse_file_info(flags=os.O_RDWR)
+        self.fs.open(control.CONTROL_PATH, fi)
+        try:
+            self.fs.write(control.CONTROL_PATH, line + '\n', 0, fi)
+            return self.fs.read(control.CONTROL_PATH, 1 << 16, 0, fi)
+        finally:
+            self.fs.release(control.CONTROL_PATH, fi)
+
+    def _Listing(self, path):
+        fh = self.fs.opendir(path)
+        try:
+            return sorted(name for name, _, _ in self.fs.readdir_from(path, 0, fh))
+        finally:
+            self.fs.releasedir(path, fh)
+
+    def testForgetKeepsTheDirectoryItself(self):
+        self.assertEqual(self._Listing('/data'), ['.', '..', 'file'])
+        self.assertEqual(self._Command('forget /data'), 'ok\n')
+        self.assertTrue(stat.S_ISDIR(self.fs.getattr('/data').st_mode))
+        self.assertEqual(self.fs.getattr('/data/file').st_size, len('contents\n'))
+
+    def testForgetAndRefreshRoot(self):
+        self.assertEqual(self.fs.getattr('/data/file').st_size, len('contents\n'))
+        for line, reply in (('forget /', 'ok\n'), ('refresh /', '1 entries\n')):
+            self.assertEqual(self._Command(line), reply)
+            self.assertTrue(stat.S_ISDIR(self.fs.getattr('/').st_mode))
+            self.assertIn('data', self._Listing('/'))
+            self.assertEqual(self.fs.getattr('/data/file').st_size, len('contents\n'))
+        self.assertRaises(FuseOSError, self.fs.getattr, '/missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
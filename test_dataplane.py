@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Tests of ranged reads: HTTPSDataPlane against a local HTTP server, and SparseFile on top.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import BaseHTTPServer
+import ctypes
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import unittest
+
+import api
+import cache
+
+DATA = ''.join(chr(i % 251) for i in xrange(10000))
+
+
+class _RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve DATA at /data/file, honoring Range unless the server says otherwise: it may
+    ignore it, serve the range shifted by range_shift bytes, or stall until resumed."""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the endpoint.
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        if self.server.stall:
+            self.server.resume.wait(10)
+        if self.path != '/data/file':
+            return self._Reply(404, 'not found')
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range') or '')
+        if not match:
+            return self._Reply(200, DATA)
+        if self.server.ignore_range:
+            return self._WholeHugeFile()
+        first = int(match.group(1)) + self.server.range_shift
+        last = min(int(match.group(2)) + self.server.range_shift, len(DATA) - 1)
+        if first >= len(DATA):
+            return self._Reply(416, '')
+        return self._Reply(206, DATA[first:last + 1], {
+            'Content-Range': 'bytes {0}-{1}/{2}'.format(first, last, len(DATA))})
+
+    def _Reply(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _WholeHugeFile(self):
+        """Answer 200 with a body far too large to buffer, until the client hangs up (or for
+        10 seconds, so a client that does read it fails rather than hangs)."""
+        self.send_response(200)
+        self.send_header('Content-Length', str(1 << 40))
+        self.end_headers()
+        deadline = time.time() + 10
+        try:
+            while time.time() < deadline:
+                self.wfile.write(DATA)
+                time.sleep(0.001)
+        except socket.error:
+            pass
+        self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded server that can end its keep-alive connections (see Close())."""
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.connections = []  # (socket, thread) of every request served.
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        self.connections.append((request, thread))
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        pass  # Clients hanging up mid-reply on purpose.
+
+    def Close(self):
+        """Stop serving and wait for the request threads, which would otherwise only notice
+        their clients are gone while the interpreter exits."""
+        self.shutdown()
+        self.server_close()
+        for request, thread in self.connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # Already closed.
+            thread.join(5)
+
+
+class RangeServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _RangeHandler)
+        self.server.requests = []
+        self.server.ignore_range = False
+        self.server.range_shift = 0
+        self.server.stall = False
+        self.server.resume = threading.Event()
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.data_plane = api.HTTPSDataPlane('http://127.0.0.1:{0}/data'.format(
+            self.server.server_address[1]))
+
+    def tearDown(self):
+        self.server.resume.set()
+        self.server.Close()
+
+
+class HTTPSDataPlaneTest(RangeServerTestCase):
+
+    def testPartialContent(self):
+        self.assertEqual(self.data_plane.ReadRange(u'/file', 100, 50), DATA[100:150])
+        self.assertEqual(self.server.requests, ['bytes=100-149'])
+
+    def testShortAtEndOfFile(self):
+        self.assertEqual(self.data_plane.ReadRange(u'/file', 9990, 50), DATA[9990:])
+
+    def testPastEndOfFile(self):
+        self.assertEqual(self.data_plane.ReadRange(u'/file', 20000, 50), '')
+
+    def testRangeIgnored(self):
+        self.server.ignore_range = True
+        start = time.time()
+        self.assertRaises(IOError, self.data_plane.ReadRange, u'/file', 0, 50)
+        self.assertLess(time.time() - start, 5)  # The whole file wasn't read.
+        # Nor was it left on the connection for the next request.
+        self.server.ignore_range = False
+        self.assertEqual(self.data_plane.ReadRange(u'/file', 0, 50), DATA[:50])
+
+    def testMissingFile(self):
+        self.assertRaises(IOError, self.data_plane.ReadRange, u'/missing', 0, 50)
+
+    def testWrongRange(self):
+        self.server.range_shift = 10
+        self.assertRaises(IOError, self.data_plane.ReadRange, u'/file', 100, 50)
+        self.server.range_shift = 0
+        self.assertEqual(self.data_plane.ReadRange(u'/file', 100, 50), DATA[100:150])
+
+    def testStalledServer(self):
+        self.server.stall = True
+        data_plane = api.HTTPSDataPlane(self.data_plane.scheme + '://' + self.data_plane.netloc,
+                                        timeout=0.2)
+        start = time.time()
+        self.assertRaises(IOError, data_plane.ReadRange, u'/data/file', 0, 50)
+        self.assertLess(time.time() - start, 5)
+
+
+class SparseFileTest(RangeServerTestCase):
+
+    def setUp(self):
+        super(SparseFileTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sparse = None
+
+    def tearDown(self):
+        if self.sparse:
+            self.sparse.Close()
+        shutil.rmtree(self.tmp_dir)
+        super(SparseFileTest, self).tearDown()
+
+    def _SparseFile(self, readahead):
+        self.sparse = cache.SparseFile(self.data_plane, u'/file',
+                                       os.path.join(self.tmp_dir, 'file'), len(DATA), readahead)
+        self.sparse.BLOCK_SIZE = 1000
+        return self.sparse
+
+    def testBlocksAreReused(self):
+        sparse = self._SparseFile(readahead=0)
+        self.assertEqual(sparse.Read(10, 20), DATA[10:30])
+        self.assertEqual(sparse.Read(500, 100), DATA[500:600])
+        self.assertEqual(self.server.requests, ['bytes=0-999'])
+
+        # Only the missing blocks are fetched, contiguous ones with a single request.
+        self.assertEqual(sparse.Read(900, 2500), DATA[900:3400])
+        self.assertEqual(self.server.requests, ['bytes=0-999', 'bytes=1000-3999'])
+
+    def testWrongRangeIsNotStored(self):
+        sparse = self._SparseFile(readahead=0)
+        self.server.range_shift = 1000
+        self.assertRaises(IOError, sparse.Read, 10, 20)
+        self.server.range_shift = 0
+        self.assertEqual(sparse.Read(10, 20), DATA[10:30])
+
+    def testReadIntoAtEndOfFile(self):
+        sparse = self._SparseFile(readahead=0)
+        buf = ctypes.create_string_buffer(100)
+        self.assertEqual(sparse.ReadInto(buf, 9950, 100), 50)
+        self.assertEqual(buf.raw[:50], DATA[9950:])
+        self.assertEqual(sparse.Read(len(DATA), 10), '')
+
+    def testSequentialReadAhead(self):
+        sparse = self._SparseFile(readahead=2)
+        data = ''.join(sparse.Read(offset, 250) for offset in xrange(0, len(DATA), 250))
+        self.assertEqual(data, DATA)
+
+        # Read-ahead never fetches a block twice, however many reads triggered it.
+        blocks = []
+        for header in self.server.requests:
+            first, last = [int(n) for n in re.match(r'bytes=(\d+)-(\d+)$', header).groups()]
+            blocks.extend(xrange(first // 1000, last // 1000 + 1))
+        self.assertEqual(sorted(blocks), range(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Tests of transfer timeouts against the simulated endpoint of replay.py.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fuse import FuseOSError, fuse_file_info
+
+import globusfs
+import replay
+
+MB = 1024 * 1024
+PATH = '/data/file'
+CONTENTS = ''.join(chr(i % 251) for i in xrange(64 * 1024))
+
+
+class TransferTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        remote_dir = os.path.join(self.tmp_dir, 'remote')
+        os.makedirs(os.path.join(remote_dir, 'data'))
+        with open(remote_dir + PATH, 'wb') as f:
+            f.write(CONTENTS)
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(cache_dir)
+        self.endpoint = replay.SimulatedEndpoint(
+            remote_dir, latency=0.05, throughput=10 * MB, file_overhead=0)
+        self.fs = globusfs.GlobusFS(
+            replay.LOCAL_ENDPOINT, cache_dir, replay.REMOTE_ENDPOINT,
+            globus_api=replay.SimulatedAPI(self.endpoint, os.path.join(cache_dir, 'session')))
+        self.fs.file_cache.progressive = False  # Opens wait for the whole file.
+        self.api = self.fs.api
+
+    def tearDown(self):
+        self.endpoint.throughput = 10 * MB
+        while self.fs.file_cache.pending:
+            time.sleep(0.1)  # Let transfers finish writing into the cache before it goes.
+        self.fs.destroy('/')
+        shutil.rmtree(self.tmp_dir)
+
+    def _Read(self, path):
+        fi = fuse_file_info(flags=os.O_RDONLY)
+        self.fs.open(path, fi)
+        try:
+            return self.fs.read(path, 1 << 20, 0, fi)
+        finally:
+            self.fs.release(path, fi)
+
+    def _Learned(self, latency, throughput):
+        """Make the remote endpoint's estimate latency seconds plus throughput bytes/s."""
+        self.api.min_timeout = 0
+        estimator = self.api.Estimator()
+        estimator.latency, estimator.throughput = latency, throughput
+
+    def testTimeoutScalesWithLearnedThroughput(self):
+        estimator = self.api.Estimator()
+        initial_latency = estimator.latency
+        self.assertEqual(self._Read(PATH), CONTENTS)
+        self.assertLess(estimator.latency, initial_latency)  # Learned from the completed task.
+
+        self.api.min_timeout = 0
+        before = self.api.TransferTimeout(100 * MB)
+        for _ in xrange(20):
+            estimator.Observe(100 * MB, estimator.latency + 10.0)  # 10 MB/s.
+        self.assertAlmostEqual(estimator.throughput / MB, 10.0, places=1)
+        self.assertLess(self.api.TransferTimeout(100 * MB), before / 5)
+        # Past the fixed latency, timeouts grow with the size at the learned throughput.
+        self.assertAlmostEqual(
+            self.api.TransferTimeout(200 * MB) - self.api.TransferTimeout(100 * MB),
+            self.api.timeout_factor * 10.0, places=1)
+        self.api.min_timeout = 30
+        self.assertEqual(self.api.TransferTimeout(1024), 30)
+
+    def testTimedOutOpenAttachesToTheRunningTask(self):
+        self._Learned(latency=0.1, throughput=MB)  # Opens time out after half a second...
+        self.api.expiry_factor = 100  # ...and the task outlives them.
+        self.endpoint.throughput = len(CONTENTS) / 2.0  # The transfer takes two seconds.
+        timeouts = 0
+        for _ in xrange(20):
+            try:
+                contents = self._Read(PATH)
+                break
+            except FuseOSError, e:
+                self.assertEqual(e.errno, errno.ETIMEDOUT)
+                timeouts += 1
+        self.assertGreater(timeouts, 0)
+        self.assertEqual(contents, CONTENTS)
+        self.assertEqual(len(self.endpoint.tasks), 1)
+
+    def testDeadlineExpiryCancelsTheTask(self):
+        self._Learned(latency=0.1, throughput=MB)
+        self.api.expiry_factor = 5  # Globus gives the task one or two seconds.
+        self.endpoint.throughput = len(CONTENTS) / 60.0
+        try:
+            self._Read(PATH)
+            self.fail('The read did not time out')
+        except FuseOSError, e:
+            self.assertEqual(e.errno, errno.ETIMEDOUT)
+        for _ in xrange(100):
+            if not self.fs.file_cache.pending:
+                break
+            time.sleep(0.1)
+        task_id, = self.endpoint.tasks
+        self.assertEqual(self.endpoint.expired, set([task_id]))
+        self.assertEqual(self.endpoint.tasks[task_id]['status'], 'FAILED')
+
+        # Nothing of the expired task is kept; opening the file again starts over.
+        self.endpoint.throughput = 10 * MB
+        self.api.min_timeout = 10
+        self.assertEqual(self._Read(PATH), CONTENTS)
+        self.assertEqual(len(self.endpoint.tasks), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
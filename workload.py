@@ -0,0 +1,183 @@
+"""Record the FUSE operations served by a mount in a compact binary trace.
+
+A trace starts with a header (magic, version, wall-clock start time), followed by two kinds of
+records: path definitions, which give each distinct path or attribute name a number the first
+time it is seen, and operations, which refer to paths by that number. replay.py drives a trace
+against a GlobusFS backed by a simulated endpoint.
+"""
+
+import collections
+import errno
+import struct
+import threading
+import time
+
+MAGIC = 'GFSTRACE'
+VERSION = 1
+_HEADER = struct.Struct('<8sHd')  # magic, version, start time
+_PATH = struct.Struct('<BIH')  # kind, path id, length of the UTF-8 path that follows
+_OP = struct.Struct('<BBdfhQqqqIII')  # kind, op, start, duration, errno, fh, size, offset,
+                                      # result, arg, path id, name id
+_KIND_PATH, _KIND_OP = 0, 1
+
+# Operation codes. New operations are only ever appended, so old traces stay readable.
+OPS = ('access', 'bmap', 'chmod', 'chown', 'create', 'destroy', 'flush', 'fsync', 'fsyncdir',
+       'getattr', 'getxattr', 'init', 'link', 'listxattr', 'lock', 'mkdir', 'mknod', 'open',
+       'opendir', 'read', 'readdir', 'readdir_from', 'readinto', 'readlink', 'release',
+       'releasedir', 'removexattr', 'rename', 'rmdir', 'setxattr', 'statfs', 'symlink',
+       'truncate', 'unlink', 'utimens', 'write', 'writefrom')
+_OP_CODES = dict((op, code) for code, op in enumerate(OPS))
+
+# One traced operation. Fields an operation doesn't have are 0 (name: None).
+#   start, duration: seconds since the trace began, and how long the operation took.
+#   errno: the error it failed with, or 0.
+#   fh: file or directory handle it used or opened.
+#   size, offset: bytes asked for and where (size is the new length for truncate).
+#   result: bytes read or written, entries listed, or st_size for getattr.
+#   arg: open flags, the mode of create/mkdir/chmod, or st_mode for getattr.
+#   name: second path of rename, or attribute name of the xattr operations.
+Record = collections.namedtuple(
+    'Record', 'op start duration errno fh size offset result arg path name')
+
+
+class TraceWriter(object):
+    """Append operation records to a trace file. Safe to use from several threads."""
+
+    def __init__(self, trace_path):
+        self.file = open(trace_path, 'wb')
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.path_ids = {}
+        self.file.write(_HEADER.pack(MAGIC, VERSION, self.start))
+
+    def _PathId(self, path):
+        """Number of a path, defining it in the trace if it's new. Call with self.lock held."""
+        if path is None:
+            return 0
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = self.path_ids[path] = len(self.path_ids) + 1
+            data = path.encode('utf-8')
+            self.file.write(_PATH.pack(_KIND_PATH, path_id, len(data)) + data)
+        return path_id
+
+    def Write(self, op, start, duration, err=0, fh=0, size=0, offset=0, result=0, arg=0,
+              path=None, name=None):
+        """Record one operation; start is its time.time() when it began."""
+        with self.lock:
+            self.file.write(_OP.pack(
+                _KIND_OP, _OP_CODES[op], start - self.start, duration, err, fh or 0, size,
+                offset, result, arg, self._PathId(path), self._PathId(name)))
+
+    def Close(self):
+        with self.lock:
+            self.file.close()
+
+
+def ReadTrace(trace_path):
+    """Return (start time, list of Records) of a trace file.
+
+    Raises:
+        ValueError: the file isn't a trace, or was written by a newer version.
+    """
+    with open(trace_path, 'rb') as f:
+        data = f.read()
+    magic, version, start = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('{0} is not a GlobusFS trace'.format(trace_path))
+    if version > VERSION:
+        raise ValueError('{0} is a version {1} trace; upgrade GlobusFS'.format(trace_path, version))
+
+    paths = {0: None}
+    records = []
+    pos = _HEADER.size
+    # A trace cut short by a crash ends with a partial record; everything before it is kept.
+    while pos < len(data):
+        kind = ord(data[pos])
+        if kind == _KIND_PATH:
+            if pos + _PATH.size > len(data):
+                break
+            _, path_id, length = _PATH.unpack_from(data, pos)
+            pos += _PATH.size
+            paths[path_id] = data[pos:pos + length].decode('utf-8')
+            pos += length
+        else:
+            if pos + _OP.size > len(data):
+                break
+            fields = _OP.unpack_from(data, pos)
+            pos += _OP.size
+            op, rest, path_id, name_id = OPS[fields[1]], fields[2:-2], fields[-2], fields[-1]
+            records.append(Record(op, *(rest + (paths[path_id], paths[name_id]))))
+    return start, records
+
+
+class RecordingMixIn:
+    """Record every operation into self.trace (a TraceWriter), like fuse.LoggingMixIn logs them.
+
+    Mix it in ahead of the Operations class and set trace before mounting, e.g.
+
+        class RecordingGlobusFS(RecordingMixIn, GlobusFS): pass
+
+    Operations with no trace set are served without being recorded. The mount is expected to
+    run with raw_fi, as GlobusFS does.
+    """
+    trace = None
+
+    def __call__(self, op, path, *args):
+        if self.trace is None:
+            return getattr(self, op)(path, *args)
+        start = time.time()
+        err = 0
+        ret = None
+        try:
+            ret = getattr(self, op)(path, *args)
+            if op == 'readdir_from':
+                ret = list(ret)  # Time the listing itself, not the creation of a generator.
+            return ret
+        except OSError, e:
+            err = e.errno or errno.EFAULT
+            raise
+        except:
+            err = errno.EFAULT
+            raise
+        finally:
+            duration = time.time() - start
+            try:
+                self.trace.Write(op, start, duration, err, path=path,
+                                 **_Fields(op, args, ret))
+            except (ValueError, struct.error), e:
+                print 'Not recording {0} {1}: {2}'.format(op, path, e)
+
+
+def _Fields(op, args, ret):
+    """Pick the traced fields (see Record) out of the arguments and result of an operation."""
+    fields = {}
+    fi = next((arg for arg in args if hasattr(arg, 'fh')), None)
+    if fi is not None:
+        fields['fh'] = fi.fh  # Set by open and create by the time they return.
+    if op in ('read', 'readinto'):
+        fields.update(size=args[-3], offset=args[-2])
+        fields['result'] = len(ret) if isinstance(ret, str) else ret or 0
+    elif op == 'write':
+        fields.update(size=len(args[0]), offset=args[1], result=ret or 0)
+    elif op == 'writefrom':
+        fields.update(size=args[1], offset=args[2], result=ret or 0)
+    elif op == 'truncate':
+        fields['size'] = args[0]
+    elif op == 'open':
+        fields['arg'] = fi.flags
+    elif op in ('create', 'mkdir', 'chmod', 'mknod', 'access'):
+        fields['arg'] = args[0]
+    elif op == 'getattr' and isinstance(ret, dict):
+        fields.update(arg=ret['st_mode'], result=ret['st_size'])
+    elif op == 'getattr' and ret:  # A c_stat
+        fields.update(arg=ret.st_mode, result=ret.st_size)
+    elif op == 'opendir':
+        fields['fh'] = ret
+    elif op == 'readdir_from':
+        fields.update(offset=args[0], fh=args[1], result=len(ret or ()))
+    elif op in ('readdir', 'releasedir', 'fsyncdir'):
+        fields['fh'] = args[-1]
+    elif op in ('rename', 'link', 'symlink', 'getxattr', 'setxattr', 'removexattr'):
+        fields['name'] = args[0]
+    return fields